@@ -0,0 +1,4 @@
+from mcproxy.proxy import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Microbenchmarks of the parser, builder, shared pointer, allocator, serializer, hot key sampler
+and latency histogram hot paths.
+
+Every result is printed as one JSON object per line, so that the output of two runs
+can be compared with --compare:
+
+    python -m mcproxy.bench --output base.json
+    python -m mcproxy.bench --compare base.json
+"""
+import argparse
+import json
+import sys
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import cbench  # type: ignore
+
+VALUE_SIZES = [16, 256, 4096, 65536]
+
+# 0 means the whole stream at once, 1460 is a typical TCP segment and 16384 the client read size
+FRAGMENTS = [0, 16384, 1460, 100]
+
+WRITE_LIMITS = [256, 1024, 4096]
+
+MSET_VALUE_SIZES = [100, 2048]
+
+KEY = b'bench:key:000001'
+
+# a small block, the parser, the builder and the client read buffer
+ALLOC_SIZES = [64, 1488, 9336, 16384]
+
+SERIALIZER_VALUES: List[Tuple[str, Any]] = [
+    ('int', 1234567), ('str', 'user:1234567'), ('float', 0.125), ('dict', {'id': 1234567, 'name': 'user'}),
+]
+
+# 1 samples every request, the upper bound of the cost of the sampler
+HOT_KEYS_SAMPLE_RATES = [1, 100]
+
+_TARGET_STREAM_BYTES = 1 << 20
+
+Result = Dict[str, Any]
+
+
+def _responses(value_size: int) -> bytes:
+    value = b'v' * value_size
+    resp = b'VA %d f3 c101\r\n%s\r\n' % (value_size, value)
+    return resp * max(64, _TARGET_STREAM_BYTES // len(resp))
+
+
+def _measure(fn: Callable[[], Tuple[float, int, int]], repeat: int) -> Tuple[float, int, int]:
+    # the best of repeat runs is the least disturbed by the rest of the system
+    best = None
+    for _ in range(repeat):
+        elapsed, ops, nbytes = fn()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, ops, nbytes)
+    assert best is not None
+    return best
+
+
+def _result(name: str, params: Dict[str, Any], measured: Tuple[float, int, int]) -> Result:
+    elapsed, ops, nbytes = measured
+    elapsed = max(elapsed, 1e-9)
+    res: Result = {
+        'name': name,
+        'params': params,
+        'seconds': elapsed,
+        'ops': ops,
+        'ops_per_sec': ops / elapsed,
+        'ns_per_op': elapsed * 1e9 / max(ops, 1),
+    }
+    if nbytes:
+        res['mb_per_sec'] = nbytes / elapsed / 1e6
+    return res
+
+
+Bench = Tuple[str, Dict[str, Any], Callable[[], Tuple[float, int, int]]]
+
+
+def _benchmarks(scale: float) -> Iterator[Bench]:
+    rounds = max(1, int(8 * scale))
+    for value_size in VALUE_SIZES:
+        data = _responses(value_size)
+        for fragment in FRAGMENTS:
+            params = {'value_size': value_size, 'fragment': fragment}
+            yield 'parser_handle', params, partial(cbench.parser_stream, data, fragment, rounds)
+            yield 'parser_handle_batch', params, partial(cbench.parser_batch, data, fragment, rounds)
+
+    ops = max(1, int(200000 * scale))
+    for writev in (False, True):
+        for limit in WRITE_LIMITS:
+            params = {'write_limit': limit, 'writev': writev}
+            yield 'builder_add_mget', params, partial(cbench.builder_mget, ops, KEY, limit, writev)
+            for value_size in MSET_VALUE_SIZES:
+                value = b'v' * value_size
+                yield 'builder_add_mset', dict(params, value_size=value_size), \
+                    partial(cbench.builder_mset, ops, KEY, value, limit, writev)
+
+    ptr_ops = max(1, int(5000000 * scale))
+    yield 'ptr_clone_free', {}, partial(cbench.ptr_clone_free, ptr_ops)
+
+    alloc_ops = max(1, int(2000000 * scale))
+    for size in ALLOC_SIZES:
+        yield 'alloc_free', {'size': size}, partial(cbench.alloc_free, alloc_ops, size)
+
+    # the dict goes through the pickle fallback, the cost the native types avoid
+    serializer_ops = max(1, int(500000 * scale))
+    for type_name, value in SERIALIZER_VALUES:
+        yield 'serializer_round_trip', {'type': type_name}, \
+            partial(cbench.serializer_round_trip, value, serializer_ops)
+
+    hot_keys_ops = max(1, int(5000000 * scale))
+    for rate in HOT_KEYS_SAMPLE_RATES:
+        yield 'hot_keys_sample', {'sample_rate': rate}, partial(cbench.hot_keys_sample, hot_keys_ops, rate, 1000)
+
+    histogram_ops = max(1, int(5000000 * scale))
+    yield 'histogram_record', {}, partial(cbench.histogram_record, histogram_ops)
+
+
+def run(scale: float = 1.0, repeat: int = 5, name_filter: str = '') -> Iterator[Result]:
+    """
+    Runs the benchmarks whose name contains name_filter,
+    scale multiplies the number of iterations of each one.
+    """
+    for name, params, fn in _benchmarks(scale):
+        if name_filter in name:
+            yield _result(name, params, _measure(fn, repeat))
+
+
+def _result_key(res: Result) -> str:
+    return res['name'] + json.dumps(res['params'], sort_keys=True)
+
+
+def load_results(path: str) -> List[Result]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(base: List[Result], current: List[Result], threshold: float = 0.1) -> List[Result]:
+    """
+    Returns the current results whose ops_per_sec dropped more than threshold
+    relative to the matching base result, with the ratio current / base added.
+    """
+    base_by_key = {_result_key(r): r for r in base}
+
+    regressions = []
+    for res in current:
+        old = base_by_key.get(_result_key(res))
+        if old is None:
+            continue
+        ratio = res['ops_per_sec'] / old['ops_per_sec']
+        if ratio < 1 - threshold:
+            regressions.append(dict(res, ratio=ratio))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m mcproxy.bench',
+        description='Microbenchmarks of the parser, builder and shared pointer, as JSON lines.',
+    )
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of the iterations of each benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, the fastest is reported')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--output', default=None, help='also write the results to this file')
+    parser.add_argument('--compare', default=None, help='results of a previous run to check for regressions')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative drop of ops_per_sec reported as a regression by --compare',
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    for res in run(args.scale, args.repeat, args.filter):
+        results.append(res)
+        print(json.dumps(res, sort_keys=True), flush=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for res in results:
+                f.write(json.dumps(res, sort_keys=True) + '\n')
+
+    if args.compare:
+        regressions = compare(load_results(args.compare), results, args.threshold)
+        for res in regressions:
+            print(f'REGRESSION {_result_key(res)}: {res["ratio"]:.2f}x of base', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
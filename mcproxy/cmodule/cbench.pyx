@@ -0,0 +1,314 @@
+from time import perf_counter
+
+from cutil cimport alloc_object, free_object
+from cutil cimport RefCounter, SharedPtr, make_shared, ptr_clone, ptr_get, ptr_free
+from cparser cimport Parser, ParserCmd, ParserRecord, new_parser, parser_free
+from cparser cimport parser_handle, parser_get_cmd, parser_handle_batch, parser_record_free, parser_last_error
+from cbuilder cimport Builder, BuilderSegment, WriteStatus, MGetCmd, MSetCmd
+from cbuilder cimport new_builder, new_builder_writev_nogil, builder_free
+from cbuilder cimport builder_add_mget, builder_add_mset, builder_finish
+from ccodec cimport Serializer
+from chotkeys cimport HotKeys
+from clatency cimport Histogram
+
+
+DEF MAX_RECORDS = 64
+
+
+# Each benchmark runs its loop without the GIL, the same way the client runs these
+# hot paths, and returns (elapsed seconds, operations, bytes).
+
+
+# ===================================
+# Parser
+# ===================================
+
+def parser_stream(bytes data, int fragment, int rounds):
+    # data is fed fragment bytes at a time, like reads of a socket returning partial responses
+    cdef Parser *p = new_parser()
+    cdef const char *ptr = data
+    cdef int n = len(data)
+    cdef int off
+    cdef int m
+    cdef int ret = 0
+    cdef int r
+    cdef long count = 0
+    cdef ParserCmd cmd
+
+    if fragment <= 0 or fragment > n:
+        fragment = n
+
+    start = perf_counter()
+    with nogil:
+        for r in range(rounds):
+            off = 0
+            while off < n and ret == 0:
+                m = n - off
+                if m > fragment:
+                    m = fragment
+
+                ret = parser_handle(p, ptr + off, m)
+                while ret == 0:
+                    cmd = parser_get_cmd(p, &ret)
+                    if cmd == ParserCmd.P_NO_CMD:
+                        break
+                    count += 1
+                off += m
+    elapsed = perf_counter() - start
+
+    try:
+        if ret:
+            raise ValueError((<bytes>parser_last_error(p)).decode())
+    finally:
+        parser_free(p)
+
+    return elapsed, count, <long>n * rounds
+
+
+def parser_batch(bytes data, int fragment, int rounds):
+    cdef Parser *p = new_parser()
+    cdef ParserRecord records[MAX_RECORDS]
+    cdef const char *ptr = data
+    cdef int n = len(data)
+    cdef int off
+    cdef int end
+    cdef int consumed
+    cdef int num = 0
+    cdef int i
+    cdef int r
+    cdef long count = 0
+
+    if fragment <= 0 or fragment > n:
+        fragment = n
+
+    start = perf_counter()
+    with nogil:
+        for r in range(rounds):
+            off = 0
+            while off < n:
+                end = off + fragment
+                if end > n:
+                    end = n
+
+                while off < end:
+                    num = parser_handle_batch(p, ptr + off, end - off, records, MAX_RECORDS, &consumed)
+                    if num < 0:
+                        break
+                    for i in range(num):
+                        parser_record_free(&records[i])
+                    count += num
+                    off += consumed
+
+                if num < 0:
+                    break
+            if num < 0:
+                break
+    elapsed = perf_counter() - start
+
+    try:
+        if num < 0:
+            raise ValueError((<bytes>parser_last_error(p)).decode())
+    finally:
+        parser_free(p)
+
+    return elapsed, count, <long>n * rounds
+
+
+# ===================================
+# Builder
+# ===================================
+
+cdef struct NullWriter:
+    long written
+
+
+cdef int null_write_func(void *obj, const char *data, int n) noexcept:
+    (<NullWriter *>obj).written += n
+    return n
+
+
+cdef Py_ssize_t null_writev_func(void *obj, const BuilderSegment *segs, int n) noexcept nogil:
+    cdef Py_ssize_t total = 0
+    cdef int i
+    for i in range(n):
+        total += segs[i].len
+    (<NullWriter *>obj).written += total
+    return total
+
+
+cdef Builder *bench_builder(NullWriter *w, int limit, bint writev) noexcept nogil:
+    if writev:
+        return new_builder_writev_nogil(w, null_writev_func, limit)
+    return new_builder(w, null_write_func, limit)
+
+
+cdef WriteStatus builder_drain(Builder *b) noexcept nogil:
+    cdef WriteStatus status
+    while True:
+        status = builder_finish(b)
+        if status == WriteStatus.WS_NOOP or status == WriteStatus.WS_ERROR:
+            return status
+
+
+def builder_mget(int ops, bytes key, int limit, bint writev = False):
+    cdef NullWriter w = NullWriter(written=0)
+    cdef Builder *b = bench_builder(&w, limit, writev)
+    cdef MGetCmd cmd = MGetCmd(key=key, key_len=len(key), N=0, flags=0, opaque=NULL, opaque_len=0)
+    cdef int i
+
+    start = perf_counter()
+    with nogil:
+        for i in range(ops):
+            builder_add_mget(b, cmd)
+        builder_drain(b)
+    elapsed = perf_counter() - start
+
+    builder_free(b)
+    return elapsed, ops, w.written
+
+
+def builder_mset(int ops, bytes key, bytes value, int limit, bint writev = False):
+    cdef NullWriter w = NullWriter(written=0)
+    cdef Builder *b = bench_builder(&w, limit, writev)
+    cdef MSetCmd cmd = MSetCmd(
+        key=key, key_len=len(key), data=value, data_len=len(value),
+        cas=0, ttl=0, client_flags=0, flags=0, opaque=NULL, opaque_len=0,
+    )
+    cdef int i
+
+    start = perf_counter()
+    with nogil:
+        for i in range(ops):
+            builder_add_mset(b, cmd)
+        builder_drain(b)
+    elapsed = perf_counter() - start
+
+    builder_free(b)
+    return elapsed, ops, w.written
+
+
+# ===================================
+# Shared Pointer
+# ===================================
+
+cdef struct BenchObj:
+    RefCounter ref
+    long value
+
+
+cdef void bench_obj_destroy(void *obj) noexcept nogil:
+    pass
+
+
+cdef void bench_obj_free(void *obj) noexcept nogil:
+    free_object(obj, sizeof(BenchObj))
+
+
+def ptr_clone_free(long ops):
+    cdef BenchObj *obj = <BenchObj *>alloc_object(sizeof(BenchObj))
+    cdef SharedPtr ptr
+    cdef SharedPtr other
+    cdef long i
+
+    obj.value = 0
+    make_shared(&ptr, obj, &obj.ref, bench_obj_destroy, bench_obj_free)
+
+    start = perf_counter()
+    with nogil:
+        for i in range(ops):
+            ptr_clone(&other, &ptr)
+            (<BenchObj *>ptr_get(&other)).value += 1
+            ptr_free(&other)
+    elapsed = perf_counter() - start
+
+    ptr_free(&ptr)
+    return elapsed, ops, 0
+
+
+# ===================================
+# Allocator
+# ===================================
+
+DEF ALLOC_BATCH = 16
+
+
+def alloc_free(long ops, size_t size):
+    # batches of blocks allocated then freed, like the parsers and builders of short-lived clients
+    cdef void *blocks[ALLOC_BATCH]
+    cdef long i
+    cdef int j
+
+    start = perf_counter()
+    with nogil:
+        for i in range(0, ops, ALLOC_BATCH):
+            for j in range(ALLOC_BATCH):
+                blocks[j] = alloc_object(size)
+                (<char *>blocks[j])[0] = 1
+            for j in range(ALLOC_BATCH):
+                free_object(blocks[j], size)
+    elapsed = perf_counter() - start
+
+    return elapsed, (ops + ALLOC_BATCH - 1) // ALLOC_BATCH * ALLOC_BATCH, 0
+
+
+# ===================================
+# Serializer
+# ===================================
+
+def serializer_round_trip(object value, long ops, object fallback = None):
+    # unlike the other benchmarks the loop holds the GIL, as the conversions of the client do
+    cdef Serializer s = Serializer(fallback)
+    cdef unsigned int client_flags
+    cdef size_t nbytes = 0
+    cdef bytes data
+    cdef long i
+
+    start = perf_counter()
+    for i in range(ops):
+        client_flags = 0
+        data = bytes(s.encode(value, &client_flags))
+        s.decode(data, client_flags)
+        nbytes += len(data)
+    elapsed = perf_counter() - start
+
+    return elapsed, ops, nbytes
+
+
+# ===================================
+# Hot Keys
+# ===================================
+
+def hot_keys_sample(long ops, unsigned int sample_rate, int num_keys):
+    # the per request cost of the sampler in the client, which holds the GIL,
+    # over num_keys keys with a skewed popularity
+    cdef HotKeys h = HotKeys(32, sample_rate)
+    cdef list keys = [b'bench:key:%08d' % (i * i % num_keys) for i in range(num_keys)]
+    cdef bytes key
+    cdef long i
+
+    start = perf_counter()
+    for i in range(ops):
+        key = keys[i % num_keys]
+        if h.should_sample():
+            h.record(key, len(key), 100)
+    elapsed = perf_counter() - start
+
+    return elapsed, ops, 0
+
+
+# ===================================
+# Latency Histograms
+# ===================================
+
+def histogram_record(long ops):
+    # the per record cost of a latency histogram, over durations from 1us to about 1ms
+    cdef Histogram h = Histogram()
+    cdef long i
+
+    start = perf_counter()
+    with nogil:
+        for i in range(ops):
+            h.record((i & 1023) * 1e-6 + 1e-6)
+    elapsed = perf_counter() - start
+
+    return elapsed, ops, 0
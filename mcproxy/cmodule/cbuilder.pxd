@@ -4,14 +4,49 @@ cdef struct Builder
 ctypedef int (*write_func)(void *obj, const char *data, int n) noexcept
 
 
+cdef struct BuilderSegment:
+    const char *data # non owning pointer
+    Py_ssize_t len
+
+
+ctypedef Py_ssize_t (*writev_func)(void *obj, const BuilderSegment *segs, int n) noexcept
+
+ctypedef Py_ssize_t (*writev_nogil_func)(void *obj, const BuilderSegment *segs, int n) noexcept nogil
+
+
+cdef enum:
+    # values of at least this size are referenced in place by a writev builder
+    BUILDER_MIN_REF_LEN = 1024
+
+
 cdef Builder *new_builder(void *write_obj, write_func write_fn, int limit) noexcept nogil
 
+# The returned builder does not copy mset values of at least BUILDER_MIN_REF_LEN bytes,
+# the caller must keep them alive until builder_finish returns WS_NOOP.
+cdef Builder *new_builder_writev(void *write_obj, writev_func writev_fn, int limit) noexcept nogil
+
+# Same as new_builder_writev, but writev_fn is called without acquiring the GIL.
+cdef Builder *new_builder_writev_nogil(void *write_obj, writev_nogil_func writev_fn, int limit) noexcept nogil
+
+
+cdef enum MetaRequestFlag:
+    MR_CAS = 1 # c: return the cas value
+    MR_TTL = 2 # t: return the remaining ttl
+    MR_CLIENT_FLAGS = 4 # f: return the client flags
+    MR_KEY = 8 # k: return the key
+    MR_INVALIDATE = 16 # I: mset and mdel only, invalidate mode
+
 
 cdef struct MGetCmd:
     const char *key # non owning pointer
     int key_len
     int N
 
+    int flags # MetaRequestFlag bits
+
+    const char *opaque # non owning pointer, may be NULL
+    int opaque_len
+
 
 cdef struct MSetCmd:
     const char *key # non owning pointer
@@ -21,12 +56,21 @@ cdef struct MSetCmd:
     int data_len
 
     size_t cas
+    int ttl # 0 for no expiration
+    unsigned int client_flags
+
+    int flags # MetaRequestFlag bits
+
+    const char *opaque # non owning pointer, may be NULL
+    int opaque_len
 
 
 cdef struct MDelCmd:
     const char *key # non owning pointer
     int key_len
 
+    int flags # MetaRequestFlag bits, only MR_INVALIDATE
+
 
 cdef enum WriteStatus:
     WS_NOOP = 0
@@ -41,6 +85,58 @@ cdef WriteStatus builder_add_mset(Builder *b, MSetCmd cmd) noexcept nogil
 
 cdef WriteStatus builder_add_mdel(Builder *b, MDelCmd cmd) noexcept nogil
 
+cdef WriteStatus builder_add_version(Builder *b) noexcept nogil
+
 cdef WriteStatus builder_finish(Builder *b) noexcept nogil
 
-cdef void builder_free(Builder *b) noexcept nogil
\ No newline at end of file
+
+cdef struct BuilderStats:
+    size_t bytes_written
+    size_t flushes # calls of the write function
+    size_t partial_writes # calls writing only part of the data
+    size_t full_stalls # calls not writing anything, returned as WS_FULL
+    size_t write_errors
+
+cdef const BuilderStats *builder_get_stats(Builder *b) noexcept nogil
+
+cdef size_t builder_mem_size() noexcept nogil
+
+cdef dict builder_stats_dict(const BuilderStats *s)
+
+cdef void builder_free(Builder *b) noexcept nogil
+
+
+cdef enum:
+    BUILDER_MIN_LIMIT = 512
+    # writev builders reference the values of msets, their limit can exceed the buffer size
+    BUILDER_MAX_REF_LIMIT = 65536
+
+cdef int builder_get_write_limit(Builder *b) noexcept nogil
+
+# limit is clamped to the range supported by the builder
+cdef void builder_set_write_limit(Builder *b, int limit) noexcept nogil
+
+
+# ===================================
+# Auto Cork
+# ===================================
+
+# Adaptive write coalescing of a connection shared by many callers,
+# a batch is what is written by one flush of the connection.
+cdef struct AutoCork:
+    double max_delay # seconds, the longest a flush is delayed to wait for other callers
+    double batch_bytes # moving average of the bytes of a batch
+    double callers # moving average of the callers contributing to a batch
+    double rtt # moving average of the seconds from the flush of a batch to its last response
+    size_t batches
+    size_t corked # flushes that were delayed
+
+cdef void autocork_init(AutoCork *c, double max_delay) noexcept nogil
+
+# Records a finished batch, then adapts the write limit of b to the batch sizes.
+cdef void autocork_record(AutoCork *c, Builder *b, Py_ssize_t nbytes, int callers, double rtt) noexcept nogil
+
+# Seconds to wait before flushing so that more callers join the batch, 0 to flush now.
+cdef double autocork_delay(AutoCork *c) noexcept nogil
+
+cdef dict autocork_stats_dict(const AutoCork *c, Builder *b)
\ No newline at end of file
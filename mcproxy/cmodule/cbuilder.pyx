@@ -1,11 +1,12 @@
-from libc.string cimport memcpy, memmove
+from libc.string cimport memcpy, memmove, memset
 
 import cython
 
-from cutil cimport alloc_object, free_object
+from cutil cimport MemOwner, alloc_owned, free_owned
 
 
 DEF MAX_DATA = 4096
+DEF MAX_SEGMENTS = 64
 
 
 cdef struct Builder:
@@ -19,9 +20,23 @@ cdef struct Builder:
     const char *current_set_data
     int current_set_len
 
+    # scatter gather mode, only used when writev_fn is not NULL
+    writev_func writev_fn
+    writev_nogil_func writev_nogil_fn
+    BuilderSegment segs[MAX_SEGMENTS]
+    int seg_len
+    int seg_index # first segment not completely written
+    int seg_buf_start # start of the bytes in buf not yet added to segs
+    Py_ssize_t ref_len # bytes of the referenced values not yet written
+
+    BuilderStats stats
+
 
 cdef Builder *new_builder(void *write_obj, write_func write_fn, int limit) noexcept nogil:
-    cdef Builder *b = <Builder *>alloc_object(sizeof(Builder))
+    cdef Builder *b = <Builder *>alloc_owned(sizeof(Builder), MemOwner.MEM_BUILDER)
+
+    if limit > MAX_DATA:
+        limit = MAX_DATA
 
     b.buf_len = 0
     b.write_limit = limit
@@ -29,11 +44,45 @@ cdef Builder *new_builder(void *write_obj, write_func write_fn, int limit) noexc
     b.write_obj = write_obj
     b.write_fn = write_fn
 
+    b.writev_fn = NULL
+    b.writev_nogil_fn = NULL
+    builder_reset_segments(b)
+
+    memset(&b.stats, 0, sizeof(BuilderStats))
+
+    return b
+
+
+cdef Builder *new_builder_writev(void *write_obj, writev_func writev_fn, int limit) noexcept nogil:
+    cdef Builder *b = new_builder(write_obj, NULL, limit)
+    b.writev_fn = writev_fn
+    return b
+
+
+cdef Builder *new_builder_writev_nogil(void *write_obj, writev_nogil_func writev_fn, int limit) noexcept nogil:
+    cdef Builder *b = new_builder(write_obj, NULL, limit)
+    b.writev_nogil_fn = writev_fn
     return b
 
 
+cdef bint builder_is_writev(Builder *b) noexcept nogil:
+    return b.writev_fn != NULL or b.writev_nogil_fn != NULL
+
+
 cdef void builder_free(Builder *b) noexcept nogil:
-    free_object(b, sizeof(Builder))
+    free_owned(b, sizeof(Builder), MemOwner.MEM_BUILDER)
+
+
+cdef void builder_count_write(Builder *b, Py_ssize_t requested, Py_ssize_t n) noexcept nogil:
+    b.stats.flushes += 1
+    if n < 0:
+        b.stats.write_errors += 1
+    elif n == 0:
+        b.stats.full_stalls += 1
+    else:
+        b.stats.bytes_written += n
+        if n < requested:
+            b.stats.partial_writes += 1
 
 
 cdef void builder_append(Builder *b, const char *data, int n) noexcept nogil:
@@ -68,10 +117,10 @@ cdef void builder_append_num(Builder *b, size_t num) noexcept nogil:
 
 cdef WriteStatus builder_internal_do_flush(Builder *b) noexcept nogil:
     cdef int n = builder_flush(b)
+    if n < 0:
+        return WriteStatus.WS_ERROR
     if n == 0:
         return WriteStatus.WS_FULL
-    
-    # TODO Check Error
 
     memmove(b.buf, b.buf + n, b.buf_len - n)
     b.buf_len -= n
@@ -79,9 +128,128 @@ cdef WriteStatus builder_internal_do_flush(Builder *b) noexcept nogil:
 
 
 cdef WriteStatus builder_write_if_full(Builder *b) noexcept nogil:
-    if b.buf_len > b.write_limit:
-        return builder_internal_do_flush(b)
-    return WriteStatus.WS_NOOP
+    if builder_is_writev(b):
+        if (
+            b.buf_len + b.ref_len > b.write_limit or b.buf_len > MAX_DATA
+            or b.seg_len >= MAX_SEGMENTS - 2
+        ):
+            return builder_writev_flush_all(b)
+        return WriteStatus.WS_NOOP
+
+    return builder_flush_to_limit(b)
+
+
+cdef WriteStatus builder_flush_to_limit(Builder *b) noexcept nogil:
+    # the write limit may have been lowered below the buffered bytes, they are written
+    # in write_limit chunks until the rest fits within the limit
+    cdef WriteStatus st = WriteStatus.WS_NOOP
+
+    while b.buf_len > b.write_limit:
+        st = builder_internal_do_flush(b)
+        if st != WriteStatus.WS_FLUSHED:
+            return st
+    return st
+
+
+# ===================================
+# Scatter Gather Writes
+# ===================================
+
+cdef void builder_reset_segments(Builder *b) noexcept nogil:
+    b.seg_len = 0
+    b.seg_index = 0
+    b.seg_buf_start = 0
+    b.ref_len = 0
+
+
+cdef void builder_add_segment(Builder *b, const char *data, Py_ssize_t n) noexcept nogil:
+    cdef BuilderSegment *seg = &b.segs[b.seg_len]
+    seg.data = data
+    seg.len = n
+    b.seg_len += 1
+
+
+cdef void builder_close_buf_segment(Builder *b) noexcept nogil:
+    if b.buf_len > b.seg_buf_start:
+        builder_add_segment(b, b.buf + b.seg_buf_start, b.buf_len - b.seg_buf_start)
+        b.seg_buf_start = b.buf_len
+
+
+cdef void builder_consume_segments(Builder *b, Py_ssize_t n) noexcept nogil:
+    cdef BuilderSegment *seg
+
+    while n > 0:
+        seg = &b.segs[b.seg_index]
+        if n < seg.len:
+            seg.data += n
+            seg.len -= n
+            return
+
+        n -= seg.len
+        b.seg_index += 1
+
+
+cdef WriteStatus builder_writev_flush(Builder *b) noexcept nogil:
+    cdef Py_ssize_t n
+    cdef Py_ssize_t requested = 0
+    cdef int i
+
+    builder_close_buf_segment(b)
+
+    if b.seg_index >= b.seg_len:
+        b.buf_len = 0
+        builder_reset_segments(b)
+        return WriteStatus.WS_NOOP
+
+    if b.writev_nogil_fn != NULL:
+        n = b.writev_nogil_fn(b.write_obj, b.segs + b.seg_index, b.seg_len - b.seg_index)
+    else:
+        with gil:
+            n = b.writev_fn(b.write_obj, b.segs + b.seg_index, b.seg_len - b.seg_index)
+
+    for i in range(b.seg_index, b.seg_len):
+        requested += b.segs[i].len
+    builder_count_write(b, requested, n)
+
+    if n < 0:
+        return WriteStatus.WS_ERROR
+    if n == 0:
+        return WriteStatus.WS_FULL
+
+    builder_consume_segments(b, n)
+
+    if b.seg_index >= b.seg_len:
+        # everything is written, buf can be reused from the start
+        b.buf_len = 0
+        builder_reset_segments(b)
+
+    return WriteStatus.WS_FLUSHED
+
+
+cdef WriteStatus builder_writev_flush_all(Builder *b) noexcept nogil:
+    cdef WriteStatus st = WriteStatus.WS_NOOP
+
+    while b.seg_index < b.seg_len or b.buf_len > b.seg_buf_start:
+        st = builder_writev_flush(b)
+        if st != WriteStatus.WS_FLUSHED:
+            return st
+
+    return st
+
+
+cdef void builder_append_meta(Builder *b, int flags, const char *opaque, int opaque_len) noexcept nogil:
+    if flags & MetaRequestFlag.MR_CAS:
+        builder_append(b, ' c', 2)
+    if flags & MetaRequestFlag.MR_TTL:
+        builder_append(b, ' t', 2)
+    if flags & MetaRequestFlag.MR_CLIENT_FLAGS:
+        builder_append(b, ' f', 2)
+    if flags & MetaRequestFlag.MR_KEY:
+        builder_append(b, ' k', 2)
+
+    if opaque_len > 0:
+        builder_append(b, ' O', 2)
+        builder_append(b, opaque, opaque_len)
 
 
 cdef WriteStatus builder_add_mget(Builder *b, MGetCmd cmd) noexcept nogil:
@@ -92,6 +260,8 @@ cdef WriteStatus builder_add_mget(Builder *b, MGetCmd cmd) noexcept nogil:
         builder_append(b, ' N', 2)
         builder_append_num(b, cmd.N)
 
+    builder_append_meta(b, cmd.flags, cmd.opaque, cmd.opaque_len)
+
     builder_append(b, ' v\r\n', 4)
 
     return builder_write_if_full(b)
@@ -108,6 +278,8 @@ cdef WriteStatus builder_write_set_data(Builder *b) noexcept nogil:
         flushed = False
 
         remaining = b.write_limit - b.buf_len
+        if remaining < 0:
+            remaining = 0
         if n > remaining:
             flushed = True
             n = remaining
@@ -119,6 +291,8 @@ cdef WriteStatus builder_write_set_data(Builder *b) noexcept nogil:
 
         if flushed:
             st = builder_internal_do_flush(b)
+            if st != WriteStatus.WS_FLUSHED:
+                return st
     
     builder_append(b, '\r\n', 2)
     
@@ -136,22 +310,57 @@ cdef WriteStatus builder_add_mset(Builder *b, MSetCmd cmd) noexcept nogil:
         builder_append(b, ' C', 2)
         builder_append_num(b, cmd.cas)
 
+    if cmd.ttl > 0:
+        builder_append(b, ' T', 2)
+        builder_append_num(b, cmd.ttl)
+
+    if cmd.client_flags > 0:
+        builder_append(b, ' F', 2)
+        builder_append_num(b, cmd.client_flags)
+
+    if cmd.flags & MetaRequestFlag.MR_INVALIDATE:
+        builder_append(b, ' I', 2)
+
+    builder_append_meta(b, cmd.flags & ~(MetaRequestFlag.MR_TTL | MetaRequestFlag.MR_CLIENT_FLAGS), cmd.opaque, cmd.opaque_len)
 
     builder_append(b, '\r\n', 2)
 
+    if builder_is_writev(b):
+        return builder_writev_set_data(b, cmd.data, cmd.data_len)
+
     b.current_set_data = cmd.data
     b.current_set_len = cmd.data_len
 
     return builder_write_set_data(b)
 
 
+cdef WriteStatus builder_writev_set_data(Builder *b, const char *data, int n) noexcept nogil:
+    if n >= BUILDER_MIN_REF_LEN:
+        builder_close_buf_segment(b)
+        builder_add_segment(b, data, n)
+        b.ref_len += n
+    else:
+        builder_append(b, data, n)
+
+    builder_append(b, '\r\n', 2)
+    return builder_write_if_full(b)
+
+
 cdef WriteStatus builder_add_mdel(Builder *b, MDelCmd cmd) noexcept nogil:
     builder_append(b, 'md ', 3)
     builder_append(b, cmd.key, cmd.key_len)
+    if cmd.flags & MetaRequestFlag.MR_INVALIDATE:
+        # the item is marked stale instead of being removed
+        builder_append(b, ' I', 2)
     builder_append(b, '\r\n', 2)
     return builder_write_if_full(b)
 
 
+cdef WriteStatus builder_add_version(Builder *b) noexcept nogil:
+    builder_append(b, 'version\r\n', 9)
+    return builder_write_if_full(b)
+
+
 cdef int builder_flush(Builder *b) noexcept nogil:
     cdef int ret
     cdef int n = b.buf_len
@@ -161,15 +370,117 @@ cdef int builder_flush(Builder *b) noexcept nogil:
 
     with gil:
         ret = b.write_fn(b.write_obj, b.buf, n)
+    builder_count_write(b, n, ret)
     return ret
 
 
 cdef WriteStatus builder_finish(Builder *b) noexcept nogil:
+    if builder_is_writev(b):
+        return builder_writev_flush(b)
+
     if b.buf_len > 0:
         return builder_internal_do_flush(b)
     return WriteStatus.WS_NOOP
 
 
+cdef const BuilderStats *builder_get_stats(Builder *b) noexcept nogil:
+    return &b.stats
+
+
+cdef size_t builder_mem_size() noexcept nogil:
+    return sizeof(Builder)
+
+
+cdef int builder_get_write_limit(Builder *b) noexcept nogil:
+    return b.write_limit
+
+
+cdef void builder_set_write_limit(Builder *b, int limit) noexcept nogil:
+    # the copied data must fit in buf, only referenced values can go past MAX_DATA
+    cdef int max_limit = BUILDER_MAX_REF_LIMIT if builder_is_writev(b) else MAX_DATA
+
+    if limit < BUILDER_MIN_LIMIT:
+        limit = BUILDER_MIN_LIMIT
+    if limit > max_limit:
+        limit = max_limit
+    b.write_limit = limit
+
+
+cdef dict builder_stats_dict(const BuilderStats *s):
+    return {
+        'bytes_written': s.bytes_written,
+        'flushes': s.flushes,
+        'partial_writes': s.partial_writes,
+        'full_stalls': s.full_stalls,
+        'write_errors': s.write_errors,
+    }
+
+
+# ===================================
+# Auto Cork
+# ===================================
+
+DEF CORK_AVG_WEIGHT = 0.125 # weight of a new sample in the moving averages
+DEF CORK_MIN_CALLERS = 1.5 # average callers per batch above which flushes are delayed
+DEF CORK_RTT_FRACTION = 0.25 # a flush is delayed at most this fraction of the round trip
+
+
+cdef void autocork_init(AutoCork *c, double max_delay) noexcept nogil:
+    c.max_delay = max_delay
+    c.batch_bytes = 0
+    c.callers = 0
+    c.rtt = 0
+    c.batches = 0
+    c.corked = 0
+
+
+cdef double moving_average(double avg, double sample, size_t count) noexcept nogil:
+    if count == 0:
+        return sample
+    return avg + CORK_AVG_WEIGHT * (sample - avg)
+
+
+cdef void autocork_record(AutoCork *c, Builder *b, Py_ssize_t nbytes, int callers, double rtt) noexcept nogil:
+    if nbytes <= 0:
+        return
+
+    c.batch_bytes = moving_average(c.batch_bytes, nbytes, c.batches)
+    c.callers = moving_average(c.callers, callers, c.batches)
+    c.rtt = moving_average(c.rtt, rtt, c.batches)
+    c.batches += 1
+
+    # a typical batch is written at once instead of in write_limit chunks,
+    # the 2x headroom absorbs the variation between batches
+    builder_set_write_limit(b, <int>(2 * c.batch_bytes))
+
+
+cdef double autocork_delay(AutoCork *c) noexcept nogil:
+    # a single caller at a time gains nothing from waiting, and waiting
+    # longer than a fraction of the round trip costs more than the saved writes
+    cdef double delay
+
+    if c.max_delay <= 0 or c.callers < CORK_MIN_CALLERS:
+        return 0
+
+    delay = c.rtt * CORK_RTT_FRACTION
+    if delay > c.max_delay:
+        delay = c.max_delay
+    if delay > 0:
+        c.corked += 1
+    return delay
+
+
+cdef dict autocork_stats_dict(const AutoCork *c, Builder *b):
+    return {
+        'write_limit': b.write_limit,
+        'batches': c.batches,
+        'corked': c.corked,
+        'avg_batch_bytes': c.batch_bytes,
+        'avg_callers': c.callers,
+        'avg_rtt_us': c.rtt * 1e6,
+    }
+
+
 cdef int python_write_func(void *obj, const char *data, int n) noexcept:
     cdef object fn
     cdef bytes b
@@ -179,40 +490,96 @@ cdef int python_write_func(void *obj, const char *data, int n) noexcept:
     return fn(b)
 
 
+cdef Py_ssize_t python_writev_func(void *obj, const BuilderSegment *segs, int n) noexcept:
+    cdef object fn
+    cdef list segments = []
+    cdef int i
+
+    fn = <object>obj
+    for i in range(n):
+        segments.append(segs[i].data[:segs[i].len])
+    return fn(segments)
+
+
 cdef class BuilderTest:
     cdef Builder *b
     cdef object write_obj
+    cdef list refs
+    cdef AutoCork cork
 
-    def __cinit__(self, object write_fn, int limit):
+    def __cinit__(self, object write_fn, int limit, bint writev = False):
         self.write_obj = write_fn
-        self.b = new_builder(<void *>write_fn, python_write_func, limit)
+        self.refs = []
+        if writev:
+            self.b = new_builder_writev(<void *>write_fn, python_writev_func, limit)
+        else:
+            self.b = new_builder(<void *>write_fn, python_write_func, limit)
 
     def __dealloc__(self):
         builder_free(self.b)
     
-    def add_mget(self, bytes key, int N = 0):
+    def add_mget(self, bytes key, int N = 0, int flags = 0, bytes opaque = b''):
         cdef const char *ptr = key
         cdef int key_len = len(key)
 
-        cdef MGetCmd cmd = MGetCmd(key=ptr, key_len=key_len, N=N)
+        cdef MGetCmd cmd = MGetCmd(
+            key=ptr, key_len=key_len, N=N,
+            flags=flags, opaque=opaque, opaque_len=len(opaque),
+        )
         return builder_add_mget(self.b, cmd)
 
-    def add_mset(self, bytes key, bytes data, size_t cas = 0):
+    def add_mset(
+        self, bytes key, bytes data, size_t cas = 0,
+        int ttl = 0, unsigned int client_flags = 0, int flags = 0, bytes opaque = b'',
+    ):
         cdef const char *ptr = key
         cdef int key_len = len(key)
 
         cdef const char *data_ptr = data
         cdef int data_len = len(data)
 
-        cdef MSetCmd cmd = MSetCmd(key=ptr, key_len=key_len, data=data_ptr, data_len=data_len, cas=cas)
+        cdef MSetCmd cmd = MSetCmd(
+            key=ptr, key_len=key_len, data=data_ptr, data_len=data_len, cas=cas,
+            ttl=ttl, client_flags=client_flags, flags=flags, opaque=opaque, opaque_len=len(opaque),
+        )
+        self.refs.append(data)
         return builder_add_mset(self.b, cmd)
     
-    def add_delete(self, bytes key):
+    def add_delete(self, bytes key, bint invalidate = False):
         cdef const char *ptr = key
         cdef int key_len = len(key)
 
-        cdef MDelCmd cmd = MDelCmd(key=ptr, key_len=key_len)
+        cdef MDelCmd cmd = MDelCmd(
+            key=ptr, key_len=key_len, flags=MetaRequestFlag.MR_INVALIDATE if invalidate else 0,
+        )
         return builder_add_mdel(self.b, cmd)
+
+    def add_version(self):
+        return builder_add_version(self.b)
     
     def finish(self):
-        return builder_finish(self.b)
+        cdef WriteStatus st = builder_finish(self.b)
+        if st == WriteStatus.WS_NOOP:
+            self.refs = []
+        return st
+
+    def stats(self):
+        return builder_stats_dict(builder_get_stats(self.b))
+
+    def get_write_limit(self):
+        return builder_get_write_limit(self.b)
+
+    def set_write_limit(self, int limit):
+        builder_set_write_limit(self.b, limit)
+
+    def init_autocork(self, double max_delay):
+        autocork_init(&self.cork, max_delay)
+
+    def autocork_record(self, Py_ssize_t nbytes, int callers, double rtt):
+        autocork_record(&self.cork, self.b, nbytes, callers, rtt)
+
+    def autocork_delay(self):
+        return autocork_delay(&self.cork)
+
+    def autocork_stats(self):
+        return autocork_stats_dict(&self.cork, self.b)
@@ -0,0 +1,30 @@
+from csketch cimport CountMinSketch
+
+
+cdef class CacheEntry:
+    cdef char *data # owning
+    cdef int size
+    cdef unsigned int client_flags
+    cdef double expire
+
+
+cdef class NearCache:
+    cdef object entries # OrderedDict of key to CacheEntry, least recently used first
+    cdef size_t max_bytes
+    cdef size_t used_bytes
+    cdef double max_ttl
+    cdef object clock
+    cdef CountMinSketch sketch
+
+    cdef size_t hits
+    cdef size_t misses
+    cdef size_t evictions
+    cdef size_t rejections
+
+    cdef object lookup(self, bytes key, unsigned int *client_flags = *)
+
+    cdef void store(self, bytes key, bytes value, int ttl, unsigned int client_flags = *) except *
+
+    cdef void invalidate(self, bytes key) except *
+
+    cdef void remove(self, bytes key, CacheEntry e) except *
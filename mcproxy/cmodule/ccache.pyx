@@ -0,0 +1,153 @@
+from libc.string cimport memcpy
+from libc.stdint cimport uint64_t
+
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+
+from cutil cimport MemOwner, alloc_owned, free_owned
+from csketch cimport sketch_init, sketch_free, sketch_add, sketch_estimate
+
+from collections import OrderedDict
+import time
+
+
+cdef class CacheEntry:
+    def __dealloc__(self):
+        if self.data != NULL:
+            free_owned(self.data, self.size, MemOwner.MEM_CACHE)
+
+
+cdef CacheEntry new_entry(bytes value, unsigned int client_flags, double expire):
+    cdef CacheEntry e = CacheEntry()
+    e.size = len(value)
+    e.client_flags = client_flags
+    e.data = <char *>alloc_owned(e.size, MemOwner.MEM_CACHE)
+    memcpy(e.data, PyBytes_AS_STRING(value), e.size)
+    e.expire = expire
+    return e
+
+
+cdef class NearCache:
+    """
+    An in-process cache of values in front of a client.
+
+    max_bytes bounds the total size of the cached values, which are kept in
+    memory allocated with alloc_owned. An entry expires after the ttl returned
+    by the server, capped at max_ttl seconds.
+
+    Eviction is LRU with TinyLFU admission: a new key replaces the least
+    recently used entry only if it was requested more often, as estimated by
+    a count-min sketch of recent lookups, so that a scan can not flush hot keys.
+    """
+
+    def __cinit__(
+        self, size_t max_bytes, double max_ttl = 10,
+        size_t expected_entries = 10000, object clock = time.monotonic,
+    ):
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.max_ttl = max_ttl
+        self.clock = clock
+        sketch_init(&self.sketch, expected_entries)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    def __dealloc__(self):
+        sketch_free(&self.sketch)
+
+    cdef object lookup(self, bytes key, unsigned int *client_flags = NULL):
+        cdef CacheEntry e
+
+        sketch_add(&self.sketch, <uint64_t>hash(key))
+
+        e = self.entries.get(key)
+        if e is None:
+            self.misses += 1
+            return None
+
+        if e.expire <= self.clock():
+            self.remove(key, e)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        if client_flags != NULL:
+            client_flags[0] = e.client_flags
+        return PyBytes_FromStringAndSize(e.data, e.size)
+
+    cdef void store(self, bytes key, bytes value, int ttl, unsigned int client_flags = 0) except *:
+        # ttl is the remaining ttl from the server, -1 if the key does not expire,
+        # client_flags are the type of the value for a Serializer
+        cdef double now
+        cdef double cache_ttl = self.max_ttl
+        cdef size_t size = len(value)
+        cdef CacheEntry e
+        cdef int freq
+        cdef bytes victim_key
+
+        if 0 <= ttl < cache_ttl:
+            cache_ttl = ttl
+        if cache_ttl <= 0 or size > self.max_bytes:
+            return
+
+        e = self.entries.get(key)
+        if e is not None:
+            self.remove(key, e)
+
+        now = self.clock()
+
+        # the key is admitted against the first victim before any entry is evicted
+        if self.used_bytes + size > self.max_bytes:
+            victim_key = next(iter(self.entries))
+            e = self.entries[victim_key]
+            freq = sketch_estimate(&self.sketch, <uint64_t>hash(key))
+            if e.expire > now and freq <= sketch_estimate(&self.sketch, <uint64_t>hash(victim_key)):
+                self.rejections += 1
+                return
+
+        while self.used_bytes + size > self.max_bytes:
+            victim_key = next(iter(self.entries))
+            self.remove(victim_key, self.entries[victim_key])
+            self.evictions += 1
+
+        self.entries[key] = new_entry(value, client_flags, now + cache_ttl)
+        self.used_bytes += size
+
+    cdef void invalidate(self, bytes key) except *:
+        cdef CacheEntry e = self.entries.get(key)
+        if e is not None:
+            self.remove(key, e)
+
+    cdef void remove(self, bytes key, CacheEntry e) except *:
+        self.entries.pop(key, None)
+        self.used_bytes -= e.size
+
+    def get(self, bytes key):
+        return self.lookup(key)
+
+    def put(self, bytes key, bytes value, int ttl = -1):
+        self.store(key, value, ttl)
+
+    def delete(self, bytes key):
+        self.invalidate(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.used_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'rejections': self.rejections,
+        }
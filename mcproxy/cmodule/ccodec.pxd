@@ -0,0 +1,34 @@
+cdef class Compressor:
+    cdef size_t threshold
+    cdef int level
+    cdef unsigned int flag
+    cdef object codec # None for zlib
+
+    cdef size_t compressed
+    cdef size_t skipped
+    cdef size_t decompressed
+    cdef size_t bytes_before
+    cdef size_t bytes_after
+
+    cdef object compress_buf(self, const char *data, Py_ssize_t n)
+
+    cdef bytes decompress_value(self, bytes value)
+
+    cdef object encode(self, object value, unsigned int *client_flags)
+
+    cdef bint is_compressed(self, unsigned int client_flags) noexcept
+
+
+cdef enum:
+    CODEC_TYPE_MASK = 0x33 # the client flags bits of the Serializer type tags
+
+
+cdef class Serializer:
+    cdef object serializer # None for pickle
+
+    cdef size_t native
+    cdef size_t serialized
+
+    cdef object encode(self, object value, unsigned int *client_flags)
+
+    cdef object decode(self, bytes data, unsigned int client_flags)
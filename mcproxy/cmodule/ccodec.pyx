@@ -0,0 +1,344 @@
+# distutils: libraries = z
+
+from libc.stdint cimport uint32_t
+from libc.string cimport memcpy
+
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyObject_CheckBuffer, PyBUF_SIMPLE
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython.long cimport PyLong_AsLongLongAndOverflow
+from cpython.conversion cimport PyOS_string_to_double, PyOS_double_to_string, Py_DTSF_ADD_DOT_0
+from cpython.mem cimport PyMem_Free
+
+from cutil cimport MemOwner, alloc_owned, free_owned
+
+import pickle
+
+
+cdef extern from "zlib.h" nogil:
+    ctypedef unsigned char Bytef
+    ctypedef unsigned long uLong
+    ctypedef unsigned long uLongf
+
+    enum:
+        Z_OK
+        Z_DEFAULT_COMPRESSION
+
+    uLong compressBound(uLong source_len)
+    int compress2(Bytef *dest, uLongf *dest_len, const Bytef *source, uLong source_len, int level)
+    int uncompress(Bytef *dest, uLongf *dest_len, const Bytef *source, uLong source_len)
+
+
+# A zlib value starts with the length of the uncompressed value, 4 bytes little endian,
+# so that it is decompressed at once into a buffer of the right size.
+DEF HEADER_LEN = 4
+DEF MAX_VALUE_LEN = 1 << 30
+
+# The client flags bit marking compressed values. Because of the header, other memcached
+# clients can not decompress these values, so the bit is one they do not use for theirs.
+COMPRESSED_FLAG = 1 << 16
+
+
+cdef void put_header(char *dest, uint32_t n) noexcept nogil:
+    cdef int i
+    for i in range(HEADER_LEN):
+        dest[i] = <char>((n >> (8 * i)) & 0xff)
+
+
+cdef uint32_t get_header(const char *data) noexcept nogil:
+    cdef uint32_t n = 0
+    cdef int i
+    for i in range(HEADER_LEN):
+        n |= (<uint32_t>(<unsigned char>data[i])) << (8 * i)
+    return n
+
+
+cdef class Compressor:
+    """
+    Compresses the values of at least threshold bytes on set and marks them
+    with the flag bit of their client flags, values with the bit set are
+    decompressed on get. A value whose compressed form is not smaller is
+    stored unchanged.
+
+    By default values are compressed with zlib at level, without the GIL.
+    codec replaces zlib, it must have compress and decompress methods taking
+    and returning bytes, called with the GIL.
+    """
+
+    def __cinit__(
+        self, size_t threshold = 1024, int level = Z_DEFAULT_COMPRESSION,
+        unsigned int flag = COMPRESSED_FLAG, object codec = None,
+    ):
+        if not -1 <= level <= 9:
+            raise ValueError('level must be between -1 and 9')
+        if flag == 0 or flag & (flag - 1) != 0:
+            raise ValueError('flag must be a single bit')
+
+        self.threshold = threshold
+        self.level = level
+        self.flag = flag
+        self.codec = codec
+
+        self.compressed = 0
+        self.skipped = 0
+        self.decompressed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    cdef object compress_buf(self, const char *data, Py_ssize_t n):
+        # returns the compressed bytes, None if they are not smaller than data
+        cdef object out
+        cdef char *buf
+        cdef size_t cap
+        cdef uLongf out_len
+        cdef int ret
+
+        if self.codec is not None:
+            out = self.codec.compress(PyBytes_FromStringAndSize(data, n))
+            if len(out) >= n:
+                return None
+            return out
+
+        if n > MAX_VALUE_LEN:
+            return None
+
+        cap = HEADER_LEN + compressBound(n)
+        buf = <char *>alloc_owned(cap, MemOwner.MEM_OTHER)
+        with nogil:
+            put_header(buf, <uint32_t>n)
+            out_len = cap - HEADER_LEN
+            ret = compress2(<Bytef *>buf + HEADER_LEN, &out_len, <const Bytef *>data, n, self.level)
+
+        out = None
+        if ret == Z_OK and HEADER_LEN + <Py_ssize_t>out_len < n:
+            out = PyBytes_FromStringAndSize(buf, HEADER_LEN + out_len)
+        free_owned(buf, cap, MemOwner.MEM_OTHER)
+        return out
+
+    cdef bytes decompress_value(self, bytes value):
+        cdef const char *data = PyBytes_AS_STRING(value)
+        cdef Py_ssize_t n = len(value)
+        cdef uint32_t value_len
+        cdef bytes out
+        cdef char *dest
+        cdef uLongf out_len
+        cdef int ret
+
+        self.decompressed += 1
+
+        if self.codec is not None:
+            return self.codec.decompress(value)
+
+        if n < HEADER_LEN:
+            raise ValueError('compressed value is too short')
+        value_len = get_header(data)
+        if value_len > MAX_VALUE_LEN:
+            raise ValueError('compressed value is too long')
+
+        out = PyBytes_FromStringAndSize(NULL, value_len)
+        dest = PyBytes_AS_STRING(out)
+        out_len = value_len
+        with nogil:
+            ret = uncompress(<Bytef *>dest, &out_len, <const Bytef *>data + HEADER_LEN, n - HEADER_LEN)
+        if ret != Z_OK or out_len != value_len:
+            raise ValueError(f'invalid compressed value: {ret}')
+        return out
+
+    cdef object encode(self, object value, unsigned int *client_flags):
+        # returns the value to send, compressed with the flag added to client_flags when worth it
+        cdef Py_buffer buf
+        cdef object out
+
+        if client_flags[0] & self.flag:
+            raise ValueError('client_flags must not have the compression flag')
+
+        PyObject_GetBuffer(value, &buf, PyBUF_SIMPLE)
+        try:
+            if <size_t>buf.len < self.threshold:
+                return value
+            out = self.compress_buf(<const char *>buf.buf, buf.len)
+            if out is None:
+                self.skipped += 1
+                return value
+
+            self.compressed += 1
+            self.bytes_before += buf.len
+            self.bytes_after += len(out)
+            client_flags[0] |= self.flag
+            return out
+        finally:
+            PyBuffer_Release(&buf)
+
+    cdef bint is_compressed(self, unsigned int client_flags) noexcept:
+        return client_flags & self.flag != 0
+
+    def compress(self, object value):
+        """Returns (data, client_flags) as they would be sent by a set of value."""
+        cdef unsigned int client_flags = 0
+        return self.encode(value, &client_flags), client_flags
+
+    def decompress(self, bytes data, unsigned int client_flags):
+        """Returns the value of the data and client_flags of a get."""
+        if self.is_compressed(client_flags):
+            return self.decompress_value(data)
+        return data
+
+    def stats(self):
+        return {
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'decompressed': self.decompressed,
+            'bytes_before': self.bytes_before,
+            'bytes_after': self.bytes_after,
+        }
+
+
+# ===================================
+# Serializer
+# ===================================
+
+# The type of a value is tagged in its client flags, with the same bits
+# as other memcached clients for bytes, pickled values, int and str.
+TYPE_BYTES = 0
+TYPE_SERIALIZED = 1 << 0
+TYPE_INT = 1 << 1
+TYPE_STR = 1 << 4
+TYPE_FLOAT = 1 << 5
+
+TYPE_MASK = CODEC_TYPE_MASK # TYPE_SERIALIZED | TYPE_INT | TYPE_STR | TYPE_FLOAT
+
+DEF MAX_INT_DIGITS = 18 # decimal digits always fitting in a long long
+
+
+cdef bytes encode_int(object value):
+    cdef char buf[24]
+    cdef char *end = buf + sizeof(buf)
+    cdef char *p = end
+    cdef int overflow = 0
+    cdef long long v = PyLong_AsLongLongAndOverflow(value, &overflow)
+    cdef unsigned long long u
+
+    if overflow != 0:
+        return str(value).encode()
+
+    u = 0ULL - <unsigned long long>v if v < 0 else <unsigned long long>v
+    while True:
+        p -= 1
+        p[0] = <char>(48 + u % 10)
+        u //= 10
+        if u == 0:
+            break
+    if v < 0:
+        p -= 1
+        p[0] = 45 # '-'
+    return PyBytes_FromStringAndSize(p, end - p)
+
+
+cdef object decode_int(bytes data):
+    cdef const char *p = PyBytes_AS_STRING(data)
+    cdef Py_ssize_t n = len(data)
+    cdef Py_ssize_t i = 0
+    cdef long long v = 0
+    cdef bint negative = False
+
+    if n > 0 and p[0] == 45: # '-'
+        negative = True
+        i = 1
+    if n == i or n - i > MAX_INT_DIGITS:
+        return int(data)
+
+    while i < n:
+        if not 48 <= p[i] <= 57:
+            raise ValueError(f'invalid int value: {data!r}')
+        v = v * 10 + (p[i] - 48)
+        i += 1
+    return -v if negative else v
+
+
+cdef bytes encode_float(double value):
+    cdef char *s = PyOS_double_to_string(value, b'r', 0, Py_DTSF_ADD_DOT_0, NULL)
+    try:
+        return <bytes>s
+    finally:
+        PyMem_Free(s)
+
+
+cdef class Serializer:
+    """
+    Converts the values of sets to bytes and the values of gets back,
+    tagging their type in the client flags. bytes, any other buffer,
+    str, int and float are converted natively, other values are passed
+    to the dumps and loads functions of serializer, pickle by default.
+    The json and orjson modules can be used as serializer.
+    """
+
+    def __cinit__(self, object serializer = None):
+        self.serializer = serializer
+        self.native = 0
+        self.serialized = 0
+
+    cdef object encode(self, object value, unsigned int *client_flags):
+        cdef type t = type(value)
+        cdef object data
+
+        if client_flags[0] & CODEC_TYPE_MASK:
+            raise ValueError('client_flags must not have the type bits')
+
+        if t is bytes:
+            self.native += 1
+            return value
+        if t is str:
+            self.native += 1
+            client_flags[0] |= TYPE_STR
+            return (<str>value).encode('utf-8')
+        if t is int:
+            self.native += 1
+            client_flags[0] |= TYPE_INT
+            return encode_int(value)
+        if t is float:
+            self.native += 1
+            client_flags[0] |= TYPE_FLOAT
+            return encode_float(value)
+        if PyObject_CheckBuffer(value):
+            self.native += 1
+            return value
+
+        self.serialized += 1
+        client_flags[0] |= TYPE_SERIALIZED
+        if self.serializer is None:
+            return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        data = self.serializer.dumps(value)
+        if type(data) is str:
+            return (<str>data).encode('utf-8')
+        return data
+
+    cdef object decode(self, bytes data, unsigned int client_flags):
+        cdef unsigned int tag = client_flags & CODEC_TYPE_MASK
+
+        if tag == TYPE_BYTES:
+            return data
+        if tag == TYPE_STR:
+            return data.decode('utf-8')
+        if tag == TYPE_INT:
+            return decode_int(data)
+        if tag == TYPE_FLOAT:
+            return PyOS_string_to_double(PyBytes_AS_STRING(data), NULL, NULL)
+        if tag == TYPE_SERIALIZED:
+            if self.serializer is None:
+                return pickle.loads(data)
+            return self.serializer.loads(data)
+        raise ValueError(f'unknown value type in client flags: {client_flags}')
+
+    def dumps(self, object value):
+        """Returns (data, client_flags) as they would be sent by a set of value."""
+        cdef unsigned int client_flags = 0
+        return self.encode(value, &client_flags), client_flags
+
+    def loads(self, bytes data, unsigned int client_flags):
+        """Returns the value of the data and client_flags of a get."""
+        return self.decode(data, client_flags)
+
+    def stats(self):
+        return {
+            'native': self.native,
+            'serialized': self.serialized,
+        }
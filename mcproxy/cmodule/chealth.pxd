@@ -0,0 +1,36 @@
+cdef enum BreakerState:
+    BS_CLOSED = 0 # requests are sent to the node
+    BS_OPEN = 1 # the node is ejected, requests fail fast or go to another node
+    BS_HALF_OPEN = 2 # a probe of the ejected node is in flight
+
+
+cdef class CircuitBreaker:
+    cdef int max_errors
+    cdef double max_latency # 0 disables the latency ejection
+    cdef double eject_time
+    cdef double max_eject_time
+    cdef object clock
+
+    cdef BreakerState state
+    cdef int errors # consecutive errors
+    cdef double latency # moving average of the response times, in seconds
+    cdef int samples # response times in the average, up to BREAKER_MIN_SAMPLES
+    cdef double backoff # ejection time of the current ejection
+    cdef double retry_at # when the ejected node is probed next
+    cdef str reason # why the node was last ejected
+
+    cdef size_t ejections
+    cdef size_t probes
+    cdef size_t recoveries
+
+    cdef bint allow(self) noexcept
+
+    cdef void record_success(self, double latency) except *
+
+    cdef void record_error(self) except *
+
+    cdef void eject(self, str reason) except *
+
+    cdef bint start_probe(self) except *
+
+    cdef void end_probe(self, bint ok) except *
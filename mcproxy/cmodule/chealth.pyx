@@ -0,0 +1,142 @@
+import time
+
+
+DEF BREAKER_MIN_SAMPLES = 8 # response times needed before the latency can eject a node
+DEF BREAKER_ALPHA = 0.125 # weight of a new response time in the moving average
+
+
+cdef str state_name(BreakerState state):
+    if state == BreakerState.BS_CLOSED:
+        return 'closed'
+    if state == BreakerState.BS_OPEN:
+        return 'open'
+    return 'half_open'
+
+
+cdef class CircuitBreaker:
+    """
+    The health of one node: the node is ejected after max_errors consecutive errors,
+    or when the moving average of its response times exceeds max_latency seconds.
+
+    An ejected node is probed again after eject_time seconds, the time doubles
+    after every failed probe up to max_eject_time. A successful probe closes
+    the breaker. Probes are made by the owner of the breaker, usually a background
+    health check, the requests are never sent to a node that is not closed.
+    """
+
+    def __cinit__(
+        self, int max_errors = 3, double max_latency = 0, double eject_time = 1.0,
+        double max_eject_time = 30.0, object clock = time.monotonic,
+    ):
+        if max_errors <= 0:
+            raise ValueError('max_errors must be positive')
+        if max_latency < 0 or eject_time < 0:
+            raise ValueError('max_latency and eject_time must not be negative')
+        if max_eject_time < eject_time:
+            raise ValueError('max_eject_time must not be less than eject_time')
+
+        self.max_errors = max_errors
+        self.max_latency = max_latency
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.clock = clock
+
+        self.state = BreakerState.BS_CLOSED
+        self.errors = 0
+        self.latency = 0
+        self.samples = 0
+        self.backoff = eject_time
+        self.retry_at = 0
+        self.reason = None
+
+        self.ejections = 0
+        self.probes = 0
+        self.recoveries = 0
+
+    cdef bint allow(self) noexcept:
+        return self.state == BreakerState.BS_CLOSED
+
+    cdef void record_success(self, double latency) except *:
+        # the responses of an ejected node still in flight do not close it
+        if self.state != BreakerState.BS_CLOSED:
+            return
+
+        self.errors = 0
+        if self.samples < BREAKER_MIN_SAMPLES:
+            self.samples += 1
+            self.latency += (latency - self.latency) / self.samples
+            return
+
+        self.latency += (latency - self.latency) * BREAKER_ALPHA
+        if self.max_latency > 0 and self.latency > self.max_latency:
+            self.eject('latency')
+
+    cdef void record_error(self) except *:
+        if self.state != BreakerState.BS_CLOSED:
+            return
+
+        self.errors += 1
+        if self.errors >= self.max_errors:
+            self.eject('errors')
+
+    cdef void eject(self, str reason) except *:
+        if self.state == BreakerState.BS_CLOSED:
+            self.backoff = self.eject_time
+        self.state = BreakerState.BS_OPEN
+        self.reason = reason
+        self.retry_at = self.clock() + self.backoff
+        self.errors = 0
+        self.latency = 0
+        self.samples = 0
+        self.ejections += 1
+
+    cdef bint start_probe(self) except *:
+        # returns True if the ejected node is due for a probe, the breaker is half open until end_probe
+        if self.state != BreakerState.BS_OPEN or self.clock() < self.retry_at:
+            return False
+        self.state = BreakerState.BS_HALF_OPEN
+        self.probes += 1
+        return True
+
+    cdef void end_probe(self, bint ok) except *:
+        if self.state != BreakerState.BS_HALF_OPEN:
+            return
+        if ok:
+            self.state = BreakerState.BS_CLOSED
+            self.recoveries += 1
+            return
+
+        self.backoff = min(self.backoff * 2, self.max_eject_time)
+        self.state = BreakerState.BS_OPEN
+        self.retry_at = self.clock() + self.backoff
+
+    def clone(self):
+        """A closed breaker with the same settings, one is needed per node."""
+        return CircuitBreaker(self.max_errors, self.max_latency, self.eject_time, self.max_eject_time, self.clock)
+
+    def py_allow(self):
+        return self.allow()
+
+    def py_record_success(self, double latency):
+        self.record_success(latency)
+
+    def py_record_error(self):
+        self.record_error()
+
+    def py_start_probe(self):
+        return self.start_probe()
+
+    def py_end_probe(self, bint ok):
+        self.end_probe(ok)
+
+    def stats(self):
+        return {
+            'state': state_name(self.state),
+            'reason': self.reason,
+            'errors': self.errors,
+            'latency': self.latency,
+            'eject_time': self.backoff,
+            'ejections': self.ejections,
+            'probes': self.probes,
+            'recoveries': self.recoveries,
+        }
@@ -0,0 +1,36 @@
+from libc.stdint cimport uint64_t
+
+from csketch cimport CountMinSketch
+
+
+cdef class HotKey:
+    cdef readonly bytes key
+    cdef size_t count # sampled requests, halved every decay interval
+    cdef size_t nbytes # value bytes of the sampled requests, halved with count
+    cdef double since # when the key started to be tracked
+    cdef int index # position in the heap of HotKeys
+
+
+cdef class HotKeys:
+    cdef int k
+    cdef unsigned int sample_rate
+    cdef double decay_interval
+    cdef object clock
+    cdef CountMinSketch sketch
+    cdef dict entries # key bytes -> HotKey
+    cdef list heap # the HotKey entries, min heap by count
+    cdef uint64_t rng
+    cdef unsigned int skip # requests left before the next sampled one
+    cdef double window_start
+
+    cdef size_t sampled
+    cdef size_t admitted
+    cdef size_t rejected
+
+    cdef bint should_sample(self) noexcept
+
+    cdef void decay(self, double now) noexcept
+
+    cdef bytes record(self, const char *key, Py_ssize_t key_len, size_t nbytes)
+
+    cdef void add_bytes(self, bytes key, size_t nbytes) noexcept
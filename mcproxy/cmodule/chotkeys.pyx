@@ -0,0 +1,205 @@
+from libc.stdint cimport uint64_t
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+from csketch cimport sketch_init, sketch_free, sketch_add, sketch_estimate
+
+import time
+
+
+cdef class HotKey:
+    pass
+
+
+cdef inline void heap_swap(list heap, int i, int j) noexcept:
+    cdef HotKey a = heap[i]
+    cdef HotKey b = heap[j]
+    heap[i] = b
+    heap[j] = a
+    a.index = j
+    b.index = i
+
+
+cdef void heap_sift_up(list heap, int i) noexcept:
+    cdef int parent
+    while i > 0:
+        parent = (i - 1) // 2
+        if (<HotKey>heap[parent]).count <= (<HotKey>heap[i]).count:
+            return
+        heap_swap(heap, i, parent)
+        i = parent
+
+
+cdef void heap_sift_down(list heap, int i) noexcept:
+    cdef int n = len(heap)
+    cdef int child
+    while True:
+        child = 2 * i + 1
+        if child >= n:
+            return
+        if child + 1 < n and (<HotKey>heap[child + 1]).count < (<HotKey>heap[child]).count:
+            child += 1
+        if (<HotKey>heap[i]).count <= (<HotKey>heap[child]).count:
+            return
+        heap_swap(heap, i, child)
+        i = child
+
+
+cdef class HotKeys:
+    """
+    Finds the most requested keys from a sample of the requests of clients.
+
+    One request in sample_rate on average is sampled, at the cost of
+    a counter decrement for the others. The keys of the sampled requests
+    are counted by a count-min sketch, and the k keys with the most sampled
+    requests are tracked exactly in a min heap: a new key replaces the
+    least requested tracked key only if the sketch estimates it was requested
+    more often. The counts are halved every decay_interval seconds, so that
+    keys that cooled down leave the top.
+    """
+
+    def __cinit__(
+        self, int k = 32, unsigned int sample_rate = 100, double decay_interval = 60,
+        size_t expected_keys = 10000, object clock = time.monotonic, uint64_t seed = 0,
+    ):
+        if k <= 0 or sample_rate == 0 or decay_interval <= 0:
+            raise ValueError('k, sample_rate and decay_interval must be positive')
+
+        self.k = k
+        self.sample_rate = sample_rate
+        self.decay_interval = decay_interval
+        self.clock = clock
+        sketch_init(&self.sketch, expected_keys)
+        self.entries = {}
+        self.heap = []
+        self.rng = seed ^ 0x9e3779b97f4a7c15ULL
+        self.skip = 1
+        self.window_start = clock()
+
+        self.sampled = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def __dealloc__(self):
+        sketch_free(&self.sketch)
+
+    cdef bint should_sample(self) noexcept:
+        self.skip -= 1
+        if self.skip > 0:
+            return False
+
+        # the gap to the next sampled request is uniform in [1, 2 * sample_rate - 1]
+        self.rng ^= self.rng << 13
+        self.rng ^= self.rng >> 7
+        self.rng ^= self.rng << 17
+        self.skip = 1 + <unsigned int>(self.rng % (2 * <uint64_t>self.sample_rate - 1))
+        return True
+
+    cdef void decay(self, double now) noexcept:
+        cdef HotKey e
+
+        # halving keeps the heap order
+        while now - self.window_start >= self.decay_interval:
+            self.window_start += self.decay_interval
+            for e in self.heap:
+                e.count //= 2
+                e.nbytes //= 2
+
+    cdef bytes record(self, const char *key, Py_ssize_t key_len, size_t nbytes):
+        # counts a sampled request for key, returns the key as bytes
+        cdef bytes k = PyBytes_FromStringAndSize(key, key_len)
+        cdef uint64_t h = <uint64_t>hash(k)
+        cdef double now = self.clock()
+        cdef HotKey e
+        cdef HotKey victim
+
+        self.sampled += 1
+        self.decay(now)
+        sketch_add(&self.sketch, h)
+
+        e = self.entries.get(k)
+        if e is not None:
+            e.count += 1
+            e.nbytes += nbytes
+            heap_sift_down(self.heap, e.index)
+            return k
+
+        if len(self.heap) >= self.k:
+            victim = self.heap[0]
+            if sketch_estimate(&self.sketch, h) <= sketch_estimate(&self.sketch, <uint64_t>hash(victim.key)):
+                self.rejected += 1
+                return k
+            del self.entries[victim.key]
+
+        e = HotKey()
+        e.key = k
+        e.count = 1
+        e.nbytes = nbytes
+        e.since = now
+        self.entries[k] = e
+        self.admitted += 1
+
+        if len(self.heap) >= self.k:
+            # the new key takes the place of the victim at the root
+            e.index = 0
+            self.heap[0] = e
+            heap_sift_down(self.heap, 0)
+        else:
+            e.index = len(self.heap)
+            self.heap.append(e)
+            heap_sift_up(self.heap, e.index)
+        return k
+
+    cdef void add_bytes(self, bytes key, size_t nbytes) noexcept:
+        # adds the value bytes of a sampled get once its response is read
+        cdef HotKey e = self.entries.get(key)
+        if e is not None:
+            e.nbytes += nbytes
+
+    def sample(self, bytes key, size_t nbytes = 0):
+        """Counts a request for key if it is sampled, returns whether it was."""
+        if not self.should_sample():
+            return False
+        self.record(key, len(key), nbytes)
+        return True
+
+    def top(self, int n = 0):
+        """
+        The tracked keys, most requested first, at most n of them if n > 0,
+        as dicts with the key and its estimated requests and value bytes per second.
+        The rates are averaged over at least one second.
+        """
+        cdef double now = self.clock()
+        cdef list result = []
+        cdef HotKey e
+        cdef double span
+
+        self.decay(now)
+        for e in sorted(self.heap, key=lambda e: -(<HotKey>e).count):
+            # the halved counts of the past windows add up to about one interval
+            span = min(now - e.since, now - self.window_start + self.decay_interval)
+            span = max(1.0, span)
+            result.append({
+                'key': e.key,
+                'qps': e.count * self.sample_rate / span,
+                'bytes_per_sec': e.nbytes * self.sample_rate / span,
+            })
+            if len(result) == n:
+                break
+        return result
+
+    def clear(self):
+        self.entries.clear()
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def stats(self):
+        return {
+            'keys': len(self.heap),
+            'sample_rate': self.sample_rate,
+            'sampled': self.sampled,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
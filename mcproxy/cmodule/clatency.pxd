@@ -0,0 +1,40 @@
+from libc.stdint cimport uint64_t
+
+
+cdef enum:
+    HIST_SUB_BITS = 5 # 32 buckets per power of two, a value is within 3% of its bucket
+    HIST_BUCKETS = 1024 # values up to 2^36 ns, (36 - HIST_SUB_BITS + 1) << HIST_SUB_BITS
+
+
+# A log-linear histogram of durations, in the style of HdrHistogram,
+# its memory is fixed whatever the number of values recorded.
+cdef class Histogram:
+    cdef uint64_t counts[HIST_BUCKETS]
+    cdef uint64_t count
+    cdef uint64_t total_ns
+    cdef uint64_t min_ns
+    cdef uint64_t max_ns
+
+    cdef void record(self, double seconds) noexcept nogil
+
+    cdef double percentile(self, double p) noexcept nogil
+
+
+cdef class LatencyRecorder:
+    cdef readonly str name # the node of a ShardedClient, None otherwise
+    cdef double slow_threshold
+    cdef object on_slow # may be None
+
+    cdef readonly Histogram flush # writing the requests of a pipeline
+    cdef readonly Histogram first_byte # from the end of the flush to the first bytes of the responses
+    cdef readonly Histogram parse # parsing the responses and resolving the results
+    cdef readonly Histogram pipeline # from the flush to the last response
+    cdef readonly Histogram mg # from the flush to the response of every get
+    cdef readonly Histogram ms
+    cdef readonly Histogram md
+
+    cdef size_t slow
+
+    cdef dict record_pipeline(self, double flush, double first_byte, double parse, double total, int requests)
+
+    cdef void report_slow(self, dict info) except *
@@ -0,0 +1,197 @@
+from libc.stdint cimport uint64_t
+from libc.string cimport memset
+from libc.math cimport ceil, frexp
+
+
+DEF HIST_MAX_BITS = 36 # values up to 2^36 - 1 ns, about 68 seconds, larger ones are clamped
+
+
+cdef inline int bucket_index(uint64_t ns) noexcept nogil:
+    # the values below 2^HIST_SUB_BITS have a bucket each, the others share
+    # 2^HIST_SUB_BITS buckets per power of two
+    cdef int bits
+    cdef int shift
+
+    if ns < (1 << HIST_SUB_BITS):
+        return <int>ns
+    frexp(<double>ns, &bits)
+    shift = bits - 1 - HIST_SUB_BITS
+    return ((shift + 1) << HIST_SUB_BITS) + <int>((ns >> shift) & ((1 << HIST_SUB_BITS) - 1))
+
+
+cdef inline uint64_t bucket_max(int index) noexcept nogil:
+    # the largest value of the bucket
+    cdef int shift
+
+    if index < (1 << HIST_SUB_BITS):
+        return index
+    shift = (index >> HIST_SUB_BITS) - 1
+    return ((<uint64_t>((1 << HIST_SUB_BITS) + (index & ((1 << HIST_SUB_BITS) - 1))) + 1) << shift) - 1
+
+
+cdef class Histogram:
+    """
+    Durations in seconds, recorded in nanoseconds with a relative error of at most 3%.
+    The records are made under the GIL or the lock of a client, the histogram has no lock of its own.
+    """
+
+    def __cinit__(self):
+        self.clear()
+
+    cdef void record(self, double seconds) noexcept nogil:
+        cdef uint64_t max_ns = (<uint64_t>1 << HIST_MAX_BITS) - 1
+        cdef uint64_t ns = 0
+
+        if seconds > 0:
+            ns = <uint64_t>(seconds * 1e9) if seconds * 1e9 < max_ns else max_ns
+
+        self.counts[bucket_index(ns)] += 1
+        if self.count == 0 or ns < self.min_ns:
+            self.min_ns = ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.count += 1
+        self.total_ns += ns
+
+    cdef double percentile(self, double p) noexcept nogil:
+        # the largest value of the bucket of the nearest rank, bounded by the max
+        cdef uint64_t rank
+        cdef uint64_t seen = 0
+        cdef int i
+
+        if self.count == 0:
+            return 0
+        rank = <uint64_t>ceil(p * self.count)
+        if rank == 0:
+            rank = 1
+
+        for i in range(HIST_BUCKETS):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(bucket_max(i), self.max_ns) * 1e-9
+        return self.max_ns * 1e-9
+
+    def py_record(self, double seconds):
+        self.record(seconds)
+
+    def merge(self, Histogram other not None):
+        """Adds the values of other, to aggregate the histograms of several nodes."""
+        cdef int i
+
+        if other.count == 0:
+            return
+        for i in range(HIST_BUCKETS):
+            self.counts[i] += other.counts[i]
+        if self.count == 0 or other.min_ns < self.min_ns:
+            self.min_ns = other.min_ns
+        if other.max_ns > self.max_ns:
+            self.max_ns = other.max_ns
+        self.count += other.count
+        self.total_ns += other.total_ns
+
+    def clear(self):
+        memset(self.counts, 0, sizeof(self.counts))
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+
+    def __len__(self):
+        return self.count
+
+    def snapshot(self):
+        """The count and the distribution of the values, in seconds."""
+        return {
+            'count': self.count,
+            'min': self.min_ns * 1e-9,
+            'max': self.max_ns * 1e-9,
+            'mean': self.total_ns * 1e-9 / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+        }
+
+
+cdef class LatencyRecorder:
+    """
+    The latency histograms of the pipelines of a client: the time to flush
+    the requests, the time from the end of the flush to the first bytes
+    of the responses, the time parsing them and the whole pipeline,
+    and the time of every get, set and delete from the flush to its response.
+
+    on_slow is called with the durations of every pipeline of at least
+    slow_threshold seconds, from the thread executing it once the lock
+    of the connection is released, its errors are ignored.
+    """
+
+    def __cinit__(self, double slow_threshold = 0, object on_slow = None, str name = None):
+        if slow_threshold < 0:
+            raise ValueError('slow_threshold must not be negative')
+
+        self.name = name
+        self.slow_threshold = slow_threshold
+        self.on_slow = on_slow
+        self.flush = Histogram()
+        self.first_byte = Histogram()
+        self.parse = Histogram()
+        self.pipeline = Histogram()
+        self.mg = Histogram()
+        self.ms = Histogram()
+        self.md = Histogram()
+        self.slow = 0
+
+    cdef dict record_pipeline(self, double flush, double first_byte, double parse, double total, int requests):
+        # Returns the durations of a slow pipeline to pass to report_slow, None otherwise.
+        # first_byte is negative when the responses were already read with a previous pipeline.
+        self.flush.record(flush)
+        if first_byte >= 0:
+            self.first_byte.record(first_byte)
+        self.parse.record(parse)
+        self.pipeline.record(total)
+
+        if self.slow_threshold <= 0 or total < self.slow_threshold:
+            return None
+        self.slow += 1
+        if self.on_slow is None:
+            return None
+        return {
+            'node': self.name,
+            'seconds': total,
+            'flush': flush,
+            'first_byte': first_byte if first_byte >= 0 else None,
+            'parse': parse,
+            'requests': requests,
+        }
+
+    cdef void report_slow(self, dict info) except *:
+        # calls on_slow, the caller must not hold a lock it could wait for
+        try:
+            self.on_slow(info)
+        except Exception:
+            pass
+
+    def py_record_pipeline(self, double flush, double first_byte, double parse, double total, int requests):
+        cdef dict info = self.record_pipeline(flush, first_byte, parse, total, requests)
+        if info is not None:
+            self.report_slow(info)
+
+    def clone(self, str name = None):
+        """An empty recorder with the same settings, one is needed per node."""
+        return LatencyRecorder(self.slow_threshold, self.on_slow, name)
+
+    def clear(self):
+        for h in (self.flush, self.first_byte, self.parse, self.pipeline, self.mg, self.ms, self.md):
+            h.clear()
+        self.slow = 0
+
+    def snapshot(self):
+        """The distributions of the durations in seconds, cheap enough to be exported periodically."""
+        return {
+            'flush': self.flush.snapshot(),
+            'first_byte': self.first_byte.snapshot(),
+            'parse': self.parse.snapshot(),
+            'pipeline': self.pipeline.snapshot(),
+            'commands': {'mg': self.mg.snapshot(), 'ms': self.ms.snapshot(), 'md': self.md.snapshot()},
+            'slow': self.slow,
+        }
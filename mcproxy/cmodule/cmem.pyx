@@ -1,10 +1,44 @@
-from libc.string cimport memcpy
+from libc.string cimport memcpy, strerror
+from libc.errno cimport ETIMEDOUT
+from libc.math cimport ceil
 
-from cutil cimport alloc_object, free_object
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE, PyBUF_READ, PyBUF_WRITE
+from cpython.memoryview cimport PyMemoryView_FromMemory
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.pythread cimport PyThread_type_lock, PyThread_allocate_lock, PyThread_free_lock
+from cpython.pythread cimport PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK, NOWAIT_LOCK
+
+import select
+import socket
+from collections import deque
+
+from cutil cimport MemOwner, alloc_owned, free_owned, monotonic_now, sleep_seconds
 from cutil cimport RefCounter, SharedPtr, make_shared, ptr_free, ptr_get, ptr_clone
 from cpool cimport ObjectPool
-from cparser cimport Parser, new_parser, parser_free
-from cbuilder cimport Builder, new_builder, builder_free
+from cparser cimport Parser, ParserCmd, ParserRecord, ParserMetaFlag, new_parser, parser_free
+from cparser cimport parser_handle_batch, parser_record_data, parser_record_free, parser_last_error
+from cparser cimport parser_get_stats, parser_stats_dict, parser_mem_size
+from cbuilder cimport Builder, BuilderSegment, BUILDER_MIN_REF_LEN, builder_free
+from cbuilder cimport new_builder, new_builder_writev, new_builder_writev_nogil
+from cbuilder cimport builder_get_stats, builder_stats_dict, builder_mem_size
+from cbuilder cimport AutoCork, autocork_init, autocork_record, autocork_delay, autocork_stats_dict
+from cnet cimport FdConn, fd_conn_init, fd_conn_writev, fd_conn_recv
+from cring cimport HashRing
+from ccache cimport NearCache
+from ccodec cimport Compressor, Serializer, CODEC_TYPE_MASK
+from chotkeys cimport HotKeys
+from chealth cimport CircuitBreaker
+from clatency cimport LatencyRecorder
+from cbuilder cimport WriteStatus, MetaRequestFlag, MGetCmd, MSetCmd, MDelCmd
+from cbuilder cimport builder_add_mget, builder_add_mset, builder_add_mdel, builder_add_version, builder_finish
+
+
+DEF MAX_KEY_LEN = 250
+DEF READ_SIZE = 16384
+DEF MAX_RECORDS = 64
+DEF HEDGE_SAMPLES = 512 # response times kept by a hedge policy
+DEF HEDGE_MIN_SAMPLES = 16 # response times needed before any get is hedged
+DEF HEDGE_UPDATE_EVERY = 64 # response times recorded between two updates of the delay
 
 
 cdef ObjectPool client_pool = ObjectPool(1024)
@@ -18,8 +52,12 @@ cdef struct ClientPtr:
     SharedPtr __ptr
 
 
-cdef ClientData client_ptr_get(ClientPtr *ptr) noexcept:
-    return <ClientData>ptr_get(&ptr.__ptr)
+cdef ClientData client_ptr_get(ClientPtr *ptr):
+    cdef void *obj = ptr_get(&ptr.__ptr)
+    if obj == NULL:
+        # a misused pointer fails the caller instead of the process
+        raise ConnectionError('client pointer is invalid')
+    return <ClientData>obj
 
 
 cdef void client_ptr_destroy(void *obj) noexcept nogil:
@@ -30,8 +68,16 @@ cdef void client_ptr_free(void *obj) noexcept nogil:
     with gil:
         d = <ClientData>obj
 
+        d.error = ConnectionError('client is closed')
+        d.fail_pending(d.error)
+
         parser_free(d.parser)
         builder_free(d.builder)
+        free_owned(d.read_buf, READ_SIZE, MemOwner.MEM_CLIENT)
+        d.parser = NULL
+        d.builder = NULL
+        d.read_buf = NULL
+        d.read_view = None
 
         d.conn.close()
         client_pool.free(d.pool_index)
@@ -39,8 +85,118 @@ cdef void client_ptr_free(void *obj) noexcept nogil:
 
 cdef int client_write_func(void *obj, const char *data, int n) noexcept:
     cdef ClientData client_data = <ClientData>obj
-    cdef bytes b = data[:n]
-    return client_data.conn.write(b)
+    try:
+        return client_data.conn.send(PyMemoryView_FromMemory(<char *>data, n, PyBUF_READ))
+    except Exception as ex:
+        client_data.error = ex
+        return -1
+
+
+cdef Py_ssize_t client_writev_func(void *obj, const BuilderSegment *segs, int n) noexcept:
+    cdef ClientData client_data = <ClientData>obj
+    cdef list buffers = []
+    cdef int i
+
+    for i in range(n):
+        buffers.append(PyMemoryView_FromMemory(<char *>segs[i].data, segs[i].len, PyBUF_READ))
+
+    try:
+        return client_data.conn.sendmsg(buffers)
+    except Exception as ex:
+        client_data.error = ex
+        return -1
+
+
+cdef WriteStatus client_flush(Builder *b) noexcept nogil:
+    cdef WriteStatus st
+
+    while True:
+        st = builder_finish(b)
+        if st != WriteStatus.WS_FLUSHED:
+            return st
+
+
+cdef int timeout_to_ms(object timeout) except? -2:
+    if timeout is None:
+        return -1
+    return <int>(timeout * 1000)
+
+
+cdef inline void record_command(LatencyRecorder latency, Result r, double seconds) noexcept:
+    if type(r) is GetResult:
+        latency.mg.record(seconds)
+    elif type(r) is SetResult:
+        latency.ms.record(seconds)
+    elif type(r) is DeleteResult:
+        latency.md.record(seconds)
+
+
+cdef class InflightGets:
+    """
+    The gets waiting for a response by key and request flags,
+    so that concurrent gets of the same key share a single request.
+    """
+    cdef dict keys # key bytes -> {request flags: GetResult}
+
+    def __cinit__(self):
+        self.keys = {}
+
+    cdef GetResult find(self, const Py_buffer *key, int flags):
+        cdef dict entry
+
+        if len(self.keys) == 0:
+            return None
+
+        entry = self.keys.get(PyBytes_FromStringAndSize(<const char *>key.buf, key.len))
+        if entry is None:
+            return None
+        return entry.get(flags)
+
+    cdef void add(self, const Py_buffer *key, int flags, GetResult r) except *:
+        cdef bytes k = PyBytes_FromStringAndSize(<const char *>key.buf, key.len)
+        cdef dict entry = self.keys.get(k)
+
+        if entry is None:
+            entry = {}
+            self.keys[k] = entry
+        entry[flags] = r
+        r.inflight_key = k
+        r.inflight_flags = flags
+
+    cdef void remove(self, Result r) except *:
+        cdef GetResult g
+        cdef dict entry
+
+        if type(r) is not GetResult:
+            return
+        g = <GetResult>r
+        if g.inflight_key is None:
+            return
+
+        entry = self.keys.get(g.inflight_key)
+        if entry is not None and entry.get(g.inflight_flags) is g:
+            del entry[g.inflight_flags]
+            if len(entry) == 0:
+                del self.keys[g.inflight_key]
+        g.inflight_key = None
+
+    cdef void forget(self, const Py_buffer *key) except *:
+        # called before a write of the key, later gets must not share earlier requests
+        # and the values of earlier requests must not be stored in the near cache
+        cdef dict entry
+        cdef GetResult r
+
+        if len(self.keys) == 0:
+            return
+
+        entry = self.keys.pop(PyBytes_FromStringAndSize(<const char *>key.buf, key.len), None)
+        if entry is None:
+            return
+        for r in entry.values():
+            r.cache_key = None
+
+    cdef void clear(self) noexcept:
+        self.keys.clear()
 
 
 cdef class ClientData:
@@ -48,38 +204,1876 @@ cdef class ClientData:
     cdef RefCounter ref
     cdef int pool_index
 
+    # builder, parser and the read state are only used while holding lock
+    cdef PyThread_type_lock lock
+
     cdef Parser *parser
     cdef Builder *builder
 
-    def __cinit__(self, object conn):
+    # when fd_conn.fd >= 0, socket io and parsing are done without the GIL
+    cdef FdConn fd_conn
+
+    cdef list write_refs # values referenced by the builder, kept alive until flushed
+    cdef list pending # results waiting for a response, in request order
+    cdef InflightGets inflight
+    cdef NearCache cache # may be None
+    cdef Compressor compressor # may be None
+    cdef Serializer serializer # may be None
+    cdef HotKeys hot_keys # may be None
+    cdef CircuitBreaker breaker # set by a ShardedClient with health checks, may be None
+    cdef int read_index # number of results of the current execute already resolved
+
+    cdef char *read_buf # owning
+    cdef object read_view # writable memoryview of read_buf
+    cdef int read_len
+    cdef int read_offset # bytes of read_buf already handled by the parser
+    cdef ParserRecord records[MAX_RECORDS]
+
+    cdef size_t bytes_read
+    cdef size_t reads
+
+    # auto cork state, only used when cork.max_delay > 0
+    cdef AutoCork cork
+    cdef Py_ssize_t batch_source # address of the last pipeline adding to the batch
+    cdef int batch_callers
+    cdef int batch_contended # callers that waited for the lock during the batch
+    cdef size_t batch_written # bytes_written of the builder when the batch started
+
+    # timing of the pipeline being executed, only used when latency is set
+    cdef LatencyRecorder latency
+    cdef double timing_start # when its first flush started, 0 outside of a pipeline
+    cdef double timing_flush
+    cdef double timing_flushed # when its last flush ended
+    cdef double timing_first_byte # -1 until a read returns data
+    cdef double timing_parse
+    cdef int timing_requests
+    cdef list timing_slow # slow pipelines to report once the lock is released
+
+    cdef object error
+
+    def __cinit__(
+        self, object conn, bint use_fd = False, NearCache cache = None,
+        Compressor compressor = None, Serializer serializer = None, int autocork_us = 0,
+        HotKeys hot_keys = None, LatencyRecorder latency = None,
+    ):
         self.conn = conn
+        self.cache = cache
+        self.compressor = compressor
+        self.serializer = serializer
+        self.hot_keys = hot_keys
+        self.breaker = None
         self.pool_index = client_pool.put(self)
+        self.lock = PyThread_allocate_lock()
         self.parser = new_parser()
-        self.builder = new_builder(<void *>self, client_write_func, 4096)
-    
+
+        fd_conn_init(&self.fd_conn, -1, -1)
+        if use_fd:
+            fd_conn_init(&self.fd_conn, conn.fileno(), timeout_to_ms(conn.gettimeout()))
+            self.builder = new_builder_writev_nogil(<void *>&self.fd_conn, fd_conn_writev, 4096)
+        elif hasattr(conn, 'sendmsg'):
+            self.builder = new_builder_writev(<void *>self, client_writev_func, 4096)
+        else:
+            self.builder = new_builder(<void *>self, client_write_func, 4096)
+
+        self.write_refs = []
+        self.pending = []
+        self.inflight = InflightGets()
+        self.read_index = 0
+
+        self.read_buf = <char *>alloc_owned(READ_SIZE, MemOwner.MEM_CLIENT)
+        self.read_view = PyMemoryView_FromMemory(self.read_buf, READ_SIZE, PyBUF_WRITE)
+        self.read_len = 0
+        self.read_offset = 0
+
+        self.bytes_read = 0
+        self.reads = 0
+
+        autocork_init(&self.cork, autocork_us * 1e-6)
+        self.batch_source = 0
+        self.batch_callers = 0
+        self.batch_contended = 0
+        self.batch_written = 0
+
+        self.latency = latency
+        self.timing_start = 0
+        self.timing_slow = []
+
+        self.error = None
+
+    def __dealloc__(self):
+        if self.lock != NULL:
+            PyThread_free_lock(self.lock)
+
+    cdef void acquire(self) noexcept:
+        if PyThread_acquire_lock(self.lock, NOWAIT_LOCK):
+            return
+        self.batch_contended += 1
+        with nogil:
+            PyThread_acquire_lock(self.lock, WAIT_LOCK)
+
+    cdef bint try_acquire(self) noexcept:
+        return PyThread_acquire_lock(self.lock, NOWAIT_LOCK)
+
+    cdef void release(self) noexcept:
+        PyThread_release_lock(self.lock)
+
+    cdef list release_slow(self):
+        # releases the lock and returns the slow pipelines recorded while it was held,
+        # on_slow is called with them by report_slow once no lock is held
+        cdef list slow = self.timing_slow
+        if len(slow) > 0:
+            self.timing_slow = []
+        PyThread_release_lock(self.lock)
+        return slow
+
+    cdef void report_slow(self, list slow) except *:
+        for info in slow:
+            self.latency.report_slow(info)
+
+    cdef bint use_fd(self) noexcept nogil:
+        return self.fd_conn.fd >= 0
+
+    cdef object fd_error(self):
+        if self.fd_conn.err == ETIMEDOUT:
+            return socket.timeout('timed out')
+        return OSError(self.fd_conn.err, strerror(self.fd_conn.err).decode())
+
+    cdef GetResult cache_get(self, bytes key):
+        # returns a resolved result on a near cache hit, None otherwise
+        cdef GetResult r
+        cdef unsigned int client_flags = 0
+        cdef object value = self.cache.lookup(key, &client_flags)
+
+        if value is None:
+            return None
+        r = GetResult(self)
+        r.done = True
+        if self.serializer is not None:
+            value = self.serializer.decode(value, client_flags)
+        r.value = value
+        return r
+
+    cdef void cache_invalidate(self, const Py_buffer *key) except *:
+        if self.cache is not None:
+            self.cache.invalidate(PyBytes_FromStringAndSize(<const char *>key.buf, key.len))
 
     cdef void get_ptr(self, ClientPtr *ptr) noexcept nogil:
         make_shared(&ptr.__ptr, <void *>self, &self.ref, client_ptr_destroy, client_ptr_free)
 
+    cdef void check_error(self) except *:
+        if self.error is not None:
+            raise self.error
+
+    cdef void fail(self, object ex) except *:
+        if self.error is None:
+            self.error = ex
+        self.fail_pending(self.error)
+        raise self.error
+
+    cdef void fail_pending(self, object ex) noexcept:
+        cdef Result r
+        for r in self.pending:
+            # a get already resolved by its hedge keeps its value
+            if r.done:
+                continue
+            r.error = ex
+            r.done = True
+        self.pending = []
+        self.inflight.clear()
+        self.timing_start = 0
+
+    cdef void add_pending(self, Result r, WriteStatus st, object source) except *:
+        # source is the pipeline adding r, the callers of a batch are its distinct pipelines
+        if <Py_ssize_t><void *>source != self.batch_source:
+            self.batch_source = <Py_ssize_t><void *>source
+            self.batch_callers += 1
+
+        self.pending.append(r)
+        if st == WriteStatus.WS_FULL:
+            self.fail(ConnectionError('connection is not writable'))
+        elif st == WriteStatus.WS_ERROR:
+            self.fail_write()
+
+    cdef GetResult hedge_get(self, bytes key, int flags, GetResult target):
+        # adds a copy of the get of target to the builder, the lock must be held,
+        # the caller adds the returned result to the pending results
+        cdef GetResult r = GetResult(self)
+        cdef WriteStatus st
+        cdef MGetCmd cmd = MGetCmd(
+            key=<const char *>key, key_len=len(key), N=0, flags=flags, opaque=NULL, opaque_len=0,
+        )
+
+        r.hedge_target = target
+        r.compressor = self.compressor
+        r.serializer = self.serializer
+        if self.use_fd():
+            with nogil:
+                st = builder_add_mget(self.builder, cmd)
+        else:
+            st = builder_add_mget(self.builder, cmd)
+
+        if st == WriteStatus.WS_FULL:
+            self.fail(ConnectionError('connection is not writable'))
+        elif st == WriteStatus.WS_ERROR:
+            self.fail_write()
+        return r
+
+    cdef void fail_write(self) except *:
+        if self.use_fd():
+            self.fail(self.fd_error())
+        self.fail(self.error)
+
+    cdef void recv_data(self) except *:
+        cdef Py_ssize_t n = 0
+
+        if self.use_fd():
+            with nogil:
+                n = fd_conn_recv(&self.fd_conn, self.read_buf, READ_SIZE)
+            if n < 0:
+                self.fail(self.fd_error())
+        else:
+            try:
+                n = self.conn.recv_into(self.read_view)
+            except Exception as ex:
+                self.fail(ex)
+
+        if n == 0:
+            self.fail(ConnectionError('connection is closed by server'))
+
+        if self.timing_start > 0 and self.timing_first_byte < 0:
+            self.timing_first_byte = monotonic_now() - self.timing_flushed
+
+        self.bytes_read += n
+        self.reads += 1
+        self.read_len = n
+        self.read_offset = 0
+
+    cdef bint parse_buffered(self, list pending) except *:
+        # resolves the pending results from the data already read,
+        # returns True when all of them are resolved
+        cdef int count
+        cdef int consumed
+        cdef int max_records
+        cdef int i
+        cdef const char *ptr
+        cdef Result r
+        cdef bint timed = self.timing_start > 0
+        cdef double parse_start = 0
+        cdef double now
+
+        while self.read_index < len(pending) and self.read_offset < self.read_len:
+            max_records = len(pending) - self.read_index
+            if max_records > MAX_RECORDS:
+                max_records = MAX_RECORDS
+
+            ptr = self.read_buf + self.read_offset
+            if timed:
+                parse_start = monotonic_now()
+
+            with nogil:
+                count = parser_handle_batch(
+                    self.parser, ptr, self.read_len - self.read_offset,
+                    self.records, max_records, &consumed,
+                )
+            if count < 0:
+                self.fail(ValueError(self.parser_error()))
+
+            i = 0
+            try:
+                while i < count:
+                    r = pending[self.read_index]
+                    self.read_index += 1
+                    self.inflight.remove(r)
+                    r.resolve(&self.records[i], ptr)
+                    parser_record_free(&self.records[i])
+                    i += 1
+            finally:
+                # a conversion raising leaves the rest of the batch unresolved, its records are freed too
+                while i < count:
+                    parser_record_free(&self.records[i])
+                    i += 1
+
+            self.read_offset += consumed
+
+            if timed:
+                # the results of a batch of records are resolved at about the same time
+                now = monotonic_now()
+                self.timing_parse += now - parse_start
+                self.timing_requests += count
+                for i in range(self.read_index - count, self.read_index):
+                    record_command(self.latency, pending[i], now - self.timing_start)
+
+        return self.read_index >= len(pending)
+
+    cdef dict stats(self):
+        # read without the lock: the counters are only incremented,
+        # a snapshot may be a little behind the operations in progress
+        cdef dict result
+
+        if self.parser == NULL:
+            return {'closed': True}
+
+        result = {
+            'mem': parser_mem_size() + builder_mem_size() + READ_SIZE,
+            'bytes_read': self.bytes_read,
+            'reads': self.reads,
+            'pending': len(self.pending),
+            'inflight_keys': len(self.inflight.keys),
+            'closed': self.error is not None,
+        }
+        result.update(builder_stats_dict(builder_get_stats(self.builder)))
+        result.update(parser_stats_dict(parser_get_stats(self.parser)))
+
+        if self.use_fd():
+            result['write_waits'] = self.fd_conn.write_waits
+            result['read_waits'] = self.fd_conn.read_waits
+        if self.cache is not None:
+            result['near_cache'] = self.cache.stats()
+        if self.compressor is not None:
+            result['compression'] = self.compressor.stats()
+        if self.serializer is not None:
+            result['serializer'] = self.serializer.stats()
+        if self.cork.max_delay > 0:
+            result['autocork'] = autocork_stats_dict(&self.cork, self.builder)
+        if self.hot_keys is not None:
+            result['hot_keys'] = self.hot_keys.stats()
+        if self.latency is not None:
+            result['latency'] = self.latency.snapshot()
+        return result
+
+    cdef str parser_error(self):
+        return parser_last_error(self.parser).decode()
+
+    cdef void execute(self) except *:
+        cdef double delay
+
+        self.check_error()
+
+        if self.cork.max_delay > 0:
+            # the lock is not held while waiting, other callers can add to the batch
+            delay = autocork_delay(&self.cork)
+            if delay > 0:
+                with nogil:
+                    sleep_seconds(delay)
+
+        self.acquire()
+        try:
+            self.execute_locked()
+        finally:
+            slow = self.release_slow()
+            self.report_slow(slow)
+
+    cdef void execute_locked(self) except *:
+        cdef list pending
+        cdef bint recv
+        cdef double start = monotonic_now()
+        cdef size_t written
+        cdef int callers = self.batch_callers
+
+        self.batch_source = 0
+        self.batch_callers = 0
+        self.batch_contended = 0
+
+        self.flush_locked()
+
+        while len(self.pending) > 0:
+            pending = self.take_pending()
+            recv = False
+            while not self.continue_read(pending, recv):
+                recv = True
+        self.timing_end()
+
+        if self.cork.max_delay > 0:
+            # the callers blocked on the lock while this batch was in flight
+            # will make the next batches, they are a sign of concurrency too
+            callers = max(callers, self.batch_contended + 1)
+            written = builder_get_stats(self.builder).bytes_written
+            autocork_record(
+                &self.cork, self.builder, written - self.batch_written, callers, monotonic_now() - start,
+            )
+            self.batch_written = written
+
+    cdef void flush_locked(self) except *:
+        cdef WriteStatus st
+        cdef double start = 0
+
+        if self.latency is not None:
+            start = monotonic_now()
+            if self.timing_start == 0:
+                self.timing_start = start
+                self.timing_flush = 0
+                self.timing_first_byte = -1
+                self.timing_parse = 0
+                self.timing_requests = 0
+
+        with nogil:
+            st = client_flush(self.builder)
+        if st == WriteStatus.WS_FULL:
+            self.fail(ConnectionError('connection is not writable'))
+        if st == WriteStatus.WS_ERROR:
+            self.fail_write()
+
+        self.write_refs = []
+        if self.latency is not None:
+            self.timing_flushed = monotonic_now()
+            self.timing_flush += self.timing_flushed - start
+
+    cdef void timing_end(self) except *:
+        # records the latency of the pipeline once all of its responses are read,
+        # a slow pipeline is reported by release_and_report
+        cdef dict info
+        if self.timing_start == 0:
+            return
+        info = self.latency.record_pipeline(
+            self.timing_flush, self.timing_first_byte, self.timing_parse,
+            monotonic_now() - self.timing_start, self.timing_requests,
+        )
+        self.timing_start = 0
+        if info is not None:
+            self.timing_slow.append(info)
+
+    cdef list take_pending(self):
+        cdef list pending = self.pending
+        self.pending = []
+        self.read_index = 0
+        return pending
+
+    cdef bint continue_read(self, list pending, bint recv) except *:
+        # reads once from the connection if recv is set, then resolves the results
+        # it can, on error the unresolved results of pending are failed
+        try:
+            if recv:
+                self.recv_data()
+            return self.parse_buffered(pending)
+        except BaseException:
+            self.fail_read(pending)
+            raise
+
+    cdef void fail_read(self, list pending) noexcept:
+        if self.error is None:
+            self.error = ConnectionError('connection is in an unknown state')
+        self.pending = pending[self.read_index:] + self.pending
+        self.fail_pending(self.error)
+
+
+cdef bint hedge_settled(Result r) noexcept:
+    # a hedged get is settled as soon as the get it was sent for is resolved
+    if r.done:
+        return True
+    return isinstance(r, GetResult) and (<GetResult>r).hedge_target is not None \
+        and (<GetResult>r).hedge_target.done
+
+
+cdef void send_hedges(ShardedBatch batch, dict waiting, list acquired, object poller) except *:
+    # Sends the gets of batch still waiting for their node to the first of their
+    # replicas that is usable. The lock of a replica outside the batch is only taken
+    # if it is free: waiting for it could deadlock with a batch holding it.
+    cdef GetResult r
+    cdef GetResult hedge
+    cdef ClientData d
+    cdef list pending
+    cdef int node
+    cdef int fd
+
+    for r, key, replicas in batch.hedges:
+        if r.done:
+            continue
+
+        for node in replicas:
+            d = batch.nodes[node]
+            if d not in acquired:
+                if not d.try_acquire():
+                    continue
+                acquired.append(d)
+            if d.error is not None:
+                continue
+
+            try:
+                hedge = d.hedge_get(key, r.inflight_flags, r)
+                hedge.hedge_policy = batch.policy
+                fd = d.conn.fileno()
+                if fd in waiting:
+                    (<list>waiting[fd][1]).append(hedge)
+                    d.flush_locked()
+                else:
+                    d.pending.append(hedge)
+                    d.flush_locked()
+                    pending = d.take_pending()
+                    if not d.continue_read(pending, False):
+                        waiting[fd] = (d, pending)
+                        poller.register(fd, select.POLLIN)
+                    else:
+                        d.timing_end()
+            except Exception:
+                continue
+
+            batch.policy.hedged += 1
+            break
+
+
+cdef void release_settled(dict waiting, object poller, set measured, HedgePolicy policy, double start) except *:
+    # A node whose unread results are all settled by hedges is not waited for,
+    # its responses are read and discarded by the next execute of its client.
+    cdef ClientData d
+    cdef list pending
+    cdef Result r
+    cdef int fd
+
+    for fd, (d, pending) in list(waiting.items()):
+        for r in pending[d.read_index:]:
+            if not hedge_settled(r):
+                break
+        else:
+            d.pending = pending[d.read_index:] + d.pending
+            # the late responses are timed with the next pipeline of the node
+            d.timing_start = 0
+            poller.unregister(fd)
+            del waiting[fd]
+            if fd in measured:
+                # the node has not answered yet, its response time is at least this long
+                measured.discard(fd)
+                policy.record(monotonic_now() - start)
+
+
+cdef inline void node_done(ClientData d, double start) except *:
+    # the node read the responses of the batch or failed: the latency of its pipeline is recorded,
+    # and its response time, or the error failing its connection, counts toward ejecting it
+    d.timing_end()
+    if d.breaker is None:
+        return
+    if d.error is not None:
+        d.breaker.record_error()
+    else:
+        d.breaker.record_success(monotonic_now() - start)
+
+
+cdef double poll_deadlines(dict waiting, dict deadlines, double now) except *:
+    # returns the time to poll in ms until the first deadline of the waiting nodes, -1 without any,
+    # the deadline of a node is set the first time it is seen waiting, from the timeout of its socket
+    cdef ClientData d
+    cdef double poll_ms = -1
+    cdef double deadline
+    cdef int timeout_ms
+    cdef int fd
+
+    for fd, (d, _) in waiting.items():
+        deadline = deadlines.get(fd, -2)
+        if deadline == -2:
+            timeout_ms = timeout_to_ms(d.conn.gettimeout())
+            deadline = now + timeout_ms / 1000.0 if timeout_ms >= 0 else -1
+            deadlines[fd] = deadline
+        if deadline >= 0 and (poll_ms < 0 or (deadline - now) * 1000 < poll_ms):
+            poll_ms = max(0.0, (deadline - now) * 1000)
+    return poll_ms
+
+
+cdef void expire_nodes(dict waiting, dict deadlines, object poller, double start) except *:
+    # fails the nodes waited for past their deadline, the others keep being waited for
+    cdef ClientData d
+    cdef list pending
+    cdef double deadline
+    cdef double now = monotonic_now()
+    cdef int fd
+
+    for fd, (d, pending) in list(waiting.items()):
+        deadline = deadlines.get(fd, -1)
+        if deadline < 0 or deadline > now:
+            continue
+        if d.error is None:
+            d.error = socket.timeout('timed out')
+        d.fail_read(pending)
+        node_done(d, start)
+        poller.unregister(fd)
+        del waiting[fd]
+
+
+cdef void execute_many(list datas, ShardedBatch batch = None) except *:
+    # Executes the pipelines of multiple clients: all of them are flushed before
+    # any response is read, then each one is read as soon as its socket is readable.
+    # Each node is timed out on its own, after the timeout of its socket.
+    # datas must be in the same order for every call, the locks are taken in that order.
+    # The errors of a client are set on its results instead of being raised.
+    # With the hedge policy of batch, its gets still waiting after the hedge delay
+    # are sent to a replica as well, and the response times of the nodes are recorded.
+    # The response times and errors of the nodes are recorded by their circuit breakers,
+    # and the latency of their pipelines by their latency recorders.
+    cdef list active = []
+    cdef list acquired = []
+    cdef dict waiting = {}
+    cdef dict deadlines = {} # when each waiting node times out, -1 never
+    cdef set measured = set() # nodes whose response time is recorded
+    cdef ClientData d
+    cdef list pending
+    cdef double poll_ms
+    cdef double hedge_ms
+    cdef double now
+    cdef int fd
+    cdef HedgePolicy policy = None
+    cdef double start = monotonic_now()
+    cdef double hedge_at = -1
+    cdef bint hedge_wait
+    cdef bint hedged = False
+
+    for d in datas:
+        if len(d.pending) > 0:
+            active.append(d)
+
+    if len(active) == 0:
+        return
+
+    if batch is not None and batch.policy is not None:
+        policy = batch.policy
+        if len(batch.hedges) > 0 and policy.delay >= 0:
+            hedge_at = start + policy.delay
+
+    try:
+        for d in active:
+            d.acquire()
+            acquired.append(d)
+
+        for d in active:
+            if d.error is not None:
+                d.fail_pending(d.error)
+                continue
+            try:
+                d.flush_locked()
+            except Exception:
+                node_done(d, start)
+                continue
+
+            pending = d.take_pending()
+            try:
+                if d.continue_read(pending, False):
+                    node_done(d, start)
+                    continue
+            except Exception:
+                node_done(d, start)
+                continue
+
+            waiting[d.conn.fileno()] = (d, pending)
+
+        poller = select.poll()
+        for fd in waiting:
+            poller.register(fd, select.POLLIN)
+        if policy is not None:
+            measured.update(waiting)
+
+        while len(waiting) > 0:
+            now = monotonic_now()
+            poll_ms = poll_deadlines(waiting, deadlines, now)
+            hedge_wait = False
+            if hedge_at >= 0:
+                hedge_ms = max(0.0, (hedge_at - now) * 1000)
+                hedge_wait = poll_ms < 0 or hedge_ms < poll_ms
+                if hedge_wait:
+                    poll_ms = hedge_ms
+
+            events = poller.poll(poll_ms)
+            if len(events) == 0 and hedge_wait:
+                hedge_at = -1
+                send_hedges(batch, waiting, acquired, poller)
+                hedged = True
+                release_settled(waiting, poller, measured, policy, start)
+                continue
+
+            for fd, _ in events:
+                d, pending = waiting[fd]
+                try:
+                    if not d.continue_read(pending, True):
+                        continue
+                except Exception:
+                    pass
+                else:
+                    if fd in measured:
+                        measured.discard(fd)
+                        policy.record(monotonic_now() - start)
+                node_done(d, start)
+                poller.unregister(fd)
+                del waiting[fd]
+
+            expire_nodes(waiting, deadlines, poller, start)
+            if hedged:
+                release_settled(waiting, poller, measured, policy, start)
+    finally:
+        slow = []
+        for d in acquired:
+            slow.append(d.release_slow())
+        for d, infos in zip(acquired, slow):
+            d.report_slow(infos)
+
 
 cdef class Client:
     cdef ClientPtr ptr
 
-    def __cinit__(self, object conn):
-        cdef ClientData client_data = ClientData(conn)
+    def __cinit__(
+        self, object conn, bint use_fd = False, NearCache near_cache = None,
+        Compressor compressor = None, Serializer serializer = None, int autocork_us = 0,
+        HotKeys hot_keys = None, LatencyRecorder latency = None,
+    ):
+        # with autocork_us > 0, the write limit adapts to the batch sizes and, when
+        # concurrent callers share the connection, flushes wait up to autocork_us
+        # microseconds for more of them to join the batch.
+        # hot_keys samples the keys of the gets and sets sent, it can be shared by clients.
+        # latency records the durations of the pipelines, see Client.stats
+        cdef ClientData client_data = ClientData(
+            conn, use_fd, near_cache, compressor, serializer, autocork_us, hot_keys, latency,
+        )
         client_data.get_ptr(&self.ptr)
-    
+
     cpdef Pipeline pipeline(self):
         cdef Pipeline p = Pipeline()
         ptr_clone(&p.ptr.__ptr, &self.ptr.__ptr)
         return p
-    
+
+    @property
+    def error(self):
+        """The error that failed the connection, None if it is still usable."""
+        return client_ptr_get(&self.ptr).error
+
+    def stats(self):
+        """
+        A snapshot of the memory and io counters of the connection,
+        cheap enough to be polled periodically from any thread.
+        """
+        return client_ptr_get(&self.ptr).stats()
+
     def __dealloc__(self):
         ptr_free(&self.ptr.__ptr)
 
 
+cdef int get_key_buffer(object key, Py_buffer *view) except -1:
+    cdef Py_ssize_t n
+
+    PyObject_GetBuffer(key, view, PyBUF_SIMPLE)
+    n = view.len
+    if 0 < n <= MAX_KEY_LEN:
+        return 0
+
+    PyBuffer_Release(view)
+    if n == 0:
+        raise ValueError('key must not be empty')
+    raise ValueError('key is too long')
+
+
+cdef int mget_flags(bint cas, bint ttl, bint client_flags) noexcept:
+    cdef int flags = 0
+    if cas:
+        flags |= MetaRequestFlag.MR_CAS
+    if ttl:
+        flags |= MetaRequestFlag.MR_TTL
+    if client_flags:
+        flags |= MetaRequestFlag.MR_CLIENT_FLAGS
+    return flags
+
+
+cdef inline void sample_get(HotKeys hot_keys, GetResult r, const Py_buffer *key) except *:
+    # the value bytes of a sampled get are added when its response is read
+    if hot_keys is not None and hot_keys.should_sample():
+        r.hot_keys = hot_keys
+        r.sample_key = hot_keys.record(<const char *>key.buf, key.len, 0)
+
+
+cdef inline void sample_set(HotKeys hot_keys, const Py_buffer *key, const Py_buffer *value) except *:
+    if hot_keys is not None and hot_keys.should_sample():
+        hot_keys.record(<const char *>key.buf, key.len, value.len)
+
+
 cdef class Pipeline:
     cdef ClientPtr ptr
 
+    def get(self, object key, int N = 0, bint cas = False, bint ttl = False, bint client_flags = False):
+        cdef bint created
+        return self.add_get(key, N, cas, ttl, client_flags, &created)
+
+    cdef GetResult add_get(
+        self, object key, int N, bint cas, bint ttl, bint client_flags, bint *created,
+    ):
+        # created is false if the result of a get of the key already in flight is returned
+        cdef ClientData d = client_ptr_get(&self.ptr)
+        cdef GetResult r
+        cdef WriteStatus st
+        cdef Py_buffer key_buf
+        cdef MGetCmd cmd
+        cdef bytes cache_key = None
+
+        created[0] = False
+        d.check_error()
+
+        get_key_buffer(key, &key_buf)
+        cmd = MGetCmd(
+            key=<const char *>key_buf.buf, key_len=key_buf.len, N=N,
+            flags=mget_flags(cas, ttl, client_flags), opaque=NULL, opaque_len=0,
+        )
+
+        if d.cache is not None and N == 0 and cmd.flags == 0:
+            cache_key = PyBytes_FromStringAndSize(<const char *>key_buf.buf, key_buf.len)
+            r = d.cache_get(cache_key)
+            if r is not None:
+                PyBuffer_Release(&key_buf)
+                return r
+            # the ttl of the value bounds how long it is cached
+            cmd.flags = MetaRequestFlag.MR_TTL
+
+        if d.compressor is not None or d.serializer is not None:
+            # the client flags tell whether the value is compressed and its type
+            cmd.flags |= MetaRequestFlag.MR_CLIENT_FLAGS
+
+        d.acquire()
+        try:
+            # gets with N are not shared, only one caller must see the win flag
+            if N == 0:
+                r = d.inflight.find(&key_buf, cmd.flags)
+                if r is not None:
+                    return r
+
+            r = GetResult(d)
+            created[0] = True
+            r.cache_key = cache_key
+            r.compressor = d.compressor
+            r.serializer = d.serializer
+            sample_get(d.hot_keys, r, &key_buf)
+            if d.use_fd():
+                with nogil:
+                    st = builder_add_mget(d.builder, cmd)
+            else:
+                st = builder_add_mget(d.builder, cmd)
+            d.add_pending(r, st, self)
+
+            if N == 0:
+                d.inflight.add(&key_buf, cmd.flags, r)
+        finally:
+            d.release()
+            PyBuffer_Release(&key_buf)
+        return r
+
+    def set(
+        self, object key, object value, size_t cas = 0,
+        int ttl = 0, unsigned int client_flags = 0, bint invalidate = False,
+    ):
+        cdef ClientData d = client_ptr_get(&self.ptr)
+        cdef SetResult r = SetResult(d)
+        cdef WriteStatus st
+        cdef int flags = 0
+        cdef Py_buffer key_buf
+        cdef Py_buffer value_buf
+        cdef MSetCmd cmd
+
+        d.check_error()
+
+        if invalidate:
+            flags |= MetaRequestFlag.MR_INVALIDATE
+
+        if d.serializer is not None:
+            value = d.serializer.encode(value, &client_flags)
+        if d.compressor is not None:
+            value = d.compressor.encode(value, &client_flags)
+
+        PyObject_GetBuffer(value, &value_buf, PyBUF_SIMPLE)
+        try:
+            get_key_buffer(key, &key_buf)
+        except BaseException:
+            PyBuffer_Release(&value_buf)
+            raise
+
+        cmd = MSetCmd(
+            key=<const char *>key_buf.buf, key_len=key_buf.len,
+            data=<const char *>value_buf.buf, data_len=value_buf.len, cas=cas,
+            ttl=ttl, client_flags=client_flags, flags=flags, opaque=NULL, opaque_len=0,
+        )
+
+        d.acquire()
+        try:
+            d.inflight.forget(&key_buf)
+            d.cache_invalidate(&key_buf)
+
+            if value_buf.len >= BUILDER_MIN_REF_LEN:
+                # the builder may reference the value instead of copying it,
+                # the memoryview keeps the buffer exported until it is flushed
+                d.write_refs.append(memoryview(value))
+
+            sample_set(d.hot_keys, &key_buf, &value_buf)
+            if d.use_fd():
+                with nogil:
+                    st = builder_add_mset(d.builder, cmd)
+            else:
+                st = builder_add_mset(d.builder, cmd)
+            d.add_pending(r, st, self)
+        finally:
+            d.release()
+            PyBuffer_Release(&key_buf)
+            PyBuffer_Release(&value_buf)
+        return r
+
+    def delete(self, object key, bint invalidate = False):
+        cdef ClientData d = client_ptr_get(&self.ptr)
+        cdef DeleteResult r = DeleteResult(d)
+        cdef WriteStatus st
+        cdef Py_buffer key_buf
+        cdef MDelCmd cmd
+
+        d.check_error()
+
+        get_key_buffer(key, &key_buf)
+        cmd = MDelCmd(
+            key=<const char *>key_buf.buf, key_len=key_buf.len,
+            flags=MetaRequestFlag.MR_INVALIDATE if invalidate else 0,
+        )
+        d.acquire()
+        try:
+            d.inflight.forget(&key_buf)
+            d.cache_invalidate(&key_buf)
+
+            if d.use_fd():
+                with nogil:
+                    st = builder_add_mdel(d.builder, cmd)
+            else:
+                st = builder_add_mdel(d.builder, cmd)
+            d.add_pending(r, st, self)
+        finally:
+            d.release()
+            PyBuffer_Release(&key_buf)
+        return r
+
+    def version(self):
+        cdef ClientData d = client_ptr_get(&self.ptr)
+        cdef VersionResult r = VersionResult(d)
+        cdef WriteStatus st
+
+        d.check_error()
+
+        d.acquire()
+        try:
+            if d.use_fd():
+                with nogil:
+                    st = builder_add_version(d.builder)
+            else:
+                st = builder_add_version(d.builder)
+            d.add_pending(r, st, self)
+        finally:
+            d.release()
+        return r
+
+    def execute(self):
+        cdef ClientData d = client_ptr_get(&self.ptr)
+        d.execute()
+
     def __dealloc__(self):
         ptr_free(&self.ptr.__ptr)
+
+
+# ===================================
+# Sharded Client
+# ===================================
+
+cdef class HedgePolicy:
+    """
+    The delay after which a get still waiting for its node is sent to a replica too:
+    the percentile of the recent response times of the nodes, at least min_delay seconds.
+    """
+    cdef double percentile
+    cdef double min_delay
+    cdef list samples # recent response times in seconds, a ring of HEDGE_SAMPLES
+    cdef int next_sample
+    cdef int since_update
+    cdef double delay # -1 until there are HEDGE_MIN_SAMPLES response times
+    cdef size_t hedged
+    cdef size_t wins
+
+    def __cinit__(self, double percentile, double min_delay):
+        if not 0 < percentile <= 1:
+            raise ValueError('hedge_percentile must be in (0, 1]')
+        if min_delay < 0:
+            raise ValueError('min_hedge_delay must not be negative')
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.samples = []
+        self.next_sample = 0
+        self.since_update = 0
+        self.delay = -1
+        self.hedged = 0
+        self.wins = 0
+
+    cdef void record(self, double latency) except *:
+        cdef list values
+        cdef int index
+
+        if len(self.samples) < HEDGE_SAMPLES:
+            self.samples.append(latency)
+        else:
+            self.samples[self.next_sample] = latency
+            self.next_sample = (self.next_sample + 1) % HEDGE_SAMPLES
+
+        self.since_update += 1
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return
+        if self.delay >= 0 and self.since_update < HEDGE_UPDATE_EVERY:
+            return
+
+        self.since_update = 0
+        values = sorted(self.samples)
+        index = <int>ceil(self.percentile * len(values)) - 1
+        self.delay = max(self.min_delay, values[max(0, index)])
+
+    cdef dict stats(self):
+        return {
+            'delay': self.delay,
+            'samples': len(self.samples),
+            'hedged': self.hedged,
+            'wins': self.wins,
+        }
+
+
+cdef class ShardedClient:
+    """
+    Distributes keys over multiple clients with a ketama hash ring,
+    clients is a dict from node names to cmem clients.
+
+    With replicas > 1 every key lives on that many nodes, the next ones clockwise
+    on the ring: sets and deletes are sent to all of them, and a get still waiting
+    for its node after the hedge_percentile of the recent response times,
+    at least min_hedge_delay seconds, is sent to a replica as well.
+    The first of the two responses is the result of the get, the other one
+    is read and discarded. Gets with N or cas are only sent to the first node.
+
+    With health, a clone of the circuit breaker tracks every node. The requests
+    of an ejected node fail fast with a ConnectionError, or go to its next replica
+    that is not ejected, or with failover to the next such node clockwise.
+    A node whose connection failed is skipped the same way. The requests never
+    wait for a connect: check_health replaces the failed connections with
+    connect(name), which returns a new cmem client for the node name, until
+    max_errors of them fail in a row, and probes the ejected nodes on a new connection.
+
+    With latency, a clone of the latency recorder named after the node records
+    the durations of the pipelines of every node, see latency_stats.
+    """
+    cdef HashRing ring
+    cdef list clients
+    cdef list nodes # ClientData of every node
+    cdef int replicas
+    cdef HedgePolicy policy # None without replicas
+    cdef list breakers # CircuitBreaker of every node, None without health
+    cdef list recorders # LatencyRecorder of every node, None without latency
+    cdef object connect # may be None
+    cdef bint failover
+    cdef set reconnecting # nodes whose connection is being replaced
+    cdef object __weakref__
+
+    def __cinit__(
+        self, dict clients, int points_per_node = 160, int replicas = 1,
+        double hedge_percentile = 0.95, double min_hedge_delay = 0.0005,
+        CircuitBreaker health = None, object connect = None, bint failover = False,
+        LatencyRecorder latency = None,
+    ):
+        cdef list names = list(clients.keys())
+        cdef int node
+
+        if not 1 <= replicas <= len(names):
+            raise ValueError('replicas must be between 1 and the number of nodes')
+
+        self.ring = HashRing(names, points_per_node)
+        self.clients = [clients[name] for name in names]
+        self.nodes = [client_ptr_get(&(<Client>c).ptr) for c in self.clients]
+        self.replicas = replicas
+        self.policy = None
+        if replicas > 1:
+            self.policy = HedgePolicy(hedge_percentile, min_hedge_delay)
+
+        self.breakers = None
+        self.connect = connect
+        self.failover = failover
+        self.reconnecting = set()
+        if health is not None:
+            self.breakers = [health.clone() for _ in names]
+            for node in range(len(names)):
+                (<ClientData>self.nodes[node]).breaker = self.breakers[node]
+
+        self.recorders = None
+        if latency is not None:
+            self.recorders = [latency.clone(name) for name in names]
+            for node in range(len(names)):
+                (<ClientData>self.nodes[node]).latency = self.recorders[node]
+
+    cpdef ShardedPipeline pipeline(self):
+        cdef ShardedPipeline p = ShardedPipeline()
+        p.owner = self
+        p.ring = self.ring
+        p.clients = self.clients
+        p.replicas = self.replicas
+        p.pipelines = [None] * len(self.clients)
+        p.batch = ShardedBatch()
+        p.batch.datas = [None] * len(self.clients)
+        p.batch.nodes = self.nodes
+        p.batch.policy = self.policy
+        p.batch.hedges = []
+        return p
+
+    cdef void set_client(self, int node, Client client) except *:
+        # the pipelines made before keep the previous client until they are executed
+        cdef ClientData d = client_ptr_get(&client.ptr)
+        if self.breakers is not None:
+            d.breaker = self.breakers[node]
+        if self.recorders is not None:
+            d.latency = self.recorders[node]
+        self.clients[node] = client
+        self.nodes[node] = d
+
+    cdef bint node_usable(self, int node) except *:
+        # a node whose connection failed is usable again once check_health replaced it
+        return (<CircuitBreaker>self.breakers[node]).allow() and (<ClientData>self.nodes[node]).error is None
+
+    cdef void reconnect(self, int node) except *:
+        # replaces the failed connection of a node that is not ejected
+        cdef CircuitBreaker breaker = self.breakers[node]
+        cdef Client client
+
+        if self.connect is None:
+            breaker.eject('connection')
+            return
+        if node in self.reconnecting:
+            return
+
+        self.reconnecting.add(node)
+        try:
+            client = self.connect(self.ring.nodes[node])
+        except Exception:
+            breaker.record_error()
+            return
+        finally:
+            self.reconnecting.discard(node)
+        self.set_client(node, client)
+
+    cdef list route(self, object key):
+        # the usable nodes of key, at most replicas of them, the first one is read first
+        cdef int count = len(self.nodes) if self.failover else self.replicas
+        cdef list usable = []
+        cdef int node
+
+        for node in self.ring.get_nodes(key, count):
+            if self.node_usable(node):
+                usable.append(node)
+                if len(usable) == self.replicas:
+                    break
+        return usable
+
+    cdef bint probe(self, int node) except *:
+        cdef Client client = self.clients[node]
+        cdef Pipeline p
+
+        try:
+            if self.connect is not None:
+                client = self.connect(self.ring.nodes[node])
+            p = client.pipeline()
+            r = p.version()
+            p.execute()
+            r.result()
+        except Exception:
+            return False
+
+        if client is not self.clients[node]:
+            self.set_client(node, client)
+        return True
+
+    def check_health(self):
+        """
+        Replaces or ejects the failed connections, then probes the ejected nodes
+        that are due with a version request. Returns the names of the nodes
+        that recovered, it is called periodically from a background thread.
+        """
+        cdef CircuitBreaker breaker
+        cdef list recovered = []
+        cdef int node
+
+        if self.breakers is None:
+            return recovered
+
+        for node in range(len(self.nodes)):
+            breaker = self.breakers[node]
+            if breaker.allow() and (<ClientData>self.nodes[node]).error is not None:
+                self.reconnect(node)
+            if not breaker.start_probe():
+                continue
+            ok = self.probe(node)
+            breaker.end_probe(ok)
+            if ok:
+                recovered.append(self.ring.nodes[node])
+        return recovered
+
+    def get_node(self, object key):
+        return self.ring.get_node_name(key)
+
+    def get_nodes(self, object key):
+        """The names of the nodes of key, the first one is the node read first."""
+        return [self.ring.nodes[i] for i in self.ring.get_nodes(key, self.replicas)]
+
+    def hedge_stats(self):
+        """The current hedge delay, the gets sent to a replica and those it answered first."""
+        if self.policy is None:
+            return None
+        return self.policy.stats()
+
+    def health_stats(self):
+        """The state of the circuit breaker of every node, by node name."""
+        if self.breakers is None:
+            return None
+        return {name: b.stats() for name, b in zip(self.ring.nodes, self.breakers)}
+
+    def latency_stats(self):
+        """The latency histograms of every node, by node name."""
+        if self.recorders is None:
+            return None
+        return {name: r.snapshot() for name, r in zip(self.ring.nodes, self.recorders)}
+
+    def stats(self):
+        """The stats of the client of every node, by node name."""
+        return {name: c.stats() for name, c in zip(self.ring.nodes, self.clients)}
+
+
+cdef class ShardedBatch:
+    cdef list datas # ClientData of the nodes used by a pipeline, in node order
+    cdef list nodes # ClientData of every node, not keeping the clients open
+    cdef HedgePolicy policy # None without replicas
+    cdef list hedges # (GetResult, key bytes, replica nodes) of the gets that may be hedged
+
+    cdef void execute(self) except *:
+        try:
+            execute_many([d for d in self.datas if d is not None], self)
+        finally:
+            self.hedges = []
+
+
+cdef class ShardedPipeline:
+    """
+    Commands are added to the pipelines of their nodes, on execute the
+    requests to all nodes are sent before any response is read,
+    so a batch costs about one round trip whatever the number of nodes.
+    """
+    cdef ShardedClient owner
+    cdef HashRing ring
+    cdef list clients
+    cdef int replicas
+    cdef list pipelines
+    cdef ShardedBatch batch
+
+    cdef Pipeline node_pipeline(self, object key):
+        return self.pipeline_at(self.ring.get_node(key))
+
+    cdef Pipeline pipeline_at(self, int node):
+        cdef Pipeline p = self.pipelines[node]
+
+        # the client of the node is replaced after its connection failed
+        if p is None or self.batch.datas[node] is not self.batch.nodes[node]:
+            p = (<Client>self.clients[node]).pipeline()
+            self.pipelines[node] = p
+            self.batch.datas[node] = client_ptr_get(&p.ptr)
+        return p
+
+    cdef list key_nodes(self, object key):
+        if self.owner.breakers is not None:
+            return self.owner.route(key)
+        return self.ring.get_nodes(key, self.replicas)
+
+    cdef Result fail_fast(self, Result r, object key):
+        r.done = True
+        r.error = ConnectionError(f'node {self.ring.get_node_name(key)} is not available')
+        return r
+
+    def get(self, object key, int N = 0, bint cas = False, bint ttl = False, bint client_flags = False):
+        cdef list nodes
+        cdef GetResult r
+        cdef bint created = True
+
+        if self.owner.breakers is None and (self.replicas == 1 or N != 0 or cas):
+            r = self.node_pipeline(key).add_get(key, N, cas, ttl, client_flags, &created)
+        else:
+            nodes = self.key_nodes(key)
+            if len(nodes) == 0:
+                r = <GetResult>self.fail_fast(GetResult(None), key)
+            else:
+                r = self.pipeline_at(nodes[0]).add_get(key, N, cas, ttl, client_flags, &created)
+                if created and not r.done and len(nodes) > 1 and N == 0 and not cas:
+                    self.batch.hedges.append((r, bytes(key), nodes[1:]))
+
+        # a get of a key in flight shares the result of an earlier pipeline,
+        # which stays bound to the batch and the hedges of that pipeline
+        if created:
+            r.batch = self.batch
+        return r
+
+    def set(
+        self, object key, object value, size_t cas = 0,
+        int ttl = 0, unsigned int client_flags = 0, bint invalidate = False,
+    ):
+        cdef list nodes
+        cdef Result r
+        cdef int node
+
+        if self.owner.breakers is None and self.replicas == 1:
+            r = self.node_pipeline(key).set(key, value, cas, ttl, client_flags, invalidate)
+        else:
+            # the result is the one of the first node, a cas is only valid
+            # on the node it was read from, the replicas drop their value instead
+            nodes = self.key_nodes(key)
+            if len(nodes) == 0:
+                r = self.fail_fast(SetResult(None), key)
+            else:
+                r = self.pipeline_at(nodes[0]).set(key, value, cas, ttl, client_flags, invalidate)
+            for node in nodes[1:]:
+                if cas != 0:
+                    self.pipeline_at(node).delete(key)
+                else:
+                    self.pipeline_at(node).set(key, value, cas, ttl, client_flags, invalidate)
+        r.batch = self.batch
+        return r
+
+    def delete(self, object key, bint invalidate = False):
+        cdef list nodes
+        cdef Result r
+        cdef int node
+
+        if self.owner.breakers is None and self.replicas == 1:
+            r = self.node_pipeline(key).delete(key, invalidate)
+        else:
+            nodes = self.key_nodes(key)
+            if len(nodes) == 0:
+                r = self.fail_fast(DeleteResult(None), key)
+            else:
+                r = self.pipeline_at(nodes[0]).delete(key, invalidate)
+            for node in nodes[1:]:
+                self.pipeline_at(node).delete(key, invalidate)
+        r.batch = self.batch
+        return r
+
+    def get_many(self, object keys):
+        """Returns the values of keys in the same order, None for missing keys."""
+        cdef list results = [self.get(key) for key in keys]
+        self.batch.execute()
+        return [r.result() for r in results]
+
+    def execute(self):
+        self.batch.execute()
+
+
+# ===================================
+# Asyncio Connection
+# ===================================
+
+cdef int async_write_func(void *obj, const char *data, int n) noexcept:
+    cdef AsyncConn conn = <AsyncConn>obj
+    try:
+        # the transport may keep the data after write returns
+        conn.transport.write(PyBytes_FromStringAndSize(data, n))
+        return n
+    except Exception as ex:
+        conn.error = ex
+        return -1
+
+
+cdef class AsyncConn:
+    """
+    The protocol state of an asyncio connection: commands are added to the
+    builder and flushed to the transport once per event loop iteration,
+    the data passed to data_received resolves the pending results in FIFO order.
+    """
+    cdef object transport
+    cdef object loop
+
+    cdef Parser *parser
+    cdef Builder *builder
+
+    cdef object pending # deque of results waiting for a response, in request order
+    cdef InflightGets inflight
+    cdef Compressor compressor # may be None
+    cdef Serializer serializer # may be None
+    cdef HotKeys hot_keys # may be None
+    cdef bint flush_scheduled
+    cdef ParserRecord records[MAX_RECORDS]
+
+    # auto cork state, only used when cork.max_delay > 0
+    cdef AutoCork cork
+    cdef int batch_callers # commands added since the last flush
+    cdef size_t batch_written # bytes_written of the builder after the last flush
+    cdef int measure_remaining # responses until the measured batch is complete, 0 if none
+    cdef int measure_callers
+    cdef size_t measure_bytes
+    cdef double measure_start
+
+    cdef object error
+
+    def __cinit__(
+        self, object transport, object loop,
+        Compressor compressor = None, Serializer serializer = None, int autocork_us = 0,
+        HotKeys hot_keys = None,
+    ):
+        self.transport = transport
+        self.loop = loop
+        self.compressor = compressor
+        self.serializer = serializer
+        self.hot_keys = hot_keys
+
+        autocork_init(&self.cork, autocork_us * 1e-6)
+        self.batch_callers = 0
+        self.batch_written = 0
+        self.measure_remaining = 0
+        self.parser = new_parser()
+        self.builder = new_builder(<void *>self, async_write_func, 4096)
+        self.pending = deque()
+        self.inflight = InflightGets()
+        self.flush_scheduled = False
+        self.error = None
+
+    def __dealloc__(self):
+        parser_free(self.parser)
+        builder_free(self.builder)
+
+    def get(self, object key, int N = 0, bint cas = False, bint ttl = False, bint client_flags = False):
+        cdef GetResult r
+        cdef WriteStatus st
+        cdef Py_buffer key_buf
+        cdef MGetCmd cmd
+
+        self.check_error()
+
+        get_key_buffer(key, &key_buf)
+        cmd = MGetCmd(
+            key=<const char *>key_buf.buf, key_len=key_buf.len, N=N,
+            flags=mget_flags(cas, ttl, client_flags), opaque=NULL, opaque_len=0,
+        )
+        if self.compressor is not None or self.serializer is not None:
+            cmd.flags |= MetaRequestFlag.MR_CLIENT_FLAGS
+        try:
+            if N == 0:
+                r = self.inflight.find(&key_buf, cmd.flags)
+                if r is not None:
+                    return r
+
+            r = GetResult(None)
+            r.compressor = self.compressor
+            r.serializer = self.serializer
+            sample_get(self.hot_keys, r, &key_buf)
+            st = builder_add_mget(self.builder, cmd)
+            self.add_pending(r, st)
+
+            if N == 0:
+                self.inflight.add(&key_buf, cmd.flags, r)
+        finally:
+            PyBuffer_Release(&key_buf)
+        return r
+
+    def set(
+        self, object key, object value, size_t cas = 0,
+        int ttl = 0, unsigned int client_flags = 0, bint invalidate = False,
+    ):
+        cdef SetResult r = SetResult(None)
+        cdef WriteStatus st
+        cdef int flags = 0
+        cdef Py_buffer key_buf
+        cdef Py_buffer value_buf
+        cdef MSetCmd cmd
+
+        self.check_error()
+
+        if invalidate:
+            flags |= MetaRequestFlag.MR_INVALIDATE
+
+        if self.serializer is not None:
+            value = self.serializer.encode(value, &client_flags)
+        if self.compressor is not None:
+            value = self.compressor.encode(value, &client_flags)
+
+        PyObject_GetBuffer(value, &value_buf, PyBUF_SIMPLE)
+        try:
+            get_key_buffer(key, &key_buf)
+        except BaseException:
+            PyBuffer_Release(&value_buf)
+            raise
+
+        cmd = MSetCmd(
+            key=<const char *>key_buf.buf, key_len=key_buf.len,
+            data=<const char *>value_buf.buf, data_len=value_buf.len, cas=cas,
+            ttl=ttl, client_flags=client_flags, flags=flags, opaque=NULL, opaque_len=0,
+        )
+        self.inflight.forget(&key_buf)
+        try:
+            sample_set(self.hot_keys, &key_buf, &value_buf)
+            st = builder_add_mset(self.builder, cmd)
+        finally:
+            PyBuffer_Release(&key_buf)
+            PyBuffer_Release(&value_buf)
+
+        self.add_pending(r, st)
+        return r
+
+    def delete(self, object key, bint invalidate = False):
+        cdef DeleteResult r = DeleteResult(None)
+        cdef WriteStatus st
+        cdef Py_buffer key_buf
+        cdef MDelCmd cmd
+
+        self.check_error()
+
+        get_key_buffer(key, &key_buf)
+        cmd = MDelCmd(
+            key=<const char *>key_buf.buf, key_len=key_buf.len,
+            flags=MetaRequestFlag.MR_INVALIDATE if invalidate else 0,
+        )
+        self.inflight.forget(&key_buf)
+        st = builder_add_mdel(self.builder, cmd)
+        PyBuffer_Release(&key_buf)
+
+        self.add_pending(r, st)
+        return r
+
+    cdef void check_error(self) except *:
+        if self.error is not None:
+            raise self.error
+
+    cdef void add_pending(self, Result r, WriteStatus st) except *:
+        cdef double delay = 0
+
+        r.waiter = self.loop.create_future()
+        self.pending.append(r)
+        self.batch_callers += 1
+
+        if st == WriteStatus.WS_ERROR:
+            self.fail(self.error)
+            raise self.error
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            if self.cork.max_delay > 0:
+                delay = autocork_delay(&self.cork)
+            if delay > 0:
+                self.loop.call_later(delay, self.flush)
+            else:
+                self.loop.call_soon(self.flush)
+
+    def flush(self):
+        cdef bint measure
+        cdef size_t written
+
+        self.flush_scheduled = False
+        if self.error is not None:
+            return
+
+        # one batch at a time is measured, until its last response
+        measure = self.cork.max_delay > 0 and self.measure_remaining == 0
+        if measure:
+            self.measure_start = monotonic_now()
+
+        if client_flush(self.builder) == WriteStatus.WS_ERROR:
+            self.fail(self.error)
+            return
+
+        written = builder_get_stats(self.builder).bytes_written
+        if measure:
+            self.measure_remaining = len(self.pending)
+            self.measure_callers = self.batch_callers
+            self.measure_bytes = written - self.batch_written
+        self.batch_written = written
+        self.batch_callers = 0
+
+    cdef void measure_response(self) noexcept:
+        if self.measure_remaining == 0:
+            return
+        self.measure_remaining -= 1
+        if self.measure_remaining == 0:
+            autocork_record(
+                &self.cork, self.builder, self.measure_bytes,
+                self.measure_callers, monotonic_now() - self.measure_start,
+            )
+
+    def data_received(self, const unsigned char[:] data not None):
+        cdef const char *ptr = <const char *>&data[0] if len(data) > 0 else NULL
+        cdef int n = len(data)
+        cdef int offset = 0
+        cdef int count
+        cdef int consumed
+        cdef int max_records
+        cdef int i
+        cdef Result r
+
+        while offset < n:
+            max_records = len(self.pending)
+            if max_records == 0:
+                self.fail(ValueError('unexpected response from server'))
+                self.transport.close()
+                return
+            if max_records > MAX_RECORDS:
+                max_records = MAX_RECORDS
+
+            count = parser_handle_batch(
+                self.parser, ptr + offset, n - offset, self.records, max_records, &consumed,
+            )
+            if count < 0:
+                self.fail(ValueError(parser_last_error(self.parser).decode()))
+                self.transport.close()
+                return
+
+            i = 0
+            try:
+                while i < count:
+                    r = self.pending.popleft()
+                    self.inflight.remove(r)
+                    try:
+                        r.resolve(&self.records[i], ptr + offset)
+                    except BaseException as ex:
+                        r.error = ex
+                        r.done = True
+                        r.notify()
+                        # the results of the rest of the batch and after it fail with the connection
+                        self.fail(ConnectionError('connection is in an unknown state'))
+                        self.transport.close()
+                        raise
+                    parser_record_free(&self.records[i])
+                    i += 1
+                    r.notify()
+                    self.measure_response()
+            finally:
+                # a conversion raising leaves the rest of the batch unresolved, its records are freed too
+                while i < count:
+                    parser_record_free(&self.records[i])
+                    i += 1
+                offset += consumed
+
+    def connection_lost(self, object exc):
+        if exc is None:
+            exc = ConnectionError('connection is closed')
+        self.fail(exc)
+
+    def close(self):
+        self.fail(ConnectionError('client is closed'))
+        self.transport.close()
+
+    def stats(self):
+        cdef dict result = {
+            'mem': parser_mem_size() + builder_mem_size(),
+            'pending': len(self.pending),
+            'inflight_keys': len(self.inflight.keys),
+            'closed': self.error is not None,
+        }
+        result.update(builder_stats_dict(builder_get_stats(self.builder)))
+        result.update(parser_stats_dict(parser_get_stats(self.parser)))
+        if self.compressor is not None:
+            result['compression'] = self.compressor.stats()
+        if self.serializer is not None:
+            result['serializer'] = self.serializer.stats()
+        if self.cork.max_delay > 0:
+            result['autocork'] = autocork_stats_dict(&self.cork, self.builder)
+        if self.hot_keys is not None:
+            result['hot_keys'] = self.hot_keys.stats()
+        return result
+
+    cdef void fail(self, object ex) noexcept:
+        cdef Result r
+
+        if self.error is None:
+            self.error = ex
+
+        self.measure_remaining = 0
+        self.inflight.clear()
+        while len(self.pending) > 0:
+            r = self.pending.popleft()
+            r.error = self.error
+            r.done = True
+            r.notify()
+
+
+# ===================================
+# Pipeline Results
+# ===================================
+
+cdef class Result:
+    cdef ClientData client # None for the results of an AsyncConn
+    cdef bint done
+    cdef object error
+    cdef object value
+    cdef object waiter # asyncio future, resolved together with the result
+    cdef ShardedBatch batch # executes all nodes of a ShardedPipeline, may be None
+
+    def __cinit__(self, ClientData client):
+        self.client = client
+        self.done = False
+        self.error = None
+        self.value = None
+        self.waiter = None
+        self.batch = None
+
+    cdef void resolve(self, ParserRecord *rec, const char *data) except *:
+        self.done = True
+
+    cdef void notify(self) noexcept:
+        if self.waiter is None or self.waiter.done():
+            return
+        if self.error is not None:
+            self.waiter.set_exception(self.error)
+        else:
+            self.waiter.set_result(self.value)
+
+    cdef void wait(self) except *:
+        if not self.done and self.batch is not None:
+            self.batch.execute()
+
+        if not self.done:
+            if self.client is None:
+                raise RuntimeError('result is not ready, it must be awaited')
+            self.client.execute()
+
+        if self.error is not None:
+            raise self.error
+
+    def result(self):
+        self.wait()
+        return self.value
+
+    def __await__(self):
+        if self.waiter is None:
+            raise TypeError('result of a blocking client can not be awaited')
+        return self.waiter.__await__()
+
+
+cdef class GetResult(Result):
+    cdef bytes inflight_key # set while the result can be shared by other gets of the key
+    cdef int inflight_flags
+    cdef bytes cache_key # set if the value is stored in the near cache of the client
+    cdef Compressor compressor # set if the value may be compressed
+    cdef Serializer serializer # set if the value is converted from bytes
+    cdef GetResult hedge_target # set on the copy of a get sent to a replica
+    cdef HedgePolicy hedge_policy # set with hedge_target
+    cdef HotKeys hot_keys # set if the get is sampled
+    cdef bytes sample_key
+
+    cdef int meta_flags
+    cdef size_t meta_cas
+    cdef int meta_ttl
+    cdef unsigned int meta_client_flags
+
+    cdef void resolve(self, ParserRecord *rec, const char *data) except *:
+        cdef bytes value = None
+        cdef unsigned int type_flags = 0
+
+        if self.done:
+            # the get was resolved by its hedge first, this response is discarded
+            return
+        self.done = True
+        if self.hedge_target is not None and self.hedge_target.done:
+            return
+
+        if rec.cmd == ParserCmd.P_CMD_MG:
+            value = parser_record_data(data, rec)
+            if self.hot_keys is not None:
+                self.hot_keys.add_bytes(self.sample_key, len(value))
+        elif rec.cmd != ParserCmd.P_CMD_EN:
+            self.error = ValueError(f'unexpected response for mg: {rec.cmd}')
+            return
+
+        self.meta_flags = rec.meta.flags
+        self.meta_cas = rec.meta.cas
+        self.meta_ttl = rec.meta.ttl
+        self.meta_client_flags = rec.meta.client_flags
+
+        if value is not None and self.meta_flags & ParserMetaFlag.PM_CLIENT_FLAGS:
+            # the bits of the compressor and serializer are removed from the client flags
+            try:
+                if self.compressor is not None and self.compressor.is_compressed(self.meta_client_flags):
+                    self.meta_client_flags &= ~self.compressor.flag
+                    value = self.compressor.decompress_value(value)
+                if self.serializer is not None:
+                    type_flags = self.meta_client_flags & CODEC_TYPE_MASK
+                    self.meta_client_flags &= ~CODEC_TYPE_MASK
+                    self.value = self.serializer.decode(value, type_flags)
+                else:
+                    self.value = value
+            except Exception as ex:
+                self.error = ex
+                return
+        else:
+            self.value = value
+
+        if self.cache_key is not None and value is not None:
+            self.client.cache.store(
+                self.cache_key, value,
+                self.meta_ttl if self.meta_flags & ParserMetaFlag.PM_TTL else -1, type_flags,
+            )
+
+        if self.hedge_target is not None:
+            # the replica answered first, its value is not put in the near cache of the first node
+            self.hedge_policy.wins += 1
+            self.hedge_target.take_hedge(self)
+
+    cdef void take_hedge(self, GetResult r) noexcept:
+        self.value = r.value
+        self.meta_flags = r.meta_flags
+        self.meta_cas = r.meta_cas
+        self.meta_ttl = r.meta_ttl
+        self.meta_client_flags = r.meta_client_flags
+        self.done = True
+        self.notify()
+
+    @property
+    def cas(self):
+        self.wait()
+        if self.meta_flags & ParserMetaFlag.PM_CAS:
+            return self.meta_cas
+        return None
+
+    @property
+    def ttl(self):
+        self.wait()
+        if self.meta_flags & ParserMetaFlag.PM_TTL:
+            return self.meta_ttl
+        return None
+
+    @property
+    def client_flags(self):
+        self.wait()
+        if self.meta_flags & ParserMetaFlag.PM_CLIENT_FLAGS:
+            return self.meta_client_flags
+        return None
+
+    @property
+    def win(self):
+        self.wait()
+        return self.meta_flags & ParserMetaFlag.PM_WIN != 0
+
+    @property
+    def stale(self):
+        self.wait()
+        return self.meta_flags & ParserMetaFlag.PM_STALE != 0
+
+    @property
+    def won(self):
+        self.wait()
+        return self.meta_flags & ParserMetaFlag.PM_WON != 0
+
+
+cdef class SetResult(Result):
+    cdef void resolve(self, ParserRecord *rec, const char *data) except *:
+        cdef ParserCmd cmd = rec.cmd
+        self.done = True
+        if cmd == ParserCmd.P_CMD_HD:
+            self.value = True
+        elif cmd == ParserCmd.P_CMD_NS or cmd == ParserCmd.P_CMD_EX or cmd == ParserCmd.P_CMD_NF:
+            self.value = False
+        else:
+            self.error = ValueError(f'unexpected response for ms: {cmd}')
+
+
+cdef class DeleteResult(Result):
+    cdef void resolve(self, ParserRecord *rec, const char *data) except *:
+        cdef ParserCmd cmd = rec.cmd
+        self.done = True
+        if cmd == ParserCmd.P_CMD_HD:
+            self.value = True
+        elif cmd == ParserCmd.P_CMD_NF or cmd == ParserCmd.P_CMD_EX:
+            self.value = False
+        else:
+            self.error = ValueError(f'unexpected response for md: {cmd}')
+
+
+cdef class VersionResult(Result):
+    cdef void resolve(self, ParserRecord *rec, const char *data) except *:
+        self.done = True
+        if rec.cmd == ParserCmd.P_CMD_VERSION:
+            self.value = True
+        else:
+            self.error = ValueError(f'unexpected response for version: {rec.cmd}')
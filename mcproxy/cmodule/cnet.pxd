@@ -0,0 +1,16 @@
+from cbuilder cimport BuilderSegment
+
+
+cdef struct FdConn:
+    int fd
+    int timeout_ms # -1 for no timeout
+    int err # errno of the last failed call
+    size_t write_waits # writes that had to wait for the socket to become writable
+    size_t read_waits # reads that had to wait for data
+
+
+cdef void fd_conn_init(FdConn *c, int fd, int timeout_ms) noexcept nogil
+
+cdef Py_ssize_t fd_conn_writev(void *obj, const BuilderSegment *segs, int n) noexcept nogil
+
+cdef Py_ssize_t fd_conn_recv(FdConn *c, char *buf, Py_ssize_t n) noexcept nogil
@@ -0,0 +1,115 @@
+from libc.errno cimport errno, EINTR, EAGAIN, ETIMEDOUT
+from posix.uio cimport iovec, writev
+from posix.unistd cimport read
+
+
+DEF MAX_IOV = 64
+
+
+cdef extern from "<errno.h>" nogil:
+    enum:
+        EWOULDBLOCK
+
+
+cdef extern from "<poll.h>" nogil:
+    cdef struct pollfd:
+        int fd
+        short events
+        short revents
+
+    ctypedef unsigned long nfds_t
+
+    int poll(pollfd *fds, nfds_t nfds, int timeout)
+
+    enum:
+        POLLIN
+        POLLOUT
+
+
+cdef bint fd_would_block(int err) noexcept nogil:
+    # EAGAIN and EWOULDBLOCK may be the same value
+    if err == EAGAIN:
+        return True
+    return err == EWOULDBLOCK
+
+
+cdef void fd_conn_init(FdConn *c, int fd, int timeout_ms) noexcept nogil:
+    c.fd = fd
+    c.timeout_ms = timeout_ms
+    c.err = 0
+    c.write_waits = 0
+    c.read_waits = 0
+
+
+cdef int fd_conn_wait(FdConn *c, short events) noexcept nogil:
+    cdef pollfd pfd
+    cdef int ret
+
+    pfd.fd = c.fd
+    pfd.events = events
+    pfd.revents = 0
+
+    while True:
+        ret = poll(&pfd, 1, c.timeout_ms)
+        if ret > 0:
+            return 0
+
+        if ret == 0:
+            c.err = ETIMEDOUT
+            return -1
+
+        if errno != EINTR:
+            c.err = errno
+            return -1
+
+
+cdef Py_ssize_t fd_conn_writev(void *obj, const BuilderSegment *segs, int n) noexcept nogil:
+    cdef FdConn *c = <FdConn *>obj
+    cdef iovec iov[MAX_IOV]
+    cdef Py_ssize_t ret
+    cdef int i
+
+    if n > MAX_IOV:
+        n = MAX_IOV
+
+    for i in range(n):
+        iov[i].iov_base = <void *>segs[i].data
+        iov[i].iov_len = segs[i].len
+
+    while True:
+        ret = writev(c.fd, iov, n)
+        if ret >= 0:
+            return ret
+
+        if errno == EINTR:
+            continue
+
+        if fd_would_block(errno):
+            c.write_waits += 1
+            if fd_conn_wait(c, POLLOUT):
+                return -1
+            continue
+
+        c.err = errno
+        return -1
+
+
+cdef Py_ssize_t fd_conn_recv(FdConn *c, char *buf, Py_ssize_t n) noexcept nogil:
+    cdef Py_ssize_t ret
+
+    while True:
+        ret = read(c.fd, buf, n)
+        if ret >= 0:
+            return ret
+
+        if errno == EINTR:
+            continue
+
+        if fd_would_block(errno):
+            c.read_waits += 1
+            if fd_conn_wait(c, POLLIN):
+                return -1
+            continue
+
+        c.err = errno
+        return -1
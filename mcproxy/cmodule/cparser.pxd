@@ -1,3 +1,5 @@
+from cpython.ref cimport PyObject
+
 cdef struct Parser
 
 cdef Parser *new_parser() noexcept nogil
@@ -14,9 +16,70 @@ cdef enum ParserCmd:
     P_CMD_NS
     P_CMD_EX
     P_CMD_NF
+    P_CMD_EN
+
+cdef enum:
+    PARSER_NUM_CMDS = 8 # number of ParserCmd values
+
+cdef struct ParserStats:
+    size_t responses[PARSER_NUM_CMDS] # by ParserCmd
+    size_t errors
+
+cdef enum:
+    MAX_META_KEY_LEN = 250
+    MAX_META_OPAQUE_LEN = 32
+
+cdef enum ParserMetaFlag:
+    PM_CAS = 1 # c
+    PM_TTL = 2 # t
+    PM_CLIENT_FLAGS = 4 # f
+    PM_KEY = 8 # k
+    PM_OPAQUE = 16 # O
+    PM_WIN = 32 # W
+    PM_STALE = 64 # X
+    PM_WON = 128 # Z
+
+cdef struct ParserMeta:
+    int flags # ParserMetaFlag bits of the flags present in the response
+    size_t cas
+    int ttl # -1 when the item does not expire
+    unsigned int client_flags
+    char key[MAX_META_KEY_LEN]
+    int key_len
+    char opaque[MAX_META_OPAQUE_LEN]
+    int opaque_len
+
+cdef const ParserMeta *parser_get_meta(Parser *p) noexcept nogil
+
+cdef struct ParserRecord:
+    ParserCmd cmd
+    int data_offset # offset of the value inside the batch data, -1 if the value is owned by response
+    int data_len
+    PyObject *response # owning, only set when the value did not arrive within a single batch
+    ParserMeta meta
+
+cdef int parser_handle_batch(
+    Parser *p, const char *data, int n,
+    ParserRecord *records, int max_records, int *consumed,
+) noexcept nogil
+
+cdef bytes parser_record_data(const char *data, ParserRecord *rec) noexcept
+
+cdef void parser_record_free(ParserRecord *rec) noexcept nogil
+
+# Length of the complete response at the start of data, 0 if incomplete, -1 if not well formed.
+cdef int parser_frame_response(const char *data, int n, int *need) noexcept nogil
 
 cdef ParserCmd parser_get_cmd(Parser *p, int *ret) noexcept nogil
 
+cdef const char *parser_last_error(Parser *p) noexcept nogil
+
+cdef const ParserStats *parser_get_stats(Parser *p) noexcept nogil
+
+cdef size_t parser_mem_size() noexcept nogil
+
+cdef dict parser_stats_dict(const ParserStats *s)
+
 cdef bytes parser_get_string(Parser *p) noexcept
 
 cdef bytes parser_get_data(Parser *p) noexcept
\ No newline at end of file
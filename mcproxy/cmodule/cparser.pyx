@@ -1,10 +1,22 @@
-from libc.string cimport memcpy
+from libc.string cimport memcpy, memchr, memcmp, memset
 
-from cutil cimport alloc_object, free_object
+from cpython.ref cimport PyObject, Py_XDECREF
+from cpython.bytes cimport PyBytes_AS_STRING
+from cpython.exc cimport PyErr_Clear
+
+from cutil cimport MemOwner, alloc_owned, free_owned
 from cutil cimport bytes_equal
 
 
+cdef extern from "Python.h":
+    # returns NULL instead of raising, for the parser to report the error itself
+    PyObject *PyBytes_FromStringAndSize_ptr "PyBytes_FromStringAndSize"(const char *v, Py_ssize_t n)
+
+
 DEF TMP_DATA_MAX_LEN = 1024
+DEF MAX_VA_NUM_DIGITS = 9
+DEF MAX_META_NUM_DIGITS = 20
+DEF MAX_RESPONSE_LINE_LEN = 2048
 
 
 cdef enum ParserState:
@@ -40,22 +52,36 @@ cdef struct Parser:
     char tmp_data[TMP_DATA_MAX_LEN]
     int tmp_data_len
 
-    char *response_data # owning
+    PyObject *response # owning reference to the bytes object of the current VA value
+    char *response_data # non owning, points into the buffer of response
     int response_data_len
     int response_index
 
     int wait_response
 
+    ParserMeta meta
+
     const char *last_error
 
+    ParserStats stats
+
 
 cdef void parser_inc(Parser *p) noexcept nogil:
     p.data += 1
     p.data_len -= 1
 
 
+cdef void parser_begin_flags(Parser *p, ParserCmd cmd) noexcept nogil:
+    p.state = ParserState.P_FIND_CR
+    p.next_cmd = cmd
+    p.tmp_data_len = 0
+
+
 cdef int parser_handle_init(Parser *p) noexcept nogil:
     cdef char ch = p.data[0]
+
+    meta_reset(&p.meta)
+
     if ch == 'V':
         parser_inc(p)
         p.state = ParserState.P_HANDLE_V
@@ -97,8 +123,7 @@ cdef int parser_handle_v(Parser *p) noexcept nogil:
 cdef int parser_handle_h(Parser *p) noexcept nogil:
     if p.data[0] == 'D':
         parser_inc(p)
-        p.state = ParserState.P_FIND_CR
-        p.next_cmd = ParserCmd.P_CMD_HD
+        parser_begin_flags(p, ParserCmd.P_CMD_HD)
         return 0
 
     p.last_error = 'invalid character after H'
@@ -110,13 +135,11 @@ cdef int parser_handle_n(Parser *p) noexcept nogil:
 
     if ch == 'S':
         parser_inc(p)
-        p.state = ParserState.P_FIND_CR
-        p.next_cmd = ParserCmd.P_CMD_NS
+        parser_begin_flags(p, ParserCmd.P_CMD_NS)
         return 0
     elif ch == 'F':
         parser_inc(p)
-        p.state = ParserState.P_FIND_CR
-        p.next_cmd = ParserCmd.P_CMD_NF
+        parser_begin_flags(p, ParserCmd.P_CMD_NF)
         return 0
 
     p.last_error = 'invalid character after N'
@@ -124,10 +147,15 @@ cdef int parser_handle_n(Parser *p) noexcept nogil:
 
 
 cdef int parser_handle_e(Parser *p) noexcept nogil:
-    if p.data[0] == 'X':
+    cdef char ch = p.data[0]
+
+    if ch == 'X':
+        parser_inc(p)
+        parser_begin_flags(p, ParserCmd.P_CMD_EX)
+        return 0
+    elif ch == 'N':
         parser_inc(p)
-        p.state = ParserState.P_FIND_CR
-        p.next_cmd = ParserCmd.P_CMD_EX
+        parser_begin_flags(p, ParserCmd.P_CMD_EN)
         return 0
 
     p.last_error = 'invalid character after E'
@@ -155,8 +183,26 @@ cdef int num_from_str(const char *s, int n) noexcept nogil:
 
 
 cdef void parser_free_response(Parser *p) noexcept nogil:
-    if p.response_data != NULL:
-        free_object(<void *>p.response_data, p.response_data_len)
+    if p.response != NULL:
+        with gil:
+            Py_XDECREF(p.response)
+        p.response = NULL
+        p.response_data = NULL
+
+
+cdef int parser_alloc_response(Parser *p, int n) noexcept nogil:
+    # the value is copied from the socket data directly into this bytes object,
+    # parser_get_data then returns it without another copy
+    cdef PyObject *b
+    with gil:
+        b = PyBytes_FromStringAndSize_ptr(NULL, n)
+        if b == NULL:
+            PyErr_Clear()
+            p.last_error = 'can not allocate the VA value'
+            return -1
+        p.response = b
+        p.response_data = PyBytes_AS_STRING(<object>b)
+    return 0
 
 
 cdef int parser_handle_va_num(Parser *p) noexcept nogil:
@@ -164,6 +210,10 @@ cdef int parser_handle_va_num(Parser *p) noexcept nogil:
     cdef char ch = p.data[0]
 
     if is_digit(ch):
+        # the length must fit in an int
+        if p.tmp_data_len >= MAX_VA_NUM_DIGITS:
+            p.last_error = 'VA number is too large'
+            return -1
         ret =  parser_append_tmp(p, ch)
         parser_inc(p)
         return ret
@@ -177,19 +227,21 @@ cdef int parser_handle_va_num(Parser *p) noexcept nogil:
     p.state = ParserState.P_MGET_VA_FLAGS
     p.response_data_len = num_from_str(p.tmp_data, p.tmp_data_len)
     p.response_index = 0
-    p.response_data = <char *>alloc_object(p.response_data_len)
-    
-    return 0
+    p.tmp_data_len = 0
+    return parser_alloc_response(p, p.response_data_len)
 
 cdef int parser_handle_va_flags(Parser *p) noexcept nogil:
+    cdef int ret
+
     if p.data[0] == '\r':
         p.state = ParserState.P_HANDLE_CR
         p.next_cmd = ParserCmd.P_CMD_MG
         p.wait_response = True
-        return 0
-    
+        return parser_finish_flags(p)
+
+    ret = parser_append_tmp(p, p.data[0])
     parser_inc(p)
-    return 0
+    return ret
 
 
 cdef int parser_handle_va_data(Parser *p) noexcept nogil:
@@ -201,7 +253,7 @@ cdef int parser_handle_va_data(Parser *p) noexcept nogil:
         p.state = ParserState.P_HANDLE_CR
         p.wait_response = False
 
-    memcpy(<void *>p.response_data, <void *>p.data, n)
+    memcpy(<void *>(p.response_data + p.response_index), <void *>p.data, n)
 
     p.data += n
     p.data_len -= n
@@ -211,14 +263,131 @@ cdef int parser_handle_va_data(Parser *p) noexcept nogil:
 
 
 cdef int parser_find_cr(Parser *p) noexcept nogil:
+    cdef int ret
+
     if p.data[0] == '\r':
         p.state = ParserState.P_HANDLE_CR
-        return 0
+        return parser_finish_flags(p)
 
+    ret = parser_append_tmp(p, p.data[0])
     parser_inc(p)
+    return ret
+
+
+cdef int parser_finish_flags(Parser *p) noexcept nogil:
+    cdef const char *err = meta_parse(&p.meta, p.tmp_data, p.tmp_data + p.tmp_data_len)
+    p.tmp_data_len = 0
+
+    if err != NULL:
+        p.last_error = err
+        return -1
     return 0
 
 
+# ===================================
+# Meta Flags
+# ===================================
+
+cdef void meta_reset(ParserMeta *meta) noexcept nogil:
+    meta.flags = 0
+    meta.cas = 0
+    meta.ttl = 0
+    meta.client_flags = 0
+    meta.key_len = 0
+    meta.opaque_len = 0
+
+
+cdef int meta_parse_num(const char *s, int n, size_t *num) noexcept nogil:
+    cdef int i
+    cdef size_t res = 0
+    cdef char zero = '0'
+
+    if n == 0 or n > MAX_META_NUM_DIGITS:
+        return -1
+
+    for i in range(n):
+        if not is_digit(s[i]):
+            return -1
+        res *= 10
+        res += s[i] - zero
+
+    num[0] = res
+    return 0
+
+
+cdef const char *meta_parse_token(ParserMeta *meta, char flag, const char *s, int n) noexcept nogil:
+    cdef size_t num
+
+    if flag == 'c':
+        if meta_parse_num(s, n, &num):
+            return 'invalid cas flag'
+        meta.cas = num
+        meta.flags |= ParserMetaFlag.PM_CAS
+
+    elif flag == 't':
+        if n == 2 and s[0] == '-' and s[1] == '1':
+            meta.ttl = -1
+        elif meta_parse_num(s, n, &num):
+            return 'invalid ttl flag'
+        else:
+            meta.ttl = <int>num
+        meta.flags |= ParserMetaFlag.PM_TTL
+
+    elif flag == 'f':
+        if meta_parse_num(s, n, &num):
+            return 'invalid client flags'
+        meta.client_flags = <unsigned int>num
+        meta.flags |= ParserMetaFlag.PM_CLIENT_FLAGS
+
+    elif flag == 'k':
+        if n > MAX_META_KEY_LEN:
+            return 'key flag is too long'
+        memcpy(meta.key, s, n)
+        meta.key_len = n
+        meta.flags |= ParserMetaFlag.PM_KEY
+
+    elif flag == 'O':
+        if n > MAX_META_OPAQUE_LEN:
+            return 'opaque flag is too long'
+        memcpy(meta.opaque, s, n)
+        meta.opaque_len = n
+        meta.flags |= ParserMetaFlag.PM_OPAQUE
+
+    elif flag == 'W':
+        meta.flags |= ParserMetaFlag.PM_WIN
+    elif flag == 'X':
+        meta.flags |= ParserMetaFlag.PM_STALE
+    elif flag == 'Z':
+        meta.flags |= ParserMetaFlag.PM_WON
+
+    # other flags are ignored
+    return NULL
+
+
+cdef const char *meta_parse(ParserMeta *meta, const char *pos, const char *end) noexcept nogil:
+    cdef const char *token_end
+    cdef const char *err
+
+    meta_reset(meta)
+
+    while pos < end:
+        if is_space(pos[0]):
+            pos += 1
+            continue
+
+        token_end = pos + 1
+        while token_end < end and not is_space(token_end[0]):
+            token_end += 1
+
+        err = meta_parse_token(meta, pos[0], pos + 1, token_end - pos - 1)
+        if err != NULL:
+            return err
+
+        pos = token_end
+
+    return NULL
+
+
 
 cdef int is_alphabet(char c) noexcept nogil:
     if c >= 'A' and c <= 'Z':
@@ -249,6 +418,10 @@ cdef int parser_append_tmp(Parser *p, char c) noexcept nogil:
     return 0
 
 
+cdef bytes version_prefix = b'VERSION'
+cdef int version_prefix_len = len(version_prefix)
+cdef const char *version_prefix_c = version_prefix
+
 cdef bytes version_suffix = b'RSION'
 cdef int version_suffix_len = len(version_suffix)
 cdef const char *version_suffix_c = version_suffix
@@ -362,6 +535,7 @@ cdef int parser_handle_loop(Parser *p) noexcept nogil:
     while p.data_len > 0 and p.current == ParserCmd.P_NO_CMD:
         ret = parser_handle_step(p)
         if ret:
+            p.stats.errors += 1
             return ret
 
     return 0
@@ -378,20 +552,313 @@ cdef ParserCmd parser_get_cmd(Parser *p, int *ret) noexcept nogil:
     ret[0] = parser_handle_loop(p)
     cdef ParserCmd cmd = p.current
     p.current = ParserCmd.P_NO_CMD
+    if cmd != ParserCmd.P_NO_CMD:
+        p.stats.responses[<int>cmd] += 1
     return cmd
 
 
+# ===================================
+# Batch Decoding
+# ===================================
+
+cdef int parser_batch_cmd(const char *line) noexcept nogil:
+    if memcmp(line, 'HD', 2) == 0:
+        return ParserCmd.P_CMD_HD
+    if memcmp(line, 'NS', 2) == 0:
+        return ParserCmd.P_CMD_NS
+    if memcmp(line, 'NF', 2) == 0:
+        return ParserCmd.P_CMD_NF
+    if memcmp(line, 'EN', 2) == 0:
+        return ParserCmd.P_CMD_EN
+    if memcmp(line, 'EX', 2) == 0:
+        return ParserCmd.P_CMD_EX
+    return ParserCmd.P_NO_CMD
+
+
+cdef int parser_batch_va(Parser *p, const char *base, const char *lf, ParserRecord *rec) noexcept nogil:
+    cdef const char *pos = p.data + 3
+    cdef const char *end = lf - 1
+    cdef int num = 0
+    cdef int digits = 0
+    cdef char zero = '0'
+    cdef int total
+
+    while pos < end and is_space(pos[0]):
+        pos += 1
+
+    while pos < end and is_digit(pos[0]):
+        num = num * 10 + (pos[0] - zero)
+        digits += 1
+        pos += 1
+
+    if digits == 0 or digits > MAX_VA_NUM_DIGITS:
+        return 0
+    if pos < end and not is_space(pos[0]):
+        return 0
+    if meta_parse(&rec.meta, pos, end) != NULL:
+        return 0
+
+    total = (lf + 1 - p.data) + num + 2
+    if total > p.data_len:
+        return 0
+    if p.data[total - 2] != '\r' or p.data[total - 1] != '\n':
+        return 0
+
+    rec.cmd = ParserCmd.P_CMD_MG
+    rec.data_offset = lf + 1 - base
+    rec.data_len = num
+
+    p.data += total
+    p.data_len -= total
+    return 1
+
+
+cdef int parser_batch_version(Parser *p, const char *lf, ParserRecord *rec) noexcept nogil:
+    cdef const char *pos = p.data + version_prefix_len
+    cdef const char *end = lf - 1
+    cdef int n
+
+    if pos < end and not is_space(pos[0]):
+        return 0
+
+    while pos < end and is_space(pos[0]):
+        pos += 1
+
+    n = end - pos
+    if n > TMP_DATA_MAX_LEN:
+        return 0
+
+    memcpy(p.tmp_data, pos, n)
+    p.tmp_data_len = n
+
+    rec.cmd = ParserCmd.P_CMD_VERSION
+
+    n = lf + 1 - p.data
+    p.data += n
+    p.data_len -= n
+    return 1
+
+
+cdef int parser_batch_line(Parser *p, const char *base, ParserRecord *rec) noexcept nogil:
+    # Decodes the complete response at the start of p.data using whole line scans.
+    # Returns 0 if the response is incomplete or not well formed,
+    # it is then handled by the byte by byte state machine instead.
+    cdef const char *lf = <const char *>memchr(p.data, '\n', p.data_len)
+    cdef int line_len
+    cdef int cmd
+
+    if lf == NULL:
+        return 0
+
+    line_len = lf - p.data
+    if line_len < 3 or lf[-1] != '\r':
+        return 0
+
+    rec.data_offset = -1
+    rec.data_len = 0
+    rec.response = NULL
+    meta_reset(&rec.meta)
+
+    if memcmp(p.data, 'VA ', 3) == 0:
+        return parser_batch_va(p, base, lf, rec)
+
+    if line_len > version_prefix_len and memcmp(p.data, version_prefix_c, version_prefix_len) == 0:
+        return parser_batch_version(p, lf, rec)
+
+    if p.data[2] != ' ' and p.data[2] != '\r':
+        return 0
+
+    cmd = parser_batch_cmd(p.data)
+    if cmd == ParserCmd.P_NO_CMD:
+        return 0
+    if meta_parse(&rec.meta, p.data + 2, lf - 1) != NULL:
+        return 0
+
+    rec.cmd = <ParserCmd>cmd
+
+    line_len += 1
+    p.data += line_len
+    p.data_len -= line_len
+    return 1
+
+
+cdef int parser_handle_batch(
+    Parser *p, const char *data, int n,
+    ParserRecord *records, int max_records, int *consumed,
+) noexcept nogil:
+    cdef int count = 0
+    cdef int ret
+    cdef int i
+    cdef ParserRecord *rec
+
+    p.data = data
+    p.data_len = n
+
+    while count < max_records and p.data_len > 0:
+        rec = &records[count]
+
+        if p.state == ParserState.P_INIT and parser_batch_line(p, data, rec):
+            count += 1
+            continue
+
+        ret = parser_handle_loop(p)
+        if ret:
+            for i in range(count):
+                parser_record_free(&records[i])
+            consumed[0] = n - p.data_len
+            return -1
+
+        if p.current == ParserCmd.P_NO_CMD:
+            break
+
+        rec.cmd = p.current
+        rec.data_offset = -1
+        rec.data_len = 0
+        rec.response = NULL
+        rec.meta = p.meta
+
+        if p.current == ParserCmd.P_CMD_MG:
+            rec.data_len = p.response_data_len
+            rec.response = p.response
+            p.response = NULL
+            p.response_data = NULL
+
+        p.current = ParserCmd.P_NO_CMD
+        count += 1
+
+    for i in range(count):
+        p.stats.responses[<int>records[i].cmd] += 1
+
+    consumed[0] = n - p.data_len
+    return count
+
+
+cdef bytes parser_record_data(const char *data, ParserRecord *rec) noexcept:
+    cdef bytes b
+
+    if rec.response != NULL:
+        b = <bytes>rec.response
+        Py_XDECREF(rec.response)
+        rec.response = NULL
+        return b
+
+    if rec.data_offset < 0:
+        return b''
+    return data[rec.data_offset:rec.data_offset + rec.data_len]
+
+
+cdef void parser_record_free(ParserRecord *rec) noexcept nogil:
+    if rec.response != NULL:
+        with gil:
+            Py_XDECREF(rec.response)
+        rec.response = NULL
+
+
+cdef int parser_frame_response(const char *data, int n, int *need) noexcept nogil:
+    # Length of the complete response at the start of data, without decoding it.
+    # Returns 0 if the response is incomplete and -1 if it is not well formed,
+    # need is set to the length of an incomplete response when it is already known.
+    cdef const char *lf = <const char *>memchr(data, '\n', n)
+    cdef const char *pos
+    cdef int num = 0
+    cdef int digits = 0
+    cdef char zero = '0'
+    cdef int total
+
+    need[0] = 0
+    if lf == NULL:
+        if n > MAX_RESPONSE_LINE_LEN:
+            return -1
+        return 0
+
+    if lf == data or lf[-1] != '\r':
+        return -1
+
+    total = lf + 1 - data
+    if total < 5 or memcmp(data, 'VA ', 3) != 0:
+        return total
+
+    pos = data + 3
+    while pos < lf and is_digit(pos[0]):
+        num = num * 10 + (pos[0] - zero)
+        digits += 1
+        pos += 1
+
+    if digits == 0 or digits > MAX_VA_NUM_DIGITS:
+        return -1
+
+    total += num + 2
+    if total > n:
+        need[0] = total
+        return 0
+    if data[total - 2] != '\r' or data[total - 1] != '\n':
+        return -1
+    return total
+
+
+cdef const ParserMeta *parser_get_meta(Parser *p) noexcept nogil:
+    return &p.meta
+
+
+cdef dict meta_to_dict(const ParserMeta *meta):
+    cdef dict d = {}
+
+    if meta.flags & ParserMetaFlag.PM_CAS:
+        d['cas'] = meta.cas
+    if meta.flags & ParserMetaFlag.PM_TTL:
+        d['ttl'] = meta.ttl
+    if meta.flags & ParserMetaFlag.PM_CLIENT_FLAGS:
+        d['client_flags'] = meta.client_flags
+    if meta.flags & ParserMetaFlag.PM_KEY:
+        d['key'] = meta.key[:meta.key_len]
+    if meta.flags & ParserMetaFlag.PM_OPAQUE:
+        d['opaque'] = meta.opaque[:meta.opaque_len]
+    if meta.flags & ParserMetaFlag.PM_WIN:
+        d['win'] = True
+    if meta.flags & ParserMetaFlag.PM_STALE:
+        d['stale'] = True
+    if meta.flags & ParserMetaFlag.PM_WON:
+        d['won'] = True
+
+    return d
+
+
+cdef const char *parser_last_error(Parser *p) noexcept nogil:
+    return p.last_error
+
+
+cdef const ParserStats *parser_get_stats(Parser *p) noexcept nogil:
+    return &p.stats
+
+
+cdef size_t parser_mem_size() noexcept nogil:
+    return sizeof(Parser)
+
+
+cdef tuple parser_cmd_names = (None, 'version', 'mg', 'hd', 'ns', 'ex', 'nf', 'en')
+
+
+cdef dict parser_stats_dict(const ParserStats *s):
+    cdef int i
+    cdef dict responses = {}
+
+    for i in range(1, PARSER_NUM_CMDS):
+        responses[parser_cmd_names[i]] = s.responses[i]
+    return {'responses': responses, 'parse_errors': s.errors}
+
+
 cdef bytes parser_get_string(Parser *p) noexcept:
     return p.tmp_data[:p.tmp_data_len]
 
 
 cdef bytes parser_get_data(Parser *p) noexcept:
-    cdef bytes b = p.response_data[:p.response_data_len]
-    return b
+    if p.response == NULL:
+        return b''
+    return <bytes>p.response
 
 
 cdef Parser *new_parser() noexcept nogil:
-    cdef Parser *p = <Parser *>alloc_object(sizeof(Parser))
+    cdef Parser *p = <Parser *>alloc_owned(sizeof(Parser), MemOwner.MEM_PARSER)
 
     p.state = ParserState.P_INIT
 
@@ -403,20 +870,25 @@ cdef Parser *new_parser() noexcept nogil:
 
     p.tmp_data_len = 0
 
+    p.response = NULL
     p.response_data = NULL
     p.response_data_len = 0
     p.response_index = 0
 
     p.wait_response = False
 
+    meta_reset(&p.meta)
+
     p.last_error = NULL
 
+    memset(&p.stats, 0, sizeof(ParserStats))
+
     return p
 
 
 cdef void parser_free(Parser *p) noexcept nogil:
     parser_free_response(p)
-    free_object(<void *>p, sizeof(Parser))
+    free_owned(<void *>p, sizeof(Parser), MemOwner.MEM_PARSER)
 
 
 cdef class ParserTest:
@@ -456,6 +928,43 @@ cdef class ParserTest:
                     raise ValueError(err_str)
         return cmd
     
+    def handle_batch(self, bytes data, int max_records = 64, bint with_meta = False):
+        cdef ParserRecord records[64]
+        cdef int count
+        cdef int consumed
+        cdef int i
+
+        cdef const char *data_ptr = data
+        cdef int data_len = len(data)
+
+        if max_records > 64:
+            max_records = 64
+
+        with nogil:
+            count = parser_handle_batch(self.p, data_ptr, data_len, records, max_records, &consumed)
+
+        if count < 0:
+            raise ValueError(self.p.last_error.decode())
+
+        result = []
+        for i in range(count):
+            if with_meta:
+                result.append((
+                    records[i].cmd, records[i].data_offset,
+                    parser_record_data(data_ptr, &records[i]), meta_to_dict(&records[i].meta),
+                ))
+            else:
+                result.append((records[i].cmd, records[i].data_offset, parser_record_data(data_ptr, &records[i])))
+        return result, consumed
+
+    def frame_response(self, bytes data):
+        cdef int need
+        cdef int ret = parser_frame_response(data, len(data), &need)
+        return ret, need
+
+    def get_meta(self):
+        return meta_to_dict(&self.p.meta)
+
     def get_string(self):
         return parser_get_string(self.p)
     
@@ -465,3 +974,6 @@ cdef class ParserTest:
     def get_data(self):
         cdef Parser *p = self.p
         return parser_get_data(p)
+
+    def stats(self):
+        return parser_stats_dict(parser_get_stats(self.p))
@@ -1,3 +1,10 @@
+from cpython.pythread cimport PyThread_type_lock, PyThread_allocate_lock, PyThread_free_lock
+from cpython.pythread cimport PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK, NOWAIT_LOCK
+
+from collections import deque
+import time
+
+
 cdef class ObjectPool:
     def __init__(self, int size):
         self.objects = []
@@ -25,4 +32,223 @@ cdef class ObjectPool:
         return self.objects
 
     def get_free_indices(self):
-        return self.free_indices
\ No newline at end of file
+        return self.free_indices
+
+cdef class PoolConn:
+    """
+    A connection checked out of a ConnectionPool, it is returned to the pool on release.
+    """
+    cdef readonly object client
+    cdef ConnectionPool pool
+    cdef int index # slot index in pool.slots
+    cdef int users
+    cdef double last_used
+
+    def __enter__(self):
+        return self.client
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        self.pool.release(self)
+
+
+cdef class ConnectionPool:
+    """
+    Connections to a single server.
+
+    checkout takes the most recently used idle connection, opens a new one
+    when there is none and the pool has less than max_size connections,
+    or else shares an open connection with other users in round robin,
+    the clients are safe to use from multiple pipelines at the same time.
+
+    Idle connections above min_size are closed after idle_timeout seconds,
+    they are reaped on checkout and release, or by calling reap.
+    A connection idle for more than probe_interval seconds is checked with
+    a version request before it is handed out again.
+
+    The pool is safe to use from multiple threads, its lock is held while
+    connecting but not while probing.
+    """
+    cdef object new_client
+    cdef object clock
+    cdef PyThread_type_lock lock
+
+    cdef int min_size
+    cdef int max_size
+    cdef double idle_timeout
+    cdef double probe_interval
+
+    cdef ObjectPool slots # open connections, the slots of closed ones are reused
+    cdef int size
+    cdef object idle # deque of idle connections, the least recently used on the left
+    cdef int next_shared
+
+    def __init__(
+        self, object new_client, int min_size = 1, int max_size = 8,
+        double idle_timeout = 60, double probe_interval = 5, object clock = time.monotonic,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('invalid pool size')
+
+        self.new_client = new_client
+        self.clock = clock
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.probe_interval = probe_interval
+
+        self.slots = ObjectPool(max_size)
+        self.size = 0
+        self.idle = deque()
+        self.next_shared = 0
+        self.lock = PyThread_allocate_lock()
+
+        self.fill()
+
+    def __dealloc__(self):
+        if self.lock != NULL:
+            PyThread_free_lock(self.lock)
+
+    cdef void acquire(self) noexcept:
+        if PyThread_acquire_lock(self.lock, NOWAIT_LOCK):
+            return
+        with nogil:
+            PyThread_acquire_lock(self.lock, WAIT_LOCK)
+
+    cdef void release_lock(self) noexcept:
+        PyThread_release_lock(self.lock)
+
+    cpdef fill(self):
+        """Opens connections until the pool has min_size of them."""
+        cdef PoolConn c
+        self.acquire()
+        try:
+            while self.size < self.min_size:
+                c = self.open()
+                c.last_used = self.clock()
+                self.idle.append(c)
+        finally:
+            self.release_lock()
+
+    cpdef PoolConn checkout(self):
+        cdef PoolConn c
+        cdef bint probe
+
+        while True:
+            self.acquire()
+            try:
+                self.reap_locked()
+                if len(self.idle) > 0:
+                    c = self.idle.pop()
+                    c.users = 1
+                    probe = self.clock() - c.last_used > self.probe_interval
+                elif self.size < self.max_size:
+                    c = self.open()
+                    c.users = 1
+                    return c
+                else:
+                    c = self.shared()
+                    c.users += 1
+                    return c
+            finally:
+                self.release_lock()
+
+            # the connection is checked out while it is probed without the lock,
+            # the callers sharing it meanwhile see it closed on release
+            if not probe or self.probe(c):
+                return c
+
+            self.acquire()
+            c.users -= 1
+            self.close(c)
+            self.release_lock()
+
+    cpdef release(self, PoolConn c):
+        self.acquire()
+        try:
+            if c.users <= 0:
+                raise ValueError('connection is not checked out')
+
+            c.users -= 1
+            if c.index < 0:
+                return
+
+            if c.client.error is not None:
+                self.close(c)
+                return
+
+            if c.users == 0:
+                c.last_used = self.clock()
+                self.idle.append(c)
+            self.reap_locked()
+        finally:
+            self.release_lock()
+
+    cpdef reap(self):
+        """Closes the connections above min_size that are idle for more than idle_timeout."""
+        self.acquire()
+        try:
+            self.reap_locked()
+        finally:
+            self.release_lock()
+
+    cdef void reap_locked(self) except *:
+        cdef PoolConn c
+        cdef double now = self.clock()
+
+        while len(self.idle) > 0 and self.size > self.min_size:
+            c = self.idle[0]
+            if now - c.last_used <= self.idle_timeout:
+                return
+            self.idle.popleft()
+            self.close(c)
+
+    cdef PoolConn open(self):
+        # the lock must be held
+        cdef PoolConn c = PoolConn()
+        c.client = self.new_client()
+        c.pool = self
+        c.users = 0
+        c.last_used = 0
+        c.index = self.slots.put(c)
+        self.size += 1
+        return c
+
+    cdef void close(self, PoolConn c) except *:
+        # the lock must be held
+        self.slots.free(c.index)
+        c.index = -1
+        self.size -= 1
+
+    cdef PoolConn shared(self):
+        cdef PoolConn c
+        cdef list objects = self.slots.objects
+        cdef int n = len(objects)
+        cdef int i
+
+        for i in range(n):
+            c = objects[(self.next_shared + i) % n]
+            if c is not None:
+                self.next_shared = (self.next_shared + i + 1) % n
+                return c
+
+        raise ConnectionError('connection pool is empty')
+
+    cdef bint probe(self, PoolConn c) except *:
+        try:
+            c.client.pipeline().version().result()
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        self.acquire()
+        try:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+            }
+        finally:
+            self.release_lock()
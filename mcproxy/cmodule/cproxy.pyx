@@ -0,0 +1,255 @@
+from libc.string cimport memchr, memcmp
+
+from cparser cimport parser_frame_response
+
+
+DEF MAX_REQUEST_LINE_LEN = 2048
+DEF MAX_KEY_LEN = 250
+DEF MAX_DATA_NUM_DIGITS = 9
+
+
+cdef enum RequestCmd:
+    RC_OTHER = 0
+    RC_MG = 1
+    RC_MS = 2
+    RC_MD = 3
+    RC_MN = 4
+    RC_VERSION = 5
+    RC_QUIT = 6
+    RC_INVALID = 7
+
+
+# exported for the python side of the proxy
+CMD_OTHER = RC_OTHER
+CMD_MG = RC_MG
+CMD_MS = RC_MS
+CMD_MD = RC_MD
+CMD_MN = RC_MN
+CMD_VERSION = RC_VERSION
+CMD_QUIT = RC_QUIT
+CMD_INVALID = RC_INVALID
+
+
+cdef struct RequestFrame:
+    RequestCmd cmd
+    int length # the request line and the data block of ms
+    int key_offset
+    int key_len
+    int quiet_offset # offset of the space before the q flag, -1 if absent
+
+
+cdef const char *skip_spaces(const char *pos, const char *end) noexcept nogil:
+    while pos < end and pos[0] == ' ':
+        pos += 1
+    return pos
+
+
+cdef const char *token_end(const char *pos, const char *end) noexcept nogil:
+    while pos < end and pos[0] != ' ':
+        pos += 1
+    return pos
+
+
+cdef RequestCmd request_cmd(const char *s, int n) noexcept nogil:
+    if n == 2:
+        if memcmp(s, 'mg', 2) == 0:
+            return RequestCmd.RC_MG
+        if memcmp(s, 'ms', 2) == 0:
+            return RequestCmd.RC_MS
+        if memcmp(s, 'md', 2) == 0:
+            return RequestCmd.RC_MD
+        if memcmp(s, 'mn', 2) == 0:
+            return RequestCmd.RC_MN
+    elif n == 7 and memcmp(s, 'version', 7) == 0:
+        return RequestCmd.RC_VERSION
+    elif n == 4 and memcmp(s, 'quit', 4) == 0:
+        return RequestCmd.RC_QUIT
+    return RequestCmd.RC_OTHER
+
+
+cdef int frame_request(const char *data, int n, RequestFrame *f) noexcept nogil:
+    # Finds the complete request at the start of data.
+    # Returns 1 if found, 0 if incomplete and -1 if it is not well formed,
+    # f.length is set for an incomplete ms request whose length is already known.
+    cdef const char *lf = <const char *>memchr(data, '\n', n)
+    cdef const char *end
+    cdef const char *pos
+    cdef const char *tok
+    cdef int num = 0
+    cdef int digits = 0
+    cdef char zero = '0'
+
+    f.cmd = RequestCmd.RC_OTHER
+    f.length = 0
+    f.key_offset = 0
+    f.key_len = 0
+    f.quiet_offset = -1
+
+    if lf == NULL:
+        if n > MAX_REQUEST_LINE_LEN:
+            return -1
+        return 0
+
+    end = lf
+    if end > data and end[-1] == '\r':
+        end -= 1
+
+    pos = skip_spaces(data, end)
+    tok = token_end(pos, end)
+    f.cmd = request_cmd(pos, tok - pos)
+    f.length = lf + 1 - data
+
+    if f.cmd != RequestCmd.RC_MG and f.cmd != RequestCmd.RC_MS and f.cmd != RequestCmd.RC_MD:
+        return 1
+
+    pos = skip_spaces(tok, end)
+    tok = token_end(pos, end)
+    if tok == pos or tok - pos > MAX_KEY_LEN:
+        return -1
+    f.key_offset = pos - data
+    f.key_len = tok - pos
+
+    if f.cmd == RequestCmd.RC_MS:
+        pos = skip_spaces(tok, end)
+        while pos < end and b'0' <= pos[0] <= b'9':
+            num = num * 10 + (pos[0] - zero)
+            digits += 1
+            pos += 1
+        if digits == 0 or digits > MAX_DATA_NUM_DIGITS:
+            return -1
+        tok = pos
+
+    while tok < end:
+        pos = skip_spaces(tok, end)
+        tok = token_end(pos, end)
+        if tok - pos == 1 and pos[0] == 'q':
+            f.quiet_offset = pos - 1 - data
+
+    if f.cmd == RequestCmd.RC_MS:
+        f.length += num + 2
+        if f.length > n:
+            return 0
+        if data[f.length - 2] != '\r' or data[f.length - 1] != '\n':
+            return -1
+    return 1
+
+
+cdef class StreamReader:
+    # keeps the incomplete bytes at the end of the fed data,
+    # a big incomplete message is joined only once all of it is received
+    cdef list chunks
+    cdef int size
+    cdef int need
+
+    def __cinit__(self):
+        self.chunks = []
+        self.size = 0
+        self.need = 0
+
+    cdef bytes take(self, bytes data):
+        # returns the data to be framed or None if more data is needed
+        if len(self.chunks) == 0:
+            return data
+
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size < self.need:
+            return None
+
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.need = 0
+        return data
+
+    cdef void keep(self, bytes data, int offset, int need):
+        if offset < len(data):
+            self.chunks.append(data[offset:])
+            self.size = len(data) - offset
+            self.need = need
+
+
+cdef class RequestReader(StreamReader):
+    """
+    Splits the data of a client connection into requests.
+    A quiet request is returned without its q flag, so that it always gets a response.
+    """
+
+    def feed(self, bytes data):
+        """
+        Returns a list of (cmd, key, request, quiet), key is None for commands without key.
+        A request that is not well formed ends the list with (CMD_INVALID, None, None, False),
+        the connection can not be used after it.
+        """
+        cdef const char *ptr
+        cdef int n
+        cdef int offset = 0
+        cdef int ret
+        cdef int need = 0
+        cdef RequestFrame f
+        cdef list result = []
+        cdef object key
+        cdef bytes req
+
+        data = self.take(data)
+        if data is None:
+            return result
+
+        ptr = data
+        n = len(data)
+
+        while offset < n:
+            ret = frame_request(ptr + offset, n - offset, &f)
+            if ret == 0:
+                need = f.length
+                break
+            if ret < 0:
+                result.append((RequestCmd.RC_INVALID, None, None, False))
+                return result
+
+            key = None
+            if f.key_len > 0:
+                key = ptr[offset + f.key_offset:offset + f.key_offset + f.key_len]
+
+            if f.quiet_offset >= 0:
+                req = ptr[offset:offset + f.quiet_offset] + ptr[offset + f.quiet_offset + 2:offset + f.length]
+            else:
+                req = ptr[offset:offset + f.length]
+
+            result.append((f.cmd, key, req, f.quiet_offset >= 0))
+            offset += f.length
+
+        self.keep(data, offset, need)
+        return result
+
+
+cdef class ResponseReader(StreamReader):
+    """Splits the data of a memcached connection into responses, without decoding them."""
+
+    def feed(self, bytes data):
+        cdef const char *ptr
+        cdef int n
+        cdef int offset = 0
+        cdef int ret
+        cdef int need = 0
+        cdef list result = []
+
+        data = self.take(data)
+        if data is None:
+            return result
+
+        ptr = data
+        n = len(data)
+
+        while offset < n:
+            ret = parser_frame_response(ptr + offset, n - offset, &need)
+            if ret == 0:
+                break
+            if ret < 0:
+                raise ValueError('invalid response from server')
+
+            result.append(ptr[offset:offset + ret])
+            offset += ret
+
+        self.keep(data, offset, need)
+        return result
@@ -0,0 +1,21 @@
+from libc.stdint cimport uint32_t
+
+
+cdef struct RingPoint:
+    uint32_t hash
+    int node # index of the node in HashRing.nodes
+
+
+cdef class HashRing:
+    cdef readonly list nodes
+    cdef RingPoint *points # owning, sorted by hash
+    cdef int num_points
+
+    cpdef int get_node(self, object key) except -1
+
+    cpdef list get_nodes(self, object key, int count)
+
+
+cdef uint32_t ketama_hash(const unsigned char *digest, int h) noexcept nogil
+
+cdef int ring_find(const RingPoint *points, int n, uint32_t h) noexcept nogil
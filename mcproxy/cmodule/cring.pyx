@@ -0,0 +1,105 @@
+from libc.stdint cimport uint32_t
+
+from cutil cimport MemOwner, alloc_owned, free_owned
+
+from hashlib import md5
+
+
+cdef uint32_t ketama_hash(const unsigned char *digest, int h) noexcept nogil:
+    cdef int i = h * 4
+    return (
+        (<uint32_t>digest[i + 3] << 24) | (<uint32_t>digest[i + 2] << 16) |
+        (<uint32_t>digest[i + 1] << 8) | <uint32_t>digest[i]
+    )
+
+
+cdef int ring_find(const RingPoint *points, int n, uint32_t h) noexcept nogil:
+    # index of the first point with hash >= h, wraps around to the first point
+    cdef int lo = 0
+    cdef int hi = n
+    cdef int mid
+
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if points[mid].hash < h:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    if lo == n:
+        return 0
+    return lo
+
+
+cdef class HashRing:
+    """
+    Ketama consistent hashing, compatible with the libmemcached ketama distribution.
+    Each node is placed at points_per_node points on the ring, a key belongs
+    to the node of the first point clockwise from the md5 hash of the key.
+    """
+
+    def __cinit__(self, list nodes, int points_per_node = 160):
+        cdef list points = []
+        cdef bytes digest
+        cdef int node
+        cdef int i
+        cdef int h
+
+        if len(nodes) == 0:
+            raise ValueError('ring must have at least one node')
+        if points_per_node < 4 or points_per_node % 4 != 0:
+            raise ValueError('points_per_node must be a positive multiple of 4')
+
+        self.nodes = list(nodes)
+
+        for node, name in enumerate(self.nodes):
+            for i in range(points_per_node // 4):
+                digest = md5(f'{name}-{i}'.encode()).digest()
+                for h in range(4):
+                    points.append((ketama_hash(digest, h), node))
+        points.sort()
+
+        self.num_points = len(points)
+        self.points = <RingPoint *>alloc_owned(self.num_points * sizeof(RingPoint), MemOwner.MEM_RING)
+        for i in range(self.num_points):
+            self.points[i].hash = points[i][0]
+            self.points[i].node = points[i][1]
+
+    def __dealloc__(self):
+        if self.points != NULL:
+            free_owned(self.points, self.num_points * sizeof(RingPoint), MemOwner.MEM_RING)
+
+    cpdef int get_node(self, object key) except -1:
+        """Returns the index of the node of key in nodes."""
+        cdef bytes digest = md5(key).digest()
+        cdef uint32_t h = ketama_hash(digest, 0)
+        return self.points[ring_find(self.points, self.num_points, h)].node
+
+    cpdef list get_nodes(self, object key, int count):
+        """
+        Returns the indexes of up to count distinct nodes of key, starting with
+        its node and continuing clockwise, the replicas of key in that order.
+        """
+        cdef bytes digest = md5(key).digest()
+        cdef uint32_t h = ketama_hash(digest, 0)
+        cdef int start = ring_find(self.points, self.num_points, h)
+        cdef list result = []
+        cdef int node
+        cdef int i
+
+        if count > len(self.nodes):
+            count = len(self.nodes)
+
+        for i in range(self.num_points):
+            node = self.points[(start + i) % self.num_points].node
+            if node not in result:
+                result.append(node)
+                if len(result) == count:
+                    break
+        return result
+
+    def get_node_name(self, object key):
+        return self.nodes[self.get_node(key)]
+
+    def __len__(self):
+        return self.num_points
@@ -0,0 +1,24 @@
+from libc.stdint cimport uint8_t, uint64_t
+
+
+cdef enum:
+    SKETCH_DEPTH = 4
+    SKETCH_MAX_COUNT = 15
+
+
+# Count-min sketch of small saturating counters, all counters are halved
+# after sample_size additions so that old frequencies fade out.
+cdef struct CountMinSketch:
+    uint8_t *counters # owning, SKETCH_DEPTH rows of width counters
+    uint64_t mask # width - 1, width is a power of two
+    size_t additions
+    size_t sample_size
+
+
+cdef void sketch_init(CountMinSketch *s, size_t min_width) noexcept nogil
+
+cdef void sketch_free(CountMinSketch *s) noexcept nogil
+
+cdef void sketch_add(CountMinSketch *s, uint64_t h) noexcept nogil
+
+cdef int sketch_estimate(const CountMinSketch *s, uint64_t h) noexcept nogil
@@ -0,0 +1,89 @@
+from libc.stdint cimport uint8_t, uint64_t
+from libc.string cimport memset
+
+from cutil cimport MemOwner, alloc_owned, free_owned
+
+
+cdef uint64_t[SKETCH_DEPTH] row_seeds = [
+    0x9e3779b97f4a7c15ULL, 0xbf58476d1ce4e5b9ULL, 0x94d049bb133111ebULL, 0xd6e8feb86659fd93ULL,
+]
+
+
+cdef inline uint64_t mix64(uint64_t x) noexcept nogil:
+    # splitmix64 finalizer
+    x ^= x >> 30
+    x *= 0xbf58476d1ce4e5b9ULL
+    x ^= x >> 27
+    x *= 0x94d049bb133111ebULL
+    x ^= x >> 31
+    return x
+
+
+cdef void sketch_init(CountMinSketch *s, size_t min_width) noexcept nogil:
+    cdef size_t width = 16
+    while width < min_width:
+        width <<= 1
+
+    s.counters = <uint8_t *>alloc_owned(SKETCH_DEPTH * width, MemOwner.MEM_SKETCH)
+    memset(s.counters, 0, SKETCH_DEPTH * width)
+    s.mask = width - 1
+    s.additions = 0
+    s.sample_size = 10 * width
+
+
+cdef void sketch_free(CountMinSketch *s) noexcept nogil:
+    if s.counters != NULL:
+        free_owned(s.counters, SKETCH_DEPTH * (s.mask + 1), MemOwner.MEM_SKETCH)
+        s.counters = NULL
+
+
+cdef void sketch_halve(CountMinSketch *s) noexcept nogil:
+    cdef size_t i
+    for i in range(SKETCH_DEPTH * (s.mask + 1)):
+        s.counters[i] >>= 1
+    s.additions //= 2
+
+
+cdef void sketch_add(CountMinSketch *s, uint64_t h) noexcept nogil:
+    cdef uint8_t *c
+    cdef int i
+
+    for i in range(SKETCH_DEPTH):
+        c = &s.counters[i * (s.mask + 1) + (mix64(h ^ row_seeds[i]) & s.mask)]
+        if c[0] < SKETCH_MAX_COUNT:
+            c[0] += 1
+
+    s.additions += 1
+    if s.additions >= s.sample_size:
+        sketch_halve(s)
+
+
+cdef int sketch_estimate(const CountMinSketch *s, uint64_t h) noexcept nogil:
+    cdef int result = SKETCH_MAX_COUNT
+    cdef int v
+    cdef int i
+
+    for i in range(SKETCH_DEPTH):
+        v = s.counters[i * (s.mask + 1) + (mix64(h ^ row_seeds[i]) & s.mask)]
+        if v < result:
+            result = v
+    return result
+
+
+cdef class SketchTest:
+    cdef CountMinSketch s
+
+    def __cinit__(self, size_t min_width):
+        sketch_init(&self.s, min_width)
+
+    def __dealloc__(self):
+        sketch_free(&self.s)
+
+    def add(self, object key):
+        sketch_add(&self.s, <uint64_t>hash(key))
+
+    def estimate(self, object key):
+        return sketch_estimate(&self.s, <uint64_t>hash(key))
+
+    def width(self):
+        return self.s.mask + 1
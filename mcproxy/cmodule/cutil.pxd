@@ -1,12 +1,42 @@
+cdef enum MemOwner:
+    MEM_OTHER = 0
+    MEM_PARSER # parser states
+    MEM_BUILDER # request buffers
+    MEM_CLIENT # read buffers of the clients
+    MEM_CACHE # values of the near caches
+    MEM_SKETCH # count-min sketch counters
+    MEM_RING # hash ring points
+
+cdef enum:
+    MEM_NUM_OWNERS = 7 # number of MemOwner values
+
+
 cdef void *alloc_object(size_t n) noexcept nogil
 
 
 cdef void free_object(void *ptr, size_t n) noexcept nogil
 
 
+# Same as alloc_object and free_object, also accounted to owner in py_get_mem_stats.
+# Small blocks are recycled by a slab allocator, n must be the same for both calls.
+cdef void *alloc_owned(size_t n, MemOwner owner) noexcept nogil
+
+
+cdef void free_owned(void *ptr, size_t n, MemOwner owner) noexcept nogil
+
+
+cdef void slab_trim() noexcept nogil
+
+
 cdef int bytes_equal(const char *a, int a_len, const char *b, int b_len) noexcept nogil
 
 
+# Seconds of a monotonic clock, comparable with time.monotonic.
+cdef double monotonic_now() noexcept nogil
+
+cdef void sleep_seconds(double seconds) noexcept nogil
+
+
 # ===================================
 # Shared Pointer
 # ===================================
@@ -38,6 +68,7 @@ cdef void make_shared(SharedPtr *ptr, void *obj, RefCounter *ref, destroy_func d
 
 cdef void ptr_clone(SharedPtr *new_ptr, const SharedPtr *ptr) noexcept nogil
 
+# returns NULL for an invalid pointer, the misuses of the pointers are counted, see py_get_ptr_errors
 cdef void *ptr_get(const SharedPtr *ptr) noexcept nogil
 
 cdef void ptr_free(SharedPtr *ptr) noexcept nogil
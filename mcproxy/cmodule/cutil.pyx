@@ -1,21 +1,210 @@
-from libc.stdlib cimport malloc, free, exit
+from libc.stdlib cimport malloc, free
 from libc.string cimport memset
+from posix.time cimport clock_gettime, nanosleep, timespec, CLOCK_MONOTONIC
+from cpython.pythread cimport PyThread_type_lock, PyThread_allocate_lock
+from cpython.pythread cimport PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK
+
+import os
 
 
 cdef unsigned int global_current_mem = 0
 
+cdef size_t global_owner_mem[MEM_NUM_OWNERS]
+memset(global_owner_mem, 0, sizeof(global_owner_mem))
 
-cdef void *alloc_object(size_t n) noexcept nogil:
+cdef dict mem_owner_names = {
+    MemOwner.MEM_OTHER: 'other',
+    MemOwner.MEM_PARSER: 'parser',
+    MemOwner.MEM_BUILDER: 'builder',
+    MemOwner.MEM_CLIENT: 'client',
+    MemOwner.MEM_CACHE: 'cache',
+    MemOwner.MEM_SKETCH: 'sketch',
+    MemOwner.MEM_RING: 'ring',
+}
+
+
+# ===================================
+# Slab Allocator
+# ===================================
+
+# Blocks of up to SLAB_MAX_SIZE bytes are rounded up to a size class,
+# the classes are the powers of two and their midpoints: 32, 48, 64, 96, ...
+# A freed block is kept in the free list of its class, up to SLAB_CLASS_CACHE_BYTES
+# bytes per class, and reused by the next allocation of the same class.
+DEF SLAB_MIN_SIZE = 32
+DEF SLAB_MAX_SIZE = 65536
+DEF SLAB_NUM_CLASSES = 23
+DEF SLAB_CLASS_CACHE_BYTES = 1048576
+
+
+cdef struct SlabBlock:
+    SlabBlock *next
+
+
+cdef struct SlabClass:
+    size_t size
+    SlabBlock *head
+    size_t count
+    size_t max_count
+
+
+cdef struct SlabStats:
+    size_t hits
+    size_t misses
+    size_t cached_bytes
+
+
+cdef SlabClass slab_classes[SLAB_NUM_CLASSES]
+cdef SlabStats slab_stats
+cdef bint slab_zero_on_free = False
+
+# allocations may happen without the GIL from multiple threads
+cdef PyThread_type_lock mem_lock = PyThread_allocate_lock()
+
+
+cdef void slab_init() noexcept nogil:
+    cdef int i
+    cdef size_t size = SLAB_MIN_SIZE
+
+    for i in range(SLAB_NUM_CLASSES):
+        if i % 2 == 0:
+            slab_classes[i].size = size
+        else:
+            slab_classes[i].size = size + size // 2
+            size *= 2
+        slab_classes[i].head = NULL
+        slab_classes[i].count = 0
+        slab_classes[i].max_count = max(4, SLAB_CLASS_CACHE_BYTES // slab_classes[i].size)
+
+    memset(&slab_stats, 0, sizeof(SlabStats))
+
+
+slab_init()
+
+
+cdef int slab_class_index(size_t n) noexcept nogil:
+    # -1 for the sizes not handled by the slab allocator
+    cdef int i
+
+    if n == 0 or n > SLAB_MAX_SIZE:
+        return -1
+    for i in range(SLAB_NUM_CLASSES):
+        if n <= slab_classes[i].size:
+            return i
+    return -1
+
+
+cdef void *alloc_owned(size_t n, MemOwner owner) noexcept nogil:
     global global_current_mem
+    cdef int index = slab_class_index(n)
+    cdef SlabClass *c
+    cdef SlabBlock *block = NULL
+
+    PyThread_acquire_lock(mem_lock, WAIT_LOCK)
+
     global_current_mem += n
+    global_owner_mem[<int>owner] += n
+
+    if index >= 0:
+        c = &slab_classes[index]
+        block = c.head
+        if block != NULL:
+            c.head = block.next
+            c.count -= 1
+            slab_stats.hits += 1
+            slab_stats.cached_bytes -= c.size
+        else:
+            slab_stats.misses += 1
+
+    PyThread_release_lock(mem_lock)
+
+    if block != NULL:
+        return block
+    if index >= 0:
+        return malloc(slab_classes[index].size)
     return malloc(n)
 
 
-cdef void free_object(void *ptr, size_t n) noexcept nogil:
+cdef void free_owned(void *ptr, size_t n, MemOwner owner) noexcept nogil:
     global global_current_mem
+    cdef int index = slab_class_index(n)
+    cdef SlabClass *c
+    cdef SlabBlock *block
+
+    if slab_zero_on_free:
+        memset(ptr, 0, n)
+
+    PyThread_acquire_lock(mem_lock, WAIT_LOCK)
+
     global_current_mem -= n
-    memset(ptr, 0, n)
-    free(ptr)
+    global_owner_mem[<int>owner] -= n
+
+    if index >= 0:
+        c = &slab_classes[index]
+        if c.count < c.max_count:
+            block = <SlabBlock *>ptr
+            block.next = c.head
+            c.head = block
+            c.count += 1
+            slab_stats.cached_bytes += c.size
+            ptr = NULL
+
+    PyThread_release_lock(mem_lock)
+
+    if ptr != NULL:
+        free(ptr)
+
+
+cdef void slab_trim() noexcept nogil:
+    cdef int i
+    cdef SlabBlock *block
+    cdef SlabBlock *next_block
+
+    PyThread_acquire_lock(mem_lock, WAIT_LOCK)
+    for i in range(SLAB_NUM_CLASSES):
+        block = slab_classes[i].head
+        while block != NULL:
+            next_block = block.next
+            free(block)
+            block = next_block
+        slab_classes[i].head = NULL
+        slab_classes[i].count = 0
+    slab_stats.cached_bytes = 0
+    PyThread_release_lock(mem_lock)
+
+
+def py_slab_trim():
+    """Releases the free blocks kept by the slab allocator."""
+    slab_trim()
+
+
+def py_get_slab_stats():
+    """Allocations served from the free lists (hits) or by malloc (misses), and the bytes kept in them."""
+    return {
+        'hits': slab_stats.hits,
+        'misses': slab_stats.misses,
+        'cached_bytes': slab_stats.cached_bytes,
+    }
+
+
+def py_set_zero_on_free(bint enabled):
+    """
+    Zeroes every block when it is freed, so that a use after free reads zeros.
+    Off by default, enabled at import when MCPROXY_ZERO_ON_FREE is set to 1.
+    """
+    global slab_zero_on_free
+    slab_zero_on_free = enabled
+
+
+py_set_zero_on_free(os.environ.get('MCPROXY_ZERO_ON_FREE') == '1')
+
+
+cdef void *alloc_object(size_t n) noexcept nogil:
+    return alloc_owned(n, MemOwner.MEM_OTHER)
+
+
+cdef void free_object(void *ptr, size_t n) noexcept nogil:
+    free_owned(ptr, n, MemOwner.MEM_OTHER)
 
 
 def py_get_mem():
@@ -23,6 +212,16 @@ def py_get_mem():
     return global_current_mem
 
 
+def py_get_mem_stats():
+    """Bytes currently allocated, in total and by owner."""
+    cdef int i
+    cdef dict result = {'total': global_current_mem}
+
+    for i in range(MEM_NUM_OWNERS):
+        result[mem_owner_names[i]] = global_owner_mem[i]
+    return result
+
+
 cdef int bytes_equal(const char *a, int a_len, const char *b, int b_len) noexcept nogil:
     cdef int i
 
@@ -35,10 +234,34 @@ cdef int bytes_equal(const char *a, int a_len, const char *b, int b_len) noexcep
     return True
 
 
+cdef double monotonic_now() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+cdef void sleep_seconds(double seconds) noexcept nogil:
+    cdef timespec ts
+    if seconds <= 0:
+        return
+    ts.tv_sec = <long>seconds
+    ts.tv_nsec = <long>((seconds - ts.tv_sec) * 1e9)
+    nanosleep(&ts, NULL)
+
+
 # ===================================
 # Shared Pointer
 # ===================================
 
+# misuses of the shared pointers, which are ignored instead of aborting the process
+cdef size_t ptr_errors = 0
+
+
+def py_get_ptr_errors():
+    """Number of invalid or double frees and of gets on invalid pointers."""
+    return ptr_errors
+
+
 cdef void make_shared(
     SharedPtr *ptr, void *obj, RefCounter *ref,
     destroy_func destroy_fn, free_func free_fn,
@@ -55,10 +278,11 @@ cdef void make_shared(
 
 
 cdef void *ptr_get(const SharedPtr *ptr) noexcept nogil:
+    global ptr_errors
     if <void *>ptr != ptr.__self_ptr:
-        with gil:
-            print('[ERROR] ptr_get on invalid pointer')
-        exit(-1)
+        # a copied pointer, the caller fails the operation
+        ptr_errors += 1
+        return NULL
 
     return ptr.__obj
 
@@ -71,26 +295,31 @@ cdef void ptr_clone(SharedPtr *new_ptr, const SharedPtr *ptr) noexcept nogil:
 
 
 cdef void ptr_free(SharedPtr *ptr) noexcept nogil:
+    global ptr_errors
+    cdef void *obj = ptr.__obj
+    cdef RefCounter *ref = ptr.__ref
+
     if <void *>ptr != ptr.__self_ptr:
-        with gil:
-            print('[ERROR] ptr_free on invalid pointer')
-        exit(-1)
+        ptr_errors += 1
+        return
     
-    if ptr.__obj == NULL:
+    if obj == NULL:
         return
 
-    if ptr.__ref.__count == 0:
-        with gil:
-            print('[ERROR] double free shared pointer')
-        exit(-1)
-    
-    ptr.__ref.__count -= 1
+    if ref.__count == 0:
+        # double free, the object is already destroyed
+        ptr_errors += 1
+        return
 
-    if ptr.__ref.__count == 0:
-        ptr.__ref.__destroy_fn(ptr.__obj)
+    # a second free of the same pointer does nothing
+    ptr.__obj = NULL
+    ref.__count -= 1
 
-        if ptr.__ref.__weak_count == 0:
-            ptr.__ref.__free_fn(ptr.__obj)
+    if ref.__count == 0:
+        ref.__destroy_fn(obj)
+
+        if ref.__weak_count == 0:
+            ref.__free_fn(obj)
 
 
 cdef void make_weak_ptr(WeakPtr *new_ptr, const SharedPtr *ptr) noexcept nogil:
@@ -113,15 +342,14 @@ cdef void weak_ptr_clone(SharedPtr *new_ptr, const WeakPtr *ptr) noexcept nogil:
 
 
 cdef void weak_ptr_free(WeakPtr *ptr) noexcept nogil:
+    global ptr_errors
     if <void *>ptr != ptr.__self_ptr:
-        with gil:
-            print('[ERROR] weak_ptr_free on invalid weak pointer')
-        exit(-1)
+        ptr_errors += 1
+        return
     
     if ptr.__ref.__weak_count == 0:
-        with gil:
-            print('[ERROR] double free on weak pointer')
-        exit(-1)
+        ptr_errors += 1
+        return
 
     ptr.__ref.__weak_count -= 1
     if ptr.__ref.__count == 0 and ptr.__ref.__weak_count == 0:
@@ -181,5 +409,10 @@ cdef class TestContainer:
         cdef TestData *d = <TestData *>ptr_get(&self.new_ptr)
         return d.age
 
+    def get_copied(self):
+        # a copy of the pointer struct is invalid, returns whether it was rejected
+        cdef SharedPtr copied = self.ptr
+        return ptr_get(&copied) == NULL
+
     def destroy(self):
         ptr_free(&self.ptr)
@@ -0,0 +1,362 @@
+"""
+An in-memory stand-in for memcached speaking the meta protocol, for running the
+client end to end where no memcached is available:
+
+    python -m mcproxy.fakeserver --port 11211 --latency-ms 0.5 --jitter-ms 0.2 --bandwidth-mbps 100
+
+Responses can be delayed by a fixed latency plus a random jitter, and the response
+stream of each connection can be capped to a bandwidth. Responses are always sent
+in request order. Only the commands and flags used by this library are implemented.
+"""
+import argparse
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import cproxy  # type: ignore
+
+_ERROR = b'ERROR\r\n'
+_CLIENT_ERROR = b'CLIENT_ERROR bad command line format\r\n'
+
+
+class _Item:
+    __slots__ = ('value', 'client_flags', 'expire', 'cas', 'stale', 'win_sent')
+
+    def __init__(self, value: bytes, client_flags: int, expire: float, cas: int):
+        self.value = value
+        self.client_flags = client_flags
+        self.expire = expire  # 0 when the item does not expire
+        self.cas = cas
+        self.stale = False
+        self.win_sent = False
+
+
+def _num_flags(tokens: List[bytes]) -> Dict[bytes, int]:
+    return {t[:1]: int(t[1:]) for t in tokens if len(t) > 1 and t[:1] in b'CNTF'}
+
+
+class FakeStore:
+    """
+    The items of a stand-in server, shared by all its connections.
+    Expiration uses clock, which is time.monotonic by default.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._items: Dict[bytes, _Item] = {}
+        self._clock = clock
+        self._cas = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _next_cas(self) -> int:
+        self._cas += 1
+        return self._cas
+
+    def _expire_at(self, ttl: int) -> float:
+        return self._clock() + ttl if ttl > 0 else 0
+
+    def _get(self, key: bytes) -> Optional[_Item]:
+        it = self._items.get(key)
+        if it is not None and it.expire and it.expire <= self._clock():
+            del self._items[key]
+            return None
+        return it
+
+    def _ret_flags(self, key: bytes, tokens: List[bytes], it: _Item) -> List[bytes]:
+        out = []
+        for t in tokens:
+            c = t[:1]
+            if c == b'c':
+                out.append(b'c%d' % it.cas)
+            elif c == b't':
+                out.append(b't%d' % (math.ceil(it.expire - self._clock()) if it.expire else -1))
+            elif c == b'f':
+                out.append(b'f%d' % it.client_flags)
+            elif c == b's':
+                out.append(b's%d' % len(it.value))
+            elif c == b'k':
+                out.append(b'k' + key)
+            elif c == b'O':
+                out.append(t)
+        return out
+
+    def meta_get(self, key: bytes, tokens: List[bytes]) -> bytes:
+        it = self._get(key)
+        lease = []
+
+        if it is None:
+            vivify = _num_flags(tokens).get(b'N')
+            if vivify is None:
+                return b' '.join([b'EN'] + [t for t in tokens if t[:1] == b'O']) + b'\r\n'
+
+            # the first caller of a missing key wins the lease of an empty placeholder
+            it = _Item(b'', 0, self._expire_at(vivify), self._next_cas())
+            it.win_sent = True
+            self._items[key] = it
+            lease.append(b'W')
+        elif it.stale:
+            lease.append(b'X')
+            lease.append(b'Z' if it.win_sent else b'W')
+            it.win_sent = True
+        elif it.win_sent:
+            lease.append(b'Z')
+
+        flags = self._ret_flags(key, tokens, it) + lease
+        if b'v' in tokens:
+            return b'VA %d%s\r\n%s\r\n' % (len(it.value), b''.join(b' ' + f for f in flags), it.value)
+        return b' '.join([b'HD'] + flags) + b'\r\n'
+
+    def meta_set(self, key: bytes, tokens: List[bytes], value: bytes) -> bytes:
+        nums = _num_flags(tokens)
+        opaque = [t for t in tokens if t[:1] == b'O']
+        it = self._get(key)
+
+        cas = nums.get(b'C')
+        if cas is not None:
+            if it is None:
+                return b' '.join([b'NF'] + opaque) + b'\r\n'
+            if cas != it.cas:
+                if b'I' in tokens and cas < it.cas:
+                    # an invalidating set with an older cas only marks the item stale
+                    it.stale = True
+                    it.win_sent = False
+                    return b' '.join([b'HD'] + opaque) + b'\r\n'
+                return b' '.join([b'EX'] + opaque) + b'\r\n'
+
+        it = _Item(value, nums.get(b'F', 0), self._expire_at(nums.get(b'T', 0)), self._next_cas())
+        self._items[key] = it
+        return b' '.join([b'HD'] + self._ret_flags(key, [t for t in tokens if t[:1] in b'cOk'], it)) + b'\r\n'
+
+    def meta_delete(self, key: bytes, tokens: List[bytes]) -> bytes:
+        opaque = [t for t in tokens if t[:1] == b'O']
+        it = self._get(key)
+        if it is None:
+            return b' '.join([b'NF'] + opaque) + b'\r\n'
+
+        if b'I' in tokens:
+            it.stale = True
+            it.win_sent = False
+            it.cas = self._next_cas()
+        else:
+            del self._items[key]
+        return b' '.join([b'HD'] + opaque) + b'\r\n'
+
+    def flush(self) -> None:
+        self._items.clear()
+
+    def handle(self, cmd: int, req: bytes) -> bytes:
+        """Returns the response of a request framed by cproxy.RequestReader."""
+        eol = req.index(b'\r\n')
+        tokens = req[:eol].split()
+
+        if cmd == cproxy.CMD_MG:
+            return self.meta_get(tokens[1], tokens[2:])
+        if cmd == cproxy.CMD_MS:
+            return self.meta_set(tokens[1], tokens[3:], req[eol + 2:-2])
+        if cmd == cproxy.CMD_MD:
+            return self.meta_delete(tokens[1], tokens[2:])
+        if cmd == cproxy.CMD_MN:
+            return b'MN\r\n'
+        if cmd == cproxy.CMD_VERSION:
+            return b'VERSION 1.6.21-fake\r\n'
+        if tokens and tokens[0] == b'flush_all':
+            self.flush()
+            return b'OK\r\n'
+        return _ERROR
+
+
+# responses not sent for a quiet request, by command
+_QUIET_SUPPRESSED = {
+    cproxy.CMD_MG: (b'EN',),
+    cproxy.CMD_MS: (b'HD',),
+    cproxy.CMD_MD: (b'HD', b'NF'),
+}
+
+
+class Shaping:
+    """
+    Delays every batch of responses by latency plus a uniform random jitter,
+    both in seconds, and caps the response bytes of each connection to bandwidth
+    bytes per second, 0 for no cap.
+    """
+
+    def __init__(self, latency: float = 0, jitter: float = 0, bandwidth: float = 0, seed: Optional[int] = None):
+        if latency < 0 or jitter < 0 or bandwidth < 0:
+            raise ValueError('latency, jitter and bandwidth must not be negative')
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self._random = random.Random(seed)
+
+    def enabled(self) -> bool:
+        return self.latency > 0 or self.jitter > 0 or self.bandwidth > 0
+
+    def delay(self) -> float:
+        if self.jitter > 0:
+            return self.latency + self._random.uniform(0, self.jitter)
+        return self.latency
+
+
+class _ServerProtocol(asyncio.Protocol):
+    def __init__(self, loop: asyncio.AbstractEventLoop, store: FakeStore, shaping: Shaping):
+        self._loop = loop
+        self._store = store
+        self._shaping = shaping
+        self._transport: Any = None
+        self._reader = cproxy.RequestReader()
+
+        self._queue: Deque[Tuple[float, bytes, bool]] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._last_due = 0.0
+        self._link_free = 0.0  # when the capped link finishes sending the queued bytes
+
+    def connection_made(self, transport: Any) -> None:
+        self._transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        out = []
+        closing = False
+
+        for cmd, key, req, quiet in self._reader.feed(data):
+            if cmd == cproxy.CMD_INVALID:
+                out.append(_CLIENT_ERROR)
+                closing = True
+                break
+            if cmd == cproxy.CMD_QUIT:
+                closing = True
+                break
+
+            resp = self._store.handle(cmd, req)
+            if quiet and resp[:2] in _QUIET_SUPPRESSED.get(cmd, ()):
+                continue
+            out.append(resp)
+
+        self._send(b''.join(out), closing)
+
+    def _send(self, data: bytes, closing: bool) -> None:
+        if not self._shaping.enabled():
+            self._transport.write(data)
+            if closing:
+                self._transport.close()
+            return
+
+        due = self._loop.time() + self._shaping.delay()
+        if self._shaping.bandwidth > 0:
+            self._link_free = max(due, self._link_free) + len(data) / self._shaping.bandwidth
+            due = self._link_free
+
+        # a shorter jitter must not reorder the responses
+        due = max(due, self._last_due)
+        self._last_due = due
+
+        self._queue.append((due, data, closing))
+        if self._timer is None:
+            self._timer = self._loop.call_at(due, self._flush)
+
+    def _flush(self) -> None:
+        self._timer = None
+        now = self._loop.time()
+
+        out = []
+        closing = False
+        while self._queue and self._queue[0][0] <= now and not closing:
+            _, data, closing = self._queue.popleft()
+            out.append(data)
+
+        if self._transport is None:
+            return
+        self._transport.write(b''.join(out))
+        if closing:
+            self._transport.close()
+        elif self._queue:
+            self._timer = self._loop.call_at(self._queue[0][0], self._flush)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._transport = None
+        self._queue.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+async def start_server(
+        host: str, port: int, shaping: Optional[Shaping] = None, store: Optional[FakeStore] = None,
+) -> asyncio.Server:
+    loop = asyncio.get_running_loop()
+    if shaping is None:
+        shaping = Shaping()
+    if store is None:
+        store = FakeStore()
+    return await loop.create_server(lambda: _ServerProtocol(loop, store, shaping), host, port)
+
+
+class ServerThread:
+    """
+    A stand-in server running its own event loop in a background thread,
+    port 0 picks a free port, see the port attribute.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, shaping: Optional[Shaping] = None):
+        self.store = FakeStore()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+        future = asyncio.run_coroutine_threadsafe(start_server(host, port, shaping, self.store), self._loop)
+        self._server = future.result()
+        self.host = host
+        self.port: int = self._server.sockets[0].getsockname()[1]
+
+    def close(self) -> None:
+        async def stop() -> None:
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self) -> 'ServerThread':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m mcproxy.fakeserver',
+        description='An in-memory memcached stand-in speaking the meta protocol,'
+                    ' with artificial latency, jitter and bandwidth caps.',
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=11211, help='port to listen on')
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay added to every response')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='random extra delay, up to this value')
+    parser.add_argument(
+        '--bandwidth-mbps', type=float, default=0,
+        help='cap of the response bytes of each connection, in megabits per second, 0 for no cap',
+    )
+    parser.add_argument('--seed', type=int, default=None, help='seed of the jitter')
+    args = parser.parse_args(argv)
+
+    shaping = Shaping(args.latency_ms / 1000, args.jitter_ms / 1000, args.bandwidth_mbps * 1e6 / 8, args.seed)
+
+    async def serve() -> None:
+        server = await start_server(args.host, args.port, shaping)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+A queue of cache invalidations for the write path of a cache-aside setup:
+
+    queue = InvalidationQueue(client, invalidate=True)
+    ...
+    queue.add(b'user:1')  # once per changed row, in the transaction
+    queue.add(b'user:1')
+    db.commit()
+    queue.commit()  # does not wait for the deletes
+
+The keys added while they are queued are sent once, as one pipeline of md
+requests, when the queue is committed, holds max_keys keys, or its oldest key
+waited max_delay seconds. With invalidate, the items are marked stale with
+md I instead of being removed, so that readers can still get the old value
+while one of them fills the new one.
+
+A delete failing with an error is retried with an exponential backoff,
+on_failure is called with the key and the last error after max_attempts.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class InvalidationQueue:
+    """
+    client is any client with a pipeline method, such as memcache.Client or
+    memcache.ShardedClient. With background, a thread sends the deletes,
+    otherwise they are sent by add, commit and poll in the calling thread.
+    """
+
+    def __init__(
+            self, client: Any, invalidate: bool = False, max_keys: int = 1000, max_delay: float = 0.05,
+            max_attempts: int = 5, backoff: float = 0.05, max_backoff: float = 2.0,
+            on_failure: Optional[Callable[[bytes, BaseException], None]] = None,
+            background: bool = True, clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_keys <= 0 or max_attempts <= 0:
+            raise ValueError('max_keys and max_attempts must be positive')
+        if max_delay < 0 or backoff < 0 or max_backoff < 0:
+            raise ValueError('max_delay, backoff and max_backoff must not be negative')
+
+        self._client = client
+        self._invalidate = invalidate
+        self._max_keys = max_keys
+        self._max_delay = max_delay
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._on_failure = on_failure
+        self._clock = clock
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one pipeline of deletes at a time
+        self._pending: Dict[bytes, int] = {}  # key -> failed attempts, in add order
+        self._first_added = 0.0  # when the oldest pending key was added
+        self._retries: Dict[bytes, Tuple[int, float]] = {}  # key -> (failed attempts, when to retry)
+        self._flush_requested = False
+        self._closed = False
+
+        self._added = 0
+        self._deduped = 0
+        self._sent = 0
+        self._retried = 0
+        self._failed = 0
+        self._flushes = 0
+
+        self._thread: Optional[threading.Thread] = None
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, key: bytes) -> None:
+        """Queues the invalidation of key, a key already queued is only sent once."""
+        self.add_many([key])
+
+    def add_many(self, keys: List[bytes]) -> None:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('invalidation queue is closed')
+            was_empty = not self._pending
+
+            for key in keys:
+                self._added += 1
+                if key in self._pending:
+                    self._deduped += 1
+                    continue
+                if not self._pending:
+                    self._first_added = self._clock()
+                # a queued key is sent now rather than at its next retry
+                attempts, _ = self._retries.pop(key, (0, 0.0))
+                self._pending[key] = attempts
+
+            # the background thread waits for the first key to start the max_delay timer
+            full = len(self._pending) >= self._max_keys
+            if full or (was_empty and self._pending):
+                self._cond.notify()
+
+        if full and self._thread is None:
+            self.flush()
+
+    def commit(self) -> None:
+        """Sends the queued keys, without waiting for them with a background thread."""
+        if self._thread is None:
+            self.flush()
+            return
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify()
+
+    def poll(self) -> int:
+        """
+        Sends the queued keys if the oldest one waited max_delay seconds and the
+        retries that are due, for queues without a background thread.
+        Returns the number of keys sent.
+        """
+        with self._cond:
+            due = self._due(self._clock())
+        if not due:
+            return 0
+        return self.flush()
+
+    def flush(self) -> int:
+        """Sends the queued keys and the retries that are due, returns the number of keys sent."""
+        with self._flush_lock:
+            with self._cond:
+                now = self._clock()
+                batch = self._pending
+                self._pending = {}
+                self._flush_requested = False
+                for key, (attempts, retry_at) in list(self._retries.items()):
+                    if retry_at <= now:
+                        del self._retries[key]
+                        batch[key] = attempts
+                        self._retried += 1
+
+            if not batch:
+                return 0
+
+            failed = self._send(list(batch))
+
+            failures = []
+            with self._cond:
+                self._flushes += 1
+                self._sent += len(batch)
+                now = self._clock()
+                for key, ex in failed:
+                    attempts = batch[key] + 1
+                    if key in self._pending:
+                        # added again meanwhile, it is sent by the next flush anyway
+                        self._pending[key] = attempts
+                    elif attempts >= self._max_attempts:
+                        self._failed += 1
+                        failures.append((key, ex))
+                    else:
+                        delay = min(self._max_backoff, self._backoff * 2 ** (attempts - 1))
+                        self._retries[key] = (attempts, now + delay)
+                self._cond.notify()
+
+            if self._on_failure is not None:
+                for key, ex in failures:
+                    self._on_failure(key, ex)
+            return len(batch)
+
+    def _send(self, keys: List[bytes]) -> List[Tuple[bytes, BaseException]]:
+        # returns the keys whose delete failed, a missing key is not a failure
+        try:
+            p = self._client.pipeline()
+            results = [p.delete(key, invalidate=self._invalidate) for key in keys]
+            p.execute()
+        except Exception as ex:
+            return [(key, ex) for key in keys]
+
+        failed: List[Tuple[bytes, BaseException]] = []
+        for key, r in zip(keys, results):
+            try:
+                r.result()
+            except Exception as ex:
+                failed.append((key, ex))
+        return failed
+
+    def _next_time(self) -> Optional[float]:
+        # when the queue must be flushed next, None if it is empty
+        times = [retry_at for _, retry_at in self._retries.values()]
+        if self._pending:
+            times.append(self._first_added + self._max_delay)
+        return min(times) if times else None
+
+    def _due(self, now: float) -> bool:
+        if self._flush_requested or len(self._pending) >= self._max_keys:
+            return True
+        next_time = self._next_time()
+        return next_time is not None and next_time <= now
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = self._clock()
+                    if self._due(now):
+                        break
+                    next_time = self._next_time()
+                    self._cond.wait(None if next_time is None else next_time - now)
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self) -> None:
+        """Sends the queued keys and stops the background thread, the pending retries are dropped."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def __enter__(self) -> 'InvalidationQueue':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._pending) + len(self._retries)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'retrying': len(self._retries),
+                'added': self._added,
+                'deduped': self._deduped,
+                'sent': self._sent,
+                'retried': self._retried,
+                'failed': self._failed,
+                'flushes': self._flushes,
+            }
@@ -0,0 +1,203 @@
+"""
+A load generator driving cmem.Client pipelines, for sizing the pipeline depth
+and the number of connections against a memcached node or a stand-in server:
+
+    python -m mcproxy.fakeserver --latency-ms 0.5 &
+    python -m mcproxy.loadgen --server 127.0.0.1:11211 --concurrency 16 --conns 4 --depth 8
+
+Without --qps the load is closed loop: every worker starts its next pipeline as soon
+as the previous one is done. With --qps it is open loop: pipelines are started on a
+fixed schedule and their latency is measured from their scheduled start, so a server
+falling behind is not hidden by the workers waiting on it.
+
+The result is printed as one JSON object.
+"""
+import argparse
+import json
+import math
+import random
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import cmem  # type: ignore
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest rank percentile of sorted values, p is between 0 and 1."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(p * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def _key(i: int) -> bytes:
+    return b'loadgen:%08d' % i
+
+
+class _Worker:
+    def __init__(
+            self, client: Any, index: int, depth: int, keys: int, value: bytes, set_ratio: float,
+            interval: float, first_start: float, deadline: float,
+    ):
+        self.client = client
+        self.depth = depth
+        self.keys = keys
+        self.value = value
+        self.set_ratio = set_ratio
+        self.interval = interval  # 0 for closed loop
+        self.first_start = first_start
+        self.deadline = deadline
+        self.random = random.Random(index)
+
+        self.latencies: List[float] = []
+        self.ops = 0
+        self.errors = 0
+        self.misses = 0
+
+    def run_pipeline(self) -> None:
+        p = self.client.pipeline()
+        results = []
+        for _ in range(self.depth):
+            key = _key(self.random.randrange(self.keys))
+            if self.random.random() < self.set_ratio:
+                results.append((False, p.set(key, self.value)))
+            else:
+                results.append((True, p.get(key)))
+        p.execute()
+
+        for is_get, r in results:
+            try:
+                value = r.result()
+            except Exception:
+                self.errors += 1
+                continue
+            if is_get and value is None:
+                self.misses += 1
+        self.ops += self.depth
+
+    def run(self) -> None:
+        scheduled = 0
+        while True:
+            if self.interval:
+                begin = self.first_start + scheduled * self.interval
+                scheduled += 1
+                if begin >= self.deadline:
+                    return
+                wait = begin - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            else:
+                begin = time.perf_counter()
+                if begin >= self.deadline:
+                    return
+
+            self.run_pipeline()
+            self.latencies.append(time.perf_counter() - begin)
+
+
+def prefill(client: Any, keys: int, value: bytes, batch: int = 100) -> None:
+    for begin in range(0, keys, batch):
+        p = client.pipeline()
+        results = [p.set(_key(i), value) for i in range(begin, min(keys, begin + batch))]
+        p.execute()
+        for r in results:
+            r.result()
+
+
+def run_load(
+        new_conn: Callable[[], Any], duration: float = 10, concurrency: int = 8, conns: int = 8,
+        depth: int = 1, qps: float = 0, keys: int = 10000, value_size: int = 100,
+        set_ratio: float = 0.1, use_fd: bool = False, warm: bool = True,
+) -> Dict[str, Any]:
+    """
+    Runs concurrency threads sharing conns clients for duration seconds,
+    every pipeline has depth random gets and sets over keys keys.
+    qps is the target of pipelines per second, 0 for a closed loop.
+    Returns the throughput and the percentiles of the pipeline latency.
+    """
+    if concurrency <= 0 or conns <= 0 or depth <= 0 or keys <= 0:
+        raise ValueError('concurrency, conns, depth and keys must be positive')
+
+    clients = [cmem.Client(new_conn(), use_fd) for _ in range(min(conns, concurrency))]
+    value = b'x' * value_size
+    if warm:
+        prefill(clients[0], keys, value)
+
+    interval = concurrency / qps if qps > 0 else 0
+    start = time.perf_counter()
+    deadline = start + duration
+
+    # the workers of an open loop are staggered over one interval
+    workers = [
+        _Worker(
+            clients[i % len(clients)], i, depth, keys, value, set_ratio,
+            interval, start + interval * i / concurrency, deadline,
+        )
+        for i in range(concurrency)
+    ]
+    threads = [threading.Thread(target=w.run) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(lat for w in workers for lat in w.latencies)
+    ops = sum(w.ops for w in workers)
+    return {
+        'mode': 'open' if qps > 0 else 'closed',
+        'target_qps': qps,
+        'concurrency': concurrency,
+        'conns': len(clients),
+        'depth': depth,
+        'seconds': elapsed,
+        'pipelines': len(latencies),
+        'ops': ops,
+        'errors': sum(w.errors for w in workers),
+        'misses': sum(w.misses for w in workers),
+        'pipelines_per_sec': len(latencies) / elapsed,
+        'ops_per_sec': ops / elapsed,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'p999': percentile(latencies, 0.999) * 1000,
+            'max': latencies[-1] * 1000 if latencies else 0.0,
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m mcproxy.loadgen',
+        description='Drives client pipelines against a memcached node and reports throughput and latency.',
+    )
+    parser.add_argument('--server', default='127.0.0.1:11211', help='memcached node, host:port')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of worker threads')
+    parser.add_argument('--conns', type=int, default=8, help='number of clients shared by the workers')
+    parser.add_argument('--depth', type=int, default=1, help='requests per pipeline')
+    parser.add_argument('--qps', type=float, default=0, help='target pipelines per second, 0 for a closed loop')
+    parser.add_argument('--keys', type=int, default=10000, help='number of distinct keys')
+    parser.add_argument('--value-size', type=int, default=100, help='bytes of every value set')
+    parser.add_argument('--set-ratio', type=float, default=0.1, help='fraction of the requests that are sets')
+    parser.add_argument('--use-fd', action='store_true', help='do the socket io without the GIL')
+    parser.add_argument('--no-prefill', action='store_true', help='do not set all the keys before starting')
+    args = parser.parse_args(argv)
+
+    host, _, port = args.server.rpartition(':')
+
+    def new_conn() -> socket.socket:
+        return socket.create_connection((host or '127.0.0.1', int(port)))
+
+    result = run_load(
+        new_conn, args.duration, args.concurrency, args.conns, args.depth, args.qps,
+        args.keys, args.value_size, args.set_ratio, args.use_fd, not args.no_prefill,
+    )
+    print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,230 @@
-from typing import Callable, Any
+import abc
+import asyncio
+import threading
+import time
+import weakref
+from typing import Callable, Any, Dict, List, Optional
 
 import cmem  # type: ignore
 
 
-class Client:
+class _LeaseMixin(abc.ABC):
+    @abc.abstractmethod
+    def pipeline(self) -> Any:
+        ...
+
+    def get_or_fill(
+            self, key: bytes, loader: Callable[[bytes], bytes], ttl: int = 0,
+            lease_ttl: int = 10, poll_interval: float = 0.02, max_wait: float = 1,
+    ) -> bytes:
+        """
+        Returns the value of key, calling loader(key) to fill it on a miss.
+
+        Of all concurrent callers, only the one winning the lease of the missing
+        key calls the loader, the others get the stale value if there is one,
+        or poll the key every poll_interval seconds until it is filled.
+        The filled value is written back with the cas of the lease, so it can not
+        overwrite a value set after the lease was taken.
+
+        The lease expires after lease_ttl seconds if its winner fails to fill it,
+        a caller waiting more than max_wait seconds calls the loader itself
+        without writing the value back.
+        """
+        return self.get_or_fill_many(
+            [key], lambda keys: {k: loader(k) for k in keys}, ttl,
+            lease_ttl, poll_interval, max_wait,
+        )[0]
+
+    def get_or_fill_many(
+            self, keys: List[bytes], loader: Callable[[List[bytes]], Dict[bytes, bytes]], ttl: int = 0,
+            lease_ttl: int = 10, poll_interval: float = 0.02, max_wait: float = 1,
+    ) -> List[bytes]:
+        """
+        Same as get_or_fill for a batch of keys, loader is called at most once
+        per round with the keys whose lease this caller won and must return
+        a dict with their values. The values are returned in the order of keys.
+        """
+        values: Dict[bytes, bytes] = {}
+        remaining = list(dict.fromkeys(keys))
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            p = self.pipeline()
+            results = [p.get(k, N=lease_ttl, cas=True) for k in remaining]
+            p.execute()
+
+            won = []
+            waiting = []
+            for k, r in zip(remaining, results):
+                if r.win:
+                    won.append((k, r.cas))
+                elif r.stale or not r.won:
+                    values[k] = r.result()
+                else:
+                    # another caller holds the lease of the placeholder value
+                    waiting.append(k)
+
+            if won:
+                loaded = loader([k for k, _ in won])
+                for k, cas in won:
+                    values[k] = loaded[k]
+                    p.set(k, loaded[k], cas=cas, ttl=ttl)
+                p.execute()
+
+            if not waiting:
+                return [values[k] for k in keys]
+
+            if time.monotonic() + poll_interval > deadline:
+                loaded = loader(waiting)
+                for k in waiting:
+                    values[k] = loaded[k]
+                return [values[k] for k in keys]
+
+            time.sleep(poll_interval)
+            remaining = waiting
+
+
+class Client(_LeaseMixin):
     _client: Any
 
-    def __init__(self, new_conn: Callable[[], Any]):
-        self._client = cmem.Client(new_conn)
+    def __init__(
+            self, new_conn: Callable[[], Any], use_fd: bool = False,
+            near_cache: Any = None, compressor: Any = None, serializer: Any = None, autocork_us: int = 0,
+            hot_keys: Any = None, latency: Any = None,
+    ):
+        self._client = cmem.Client(
+            new_conn(), use_fd, near_cache, compressor, serializer, autocork_us, hot_keys, latency,
+        )
+
+    def pipeline(self) -> Any:
+        return self._client.pipeline()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._client.stats()
+
+
+class ShardedClient(_LeaseMixin):
+    _client: Any
+
+    def __init__(
+            self, new_conns: Dict[str, Callable[[], Any]], use_fd: bool = False,
+            compressor: Any = None, serializer: Any = None, autocork_us: int = 0,
+            replicas: int = 1, hedge_percentile: float = 0.95, min_hedge_delay: float = 0.0005,
+            hot_keys: Any = None, health: Any = None, failover: bool = False, health_check_interval: float = 1.0,
+            latency: Any = None,
+    ):
+        # a single hot_keys samples the keys of all nodes
+        def connect(name: str) -> Any:
+            return cmem.Client(new_conns[name](), use_fd, None, compressor, serializer, autocork_us, hot_keys)
+
+        self._client = cmem.ShardedClient(
+            {name: connect(name) for name in new_conns},
+            160, replicas, hedge_percentile, min_hedge_delay, health, connect, failover, latency,
+        )
+
+        # with health, the failed connections are replaced and the ejected nodes probed
+        # every health_check_interval seconds
+        if health is not None and health_check_interval > 0:
+            thread = threading.Thread(
+                target=_check_health_loop, args=(weakref.ref(self._client), health_check_interval), daemon=True,
+            )
+            thread.start()
+
+    def pipeline(self) -> Any:
+        return self._client.pipeline()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return self._client.stats()
+
+    def hedge_stats(self) -> Optional[Dict[str, Any]]:
+        return self._client.hedge_stats()
+
+    def health_stats(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        return self._client.health_stats()
+
+    def check_health(self) -> List[str]:
+        return self._client.check_health()
+
+    def latency_stats(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        return self._client.latency_stats()
+
+
+def _check_health_loop(client_ref: Any, interval: float) -> None:
+    # the thread does not keep the client alive, it stops once the client is closed
+    while True:
+        time.sleep(interval)
+        client = client_ref()
+        if client is None:
+            return
+        try:
+            client.check_health()
+        except Exception:
+            pass
+        del client
+
+
+class _AsyncProtocol(asyncio.Protocol):
+    conn: Any
+
+    def __init__(
+            self, loop: asyncio.AbstractEventLoop,
+            compressor: Any = None, serializer: Any = None, autocork_us: int = 0, hot_keys: Any = None,
+    ):
+        self._loop = loop
+        self._compressor = compressor
+        self._serializer = serializer
+        self._autocork_us = autocork_us
+        self._hot_keys = hot_keys
+        self.conn = None
+
+    def connection_made(self, transport: Any) -> None:
+        self.conn = cmem.AsyncConn(
+            transport, self._loop, self._compressor, self._serializer, self._autocork_us, self._hot_keys,
+        )
+
+    def data_received(self, data: bytes) -> None:
+        self.conn.data_received(data)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.conn.connection_lost(exc)
+
+
+class AsyncClient:
+    """
+    Concurrent calls from many coroutines are pipelined over the same connection.
+    get, set and delete return awaitable results, the meta flags of a get
+    can be read from its result after it is awaited.
+    """
+    _conn: Any
+
+    def __init__(self, conn: Any):
+        self._conn = conn
+
+    @classmethod
+    async def connect(
+            cls, host: str = 'localhost', port: int = 11211,
+            compressor: Any = None, serializer: Any = None, autocork_us: int = 0, hot_keys: Any = None,
+    ) -> 'AsyncClient':
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_connection(
+            lambda: _AsyncProtocol(loop, compressor, serializer, autocork_us, hot_keys), host, port,
+        )
+        return cls(protocol.conn)
+
+    def get(self, key: Any, N: int = 0, cas: bool = False, ttl: bool = False, client_flags: bool = False) -> Any:
+        return self._conn.get(key, N=N, cas=cas, ttl=ttl, client_flags=client_flags)
+
+    def set(
+            self, key: Any, value: Any, cas: int = 0,
+            ttl: int = 0, client_flags: int = 0, invalidate: bool = False,
+    ) -> Any:
+        return self._conn.set(key, value, cas=cas, ttl=ttl, client_flags=client_flags, invalidate=invalidate)
+
+    def delete(self, key: Any, invalidate: bool = False) -> Any:
+        return self._conn.delete(key, invalidate=invalidate)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._conn.stats()
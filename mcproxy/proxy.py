@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from collections import deque
+from typing import Any, Deque, List, Optional, Set, Tuple
+
+import cproxy  # type: ignore
+import cring  # type: ignore
+
+# responses not sent back for a quiet request, by command
+_QUIET_SUPPRESSED = {
+    cproxy.CMD_MG: (b'EN',),
+    cproxy.CMD_MS: (b'HD',),
+    cproxy.CMD_MD: (b'HD', b'NF'),
+}
+
+_ERROR = b'ERROR\r\n'
+_CLIENT_ERROR = b'CLIENT_ERROR bad command line format\r\n'
+_SERVER_ERROR = b'SERVER_ERROR upstream connection lost\r\n'
+_VERSION = b'VERSION mcproxy\r\n'
+_MN = b'MN\r\n'
+
+
+class _Reply:
+    __slots__ = ('client', 'cmd', 'quiet', 'data')
+
+    def __init__(self, client: '_ClientProtocol', cmd: int, quiet: bool):
+        self.client = client
+        self.cmd = cmd
+        self.quiet = quiet
+        self.data: Optional[bytes] = None
+
+    def set(self, data: bytes) -> None:
+        if self.quiet and data[:2] in _QUIET_SUPPRESSED.get(self.cmd, ()):
+            data = b''
+        self.data = data
+        self.client.reply_ready()
+
+
+class _UpstreamProtocol(asyncio.Protocol):
+    """
+    One connection to a memcached node, shared by many clients.
+    The requests of all clients are written together once per event loop
+    iteration and their responses are matched in FIFO order.
+
+    While the node does not keep up with the requests, the clients sending
+    to it are not read from until its write buffer drains.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._transport: Any = None
+        self._reader = cproxy.ResponseReader()
+        self._waiting: Deque[_Reply] = deque()
+        self._out: List[bytes] = []
+        self._flush_scheduled = False
+        self._paused = False
+        self._blocked: Set['_ClientProtocol'] = set()
+        self.closed = False
+
+    def send(self, req: bytes, reply: _Reply) -> None:
+        self._waiting.append(reply)
+        self._out.append(req)
+        if self._paused and reply.client not in self._blocked:
+            self._blocked.add(reply.client)
+            reply.client.pause_reading()
+        if self._transport is not None and not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        if self._transport is None or not self._out:
+            return
+        out = self._out
+        self._out = []
+        self._transport.write(b''.join(out))
+
+    def connection_made(self, transport: Any) -> None:
+        self._transport = transport
+        self._flush()
+
+    def data_received(self, data: bytes) -> None:
+        try:
+            responses = self._reader.feed(data)
+        except ValueError:
+            self._transport.close()
+            return
+
+        for resp in responses:
+            if not self._waiting:
+                self._transport.close()
+                return
+            self._waiting.popleft().set(resp)
+
+    def pause_writing(self) -> None:
+        self._paused = True
+
+    def resume_writing(self) -> None:
+        self._paused = False
+        self._unblock()
+
+    def _unblock(self) -> None:
+        blocked = self._blocked
+        self._blocked = set()
+        for client in blocked:
+            client.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.fail()
+
+    def fail(self) -> None:
+        self.closed = True
+        self._out = []
+        while self._waiting:
+            self._waiting.popleft().set(_SERVER_ERROR)
+        self._paused = False
+        self._unblock()
+
+
+class _Node:
+    def __init__(self, loop: asyncio.AbstractEventLoop, host: str, port: int, num_conns: int):
+        self._loop = loop
+        self._host = host
+        self._port = port
+        self._conns: List[Optional[_UpstreamProtocol]] = [None] * num_conns
+
+    def get_conn(self, index: int) -> _UpstreamProtocol:
+        index %= len(self._conns)
+        conn = self._conns[index]
+        if conn is None or conn.closed:
+            conn = _UpstreamProtocol(self._loop)
+            self._conns[index] = conn
+            self._loop.create_task(self._connect(conn))
+        return conn
+
+    async def _connect(self, conn: _UpstreamProtocol) -> None:
+        try:
+            await self._loop.create_connection(lambda: conn, self._host, self._port)
+        except OSError:
+            conn.fail()
+
+
+class _Upstreams:
+    def __init__(self, loop: asyncio.AbstractEventLoop, addrs: List[Tuple[str, int]], num_conns: int):
+        self.ring = cring.HashRing([f'{host}:{port}' for host, port in addrs])
+        self.nodes = [_Node(loop, host, port, num_conns) for host, port in addrs]
+        self._next_client = 0
+
+    def next_client_id(self) -> int:
+        self._next_client += 1
+        return self._next_client
+
+
+class _ClientProtocol(asyncio.Protocol):
+    """
+    A client connection, its requests are forwarded to the upstream node
+    of their keys and the responses are written back in request order.
+
+    The client is not read from while it does not read its responses
+    or while an upstream connection it sent to is paused.
+    """
+
+    def __init__(self, upstreams: _Upstreams):
+        self._upstreams = upstreams
+        self._id = upstreams.next_client_id()
+        self._transport: Any = None
+        self._reader = cproxy.RequestReader()
+        self._replies: Deque[_Reply] = deque()
+        self._closing = False
+        self._read_pauses = 0
+
+    def connection_made(self, transport: Any) -> None:
+        self._transport = transport
+
+    def pause_reading(self) -> None:
+        # the reading resumes once every pause_reading is matched by a resume_reading
+        self._read_pauses += 1
+        if self._read_pauses == 1 and self._transport is not None:
+            self._transport.pause_reading()
+
+    def resume_reading(self) -> None:
+        self._read_pauses -= 1
+        if self._read_pauses == 0 and self._transport is not None and not self._transport.is_closing():
+            self._transport.resume_reading()
+
+    def pause_writing(self) -> None:
+        self.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.resume_reading()
+
+    def data_received(self, data: bytes) -> None:
+        if self._closing:
+            return
+
+        requests = self._reader.feed(data)
+        ring = self._upstreams.ring
+        nodes = self._upstreams.nodes
+
+        for cmd, key, req, quiet in requests:
+            reply = _Reply(self, cmd, quiet)
+            self._replies.append(reply)
+
+            if key is not None:
+                nodes[ring.get_node(key)].get_conn(self._id).send(req, reply)
+            elif cmd == cproxy.CMD_INVALID:
+                reply.data = _CLIENT_ERROR
+                self._closing = True
+                break
+            elif cmd == cproxy.CMD_MN:
+                reply.data = _MN
+            elif cmd == cproxy.CMD_VERSION:
+                reply.data = _VERSION
+            elif cmd == cproxy.CMD_QUIT:
+                reply.data = b''
+                self._closing = True
+                break
+            else:
+                reply.data = _ERROR
+
+        self.reply_ready()
+
+    def reply_ready(self) -> None:
+        replies = self._replies
+        if not replies or replies[0].data is None:
+            return
+
+        out = []
+        while replies:
+            data = replies[0].data
+            if data is None:
+                break
+            out.append(data)
+            replies.popleft()
+
+        if self._transport is None or self._transport.is_closing():
+            return
+        self._transport.write(b''.join(out))
+
+        if self._closing and not replies:
+            self._transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._transport = None
+
+
+def _parse_addr(addr: str, default_port: int) -> Tuple[str, int]:
+    host, _, port = addr.rpartition(':')
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+async def start_server(
+        host: str, port: int, upstreams: List[Tuple[str, int]],
+        num_conns: int = 2, reuse_port: bool = False,
+) -> asyncio.Server:
+    loop = asyncio.get_running_loop()
+    up = _Upstreams(loop, upstreams, num_conns)
+    return await loop.create_server(lambda: _ClientProtocol(up), host, port, reuse_port=reuse_port)
+
+
+def _run_worker(host: str, port: int, upstreams: List[Tuple[str, int]], num_conns: int) -> None:
+    async def serve() -> None:
+        server = await start_server(host, port, upstreams, num_conns, reuse_port=True)
+        await server.serve_forever()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(serve())
+    except asyncio.CancelledError:
+        pass
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m mcproxy',
+        description='A memcached meta protocol proxy multiplexing many client connections'
+                    ' onto a few upstream connections.',
+    )
+    parser.add_argument('--listen', default='127.0.0.1:11311', help='address to listen on, host:port')
+    parser.add_argument(
+        '--upstream', action='append', default=None,
+        help='memcached node, host:port, can be repeated to shard keys over multiple nodes',
+    )
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--conns', type=int, default=2, help='connections to each upstream node per worker')
+    args = parser.parse_args(argv)
+
+    host, port = _parse_addr(args.listen, 11311)
+    upstreams = [_parse_addr(addr, 11211) for addr in args.upstream or ['localhost:11211']]
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('SO_REUSEPORT is not supported on this platform')
+
+    workers = [
+        multiprocessing.Process(target=_run_worker, args=(host, port, upstreams, args.conns), daemon=True)
+        for _ in range(args.workers)
+    ]
+    for w in workers:
+        w.start()
+
+    # stop the workers on SIGTERM too, through the finally below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in workers:
+            w.terminate()
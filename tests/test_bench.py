@@ -0,0 +1,123 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+import cbench  # type: ignore
+import cutil  # type: ignore
+from mcproxy import bench
+
+
+class TestBenchFunctions(unittest.TestCase):
+    def tearDown(self) -> None:
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_parser_stream(self) -> None:
+        data = b'VA 5 f3\r\nvalue\r\nHD\r\nEN\r\n' * 10
+        for fragment in [0, 1, 7, 100]:
+            elapsed, ops, nbytes = cbench.parser_stream(data, fragment, 3)
+            self.assertEqual(90, ops)
+            self.assertEqual(len(data) * 3, nbytes)
+            self.assertGreaterEqual(elapsed, 0)
+
+    def test_parser_batch(self) -> None:
+        data = b'VA 5 f3\r\nvalue\r\nHD\r\nEN\r\n' * 30
+        for fragment in [0, 1, 7, 100]:
+            _, ops, nbytes = cbench.parser_batch(data, fragment, 2)
+            self.assertEqual(180, ops)
+            self.assertEqual(len(data) * 2, nbytes)
+
+    def test_parser_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            cbench.parser_stream(b'XX\r\n', 0, 1)
+        with self.assertRaises(ValueError):
+            cbench.parser_batch(b'XX\r\n', 0, 1)
+
+    def test_builder(self) -> None:
+        for writev in [False, True]:
+            _, ops, nbytes = cbench.builder_mget(100, b'key01', 256, writev)
+            self.assertEqual(100, ops)
+            self.assertEqual(len(b'mg key01 v\r\n') * 100, nbytes)
+
+            _, ops, nbytes = cbench.builder_mset(50, b'key01', b'x' * 2000, 1024, writev)
+            self.assertEqual(50, ops)
+            self.assertEqual(len(b'ms key01 2000\r\n' + b'x' * 2000 + b'\r\n') * 50, nbytes)
+
+    def test_ptr_clone_free(self) -> None:
+        _, ops, _ = cbench.ptr_clone_free(1000)
+        self.assertEqual(1000, ops)
+
+    def test_alloc_free(self) -> None:
+        for size in [64, 9336, 100000]:
+            _, ops, _ = cbench.alloc_free(100, size)
+            self.assertEqual(112, ops)
+
+    def test_serializer_round_trip(self) -> None:
+        _, ops, nbytes = cbench.serializer_round_trip(1234, 10)
+        self.assertEqual(10, ops)
+        self.assertEqual(40, nbytes)
+
+        _, ops, _ = cbench.serializer_round_trip({'a': 1}, 10)
+        self.assertEqual(10, ops)
+
+    def test_hot_keys_sample(self) -> None:
+        for rate in [1, 100]:
+            _, ops, _ = cbench.hot_keys_sample(1000, rate, 50)
+            self.assertEqual(1000, ops)
+
+    def test_histogram_record(self) -> None:
+        _, ops, _ = cbench.histogram_record(1000)
+        self.assertEqual(1000, ops)
+
+
+class TestBenchRunner(unittest.TestCase):
+    def test_main_json_lines(self) -> None:
+        out = io.StringIO()
+        with redirect_stdout(out):
+            ret = bench.main(['--scale', '0.001', '--repeat', '1', '--filter', 'builder_add_mget'])
+        self.assertEqual(0, ret)
+
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(6, len(results))
+        self.assertEqual({'write_limit': 256, 'writev': False}, results[0]['params'])
+        for res in results:
+            self.assertEqual('builder_add_mget', res['name'])
+            self.assertEqual(200, res['ops'])
+            self.assertGreater(res['ops_per_sec'], 0)
+            self.assertGreater(res['mb_per_sec'], 0)
+
+    def test_compare(self) -> None:
+        base = [
+            {'name': 'a', 'params': {'x': 1}, 'ops_per_sec': 100.0},
+            {'name': 'a', 'params': {'x': 2}, 'ops_per_sec': 100.0},
+            {'name': 'b', 'params': {}, 'ops_per_sec': 100.0},
+        ]
+        current = [
+            {'name': 'a', 'params': {'x': 1}, 'ops_per_sec': 95.0},
+            {'name': 'a', 'params': {'x': 2}, 'ops_per_sec': 80.0},
+            {'name': 'c', 'params': {}, 'ops_per_sec': 1.0},
+        ]
+        regressions = bench.compare(base, current, 0.1)
+        self.assertEqual(1, len(regressions))
+        self.assertEqual({'x': 2}, regressions[0]['params'])
+        self.assertAlmostEqual(0.8, regressions[0]['ratio'])
+
+    def test_main_compare_regression(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'base.json')
+            args = ['--scale', '0.001', '--repeat', '1', '--filter', 'ptr_clone_free']
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(0, bench.main(args + ['--output', path]))
+
+            base = bench.load_results(path)
+            self.assertEqual(1, len(base))
+            base[0]['ops_per_sec'] *= 1000
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(base[0]) + '\n')
+
+            err = io.StringIO()
+            with redirect_stdout(io.StringIO()), redirect_stderr(err):
+                self.assertEqual(1, bench.main(args + ['--compare', path]))
+            self.assertIn('REGRESSION ptr_clone_free{}', err.getvalue())
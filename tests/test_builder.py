@@ -35,6 +35,10 @@ class TestBuilder(unittest.TestCase):
         self.assertEqual(1, ret)
 
         self.assertEqual([cmd1], self.write_list)
+        self.assertEqual({
+            'bytes_written': len(cmd1), 'flushes': 1, 'partial_writes': 0,
+            'full_stalls': 0, 'write_errors': 0,
+        }, b.stats())
 
         del b
         self.assertEqual(0, cutil.py_get_mem())
@@ -245,6 +249,22 @@ class TestBuilder(unittest.TestCase):
 
         self.assertEqual([b'md key01\r\n'], self.write_list)
 
+        self.assertEqual(0, b.add_delete(b'key02', invalidate=True))
+        self.assertEqual(1, b.finish())
+        self.assertEqual(b'md key02 I\r\n', self.write_list[1])
+
+        del b
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_add_version(self) -> None:
+        b = cbuilder.BuilderTest(self.write_func, 1024)
+
+        self.assertEqual(0, b.add_delete(b'key01'))
+        self.assertEqual(0, b.add_version())
+        self.assertEqual(1, b.finish())
+
+        self.assertEqual([b'md key01\r\nversion\r\n'], self.write_list)
+
         del b
         self.assertEqual(0, cutil.py_get_mem())
 
@@ -266,6 +286,39 @@ class TestBuilder(unittest.TestCase):
         del b
         self.assertEqual(0, cutil.py_get_mem())
 
+    def test_add_mget_with_meta_flags(self) -> None:
+        b = cbuilder.BuilderTest(self.write_func, 1024)
+
+        self.assertEqual(0, b.add_mget(b'key01', N=5, flags=1 | 2 | 4 | 8, opaque=b'op1'))
+        self.assertEqual(0, b.add_mget(b'key02', flags=1))
+        self.assertEqual(1, b.finish())
+
+        self.assertEqual([
+            b'mg key01 N5 c t f k Oop1 v\r\n' +
+            b'mg key02 c v\r\n',
+        ], self.write_list)
+
+        del b
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_add_mset_with_meta_flags(self) -> None:
+        b = cbuilder.BuilderTest(self.write_func, 1024)
+
+        self.assertEqual(0, b.add_mset(
+            b'key01', b'data 01', cas=12, ttl=30, client_flags=3,
+            flags=1 | 8 | 16, opaque=b'op2',
+        ))
+        self.assertEqual(0, b.add_mset(b'key02', b'XX', ttl=5))
+        self.assertEqual(1, b.finish())
+
+        self.assertEqual([
+            b'ms key01 7 C12 T30 F3 I c k Oop2\r\ndata 01\r\n' +
+            b'ms key02 2 T5\r\nXX\r\n',
+        ], self.write_list)
+
+        del b
+        self.assertEqual(0, cutil.py_get_mem())
+
 
 class TestBuilderWithWriteFull(unittest.TestCase):
     write_list: List[bytes]
@@ -288,3 +341,233 @@ class TestBuilderWithWriteFull(unittest.TestCase):
 
         self.resp_list = [0]
         self.assertEqual(2, b.finish())
+
+    def test_add_mget_write_error(self) -> None:
+        b = cbuilder.BuilderTest(self.write_func, 1024)
+
+        self.assertEqual(0, b.add_mget(b'key01'))
+
+        self.resp_list = [-1]
+        self.assertEqual(-1, b.finish())
+
+
+class TestBuilderWritev(unittest.TestCase):
+    write_list: List[List[bytes]]
+
+    def setUp(self) -> None:
+        self.write_list = []
+
+    def writev_func(self, segments: List[bytes]) -> int:
+        self.write_list.append(segments)
+        return sum(len(s) for s in segments)
+
+    def test_small_commands_coalesced(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 1024, writev=True)
+
+        self.assertEqual(0, b.add_mget(b'key01'))
+        self.assertEqual(0, b.add_mset(b'key02', b'data 02', cas=12))
+        self.assertEqual(0, b.add_delete(b'key03'))
+        self.assertEqual([], self.write_list)
+
+        self.assertEqual(1, b.finish())
+        self.assertEqual(0, b.finish())
+
+        self.assertEqual([[
+            b'mg key01 v\r\n' +
+            b'ms key02 7 C12\r\ndata 02\r\n' +
+            b'md key03\r\n',
+        ]], self.write_list)
+
+        del b
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_big_value_referenced(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 1024, writev=True)
+
+        value = b'A' * 100_000
+
+        self.assertEqual(0, b.add_mget(b'key01'))
+        self.assertEqual(1, b.add_mset(b'key02', value))
+        self.assertEqual(0, b.add_mget(b'key03'))
+
+        self.assertEqual([[
+            b'mg key01 v\r\nms key02 100000\r\n',
+            value,
+            b'\r\n',
+        ]], self.write_list)
+
+        self.assertEqual(1, b.finish())
+        self.assertEqual(0, b.finish())
+
+        self.assertEqual([
+            [b'mg key01 v\r\nms key02 100000\r\n', value, b'\r\n'],
+            [b'mg key03 v\r\n'],
+        ], self.write_list)
+
+        del b
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_many_values_below_limit(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 4096, writev=True)
+
+        value = b'B' * 1024
+
+        self.assertEqual(0, b.add_mset(b'key01', value))
+        self.assertEqual(0, b.add_mset(b'key02', value))
+        self.assertEqual(0, b.add_mset(b'key03', value))
+        self.assertEqual(1, b.add_mset(b'key04', value))
+
+        self.assertEqual([[
+            b'ms key01 1024\r\n', value,
+            b'\r\nms key02 1024\r\n', value,
+            b'\r\nms key03 1024\r\n', value,
+            b'\r\nms key04 1024\r\n', value,
+            b'\r\n',
+        ]], self.write_list)
+
+        self.assertEqual(0, b.finish())
+        self.assertEqual(1, len(self.write_list))
+
+    def test_partial_write(self) -> None:
+        written: List[bytes] = []
+        sizes = [5, 20, 100_000]
+
+        def writev_func(segments: List[bytes]) -> int:
+            data = b''.join(segments)[:sizes.pop(0)]
+            written.append(data)
+            return len(data)
+
+        b = cbuilder.BuilderTest(writev_func, 1024, writev=True)
+
+        value = b'C' * 2000
+        self.assertEqual(1, b.add_mset(b'key01', value))
+        self.assertEqual(0, b.finish())
+
+        self.assertEqual(b'ms key01 2000\r\n' + value + b'\r\n', b''.join(written))
+        self.assertEqual([5, 20, 1992], [len(w) for w in written])
+
+        self.assertEqual({
+            'bytes_written': 2017, 'flushes': 3, 'partial_writes': 2,
+            'full_stalls': 0, 'write_errors': 0,
+        }, b.stats())
+
+    def test_write_full(self) -> None:
+        b = cbuilder.BuilderTest(lambda segments: 0, 1024, writev=True)
+
+        self.assertEqual(0, b.add_mget(b'key01'))
+        self.assertEqual(2, b.finish())
+        self.assertEqual(2, b.finish())
+        self.assertEqual(2, b.stats()['full_stalls'])
+        self.assertEqual(0, b.stats()['bytes_written'])
+
+    def test_write_error(self) -> None:
+        b = cbuilder.BuilderTest(lambda segments: -1, 1024, writev=True)
+
+        self.assertEqual(-1, b.add_mset(b'key01', b'D' * 5000))
+
+
+class TestBuilderAutoCork(unittest.TestCase):
+    write_list: List[List[bytes]]
+
+    def setUp(self) -> None:
+        self.write_list = []
+
+    def writev_func(self, segments: List[bytes]) -> int:
+        self.write_list.append(segments)
+        return sum(len(s) for s in segments)
+
+    def tearDown(self) -> None:
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_write_limit_range(self) -> None:
+        b = cbuilder.BuilderTest(lambda data: len(data), 4096)
+        b.set_write_limit(100)
+        self.assertEqual(512, b.get_write_limit())
+        b.set_write_limit(100_000)
+        self.assertEqual(4096, b.get_write_limit())
+
+        b = cbuilder.BuilderTest(self.writev_func, 4096, writev=True)
+        b.set_write_limit(100_000)
+        self.assertEqual(65536, b.get_write_limit())
+
+    def test_referenced_values_in_one_write(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 4096, writev=True)
+        b.set_write_limit(65536)
+
+        value = b'A' * 2000
+        for i in range(20):
+            self.assertEqual(0, b.add_mset(b'key%02d' % i, value))
+        self.assertEqual(1, b.finish())
+        self.assertEqual(1, len(self.write_list))
+        self.assertEqual(20 * (len(b'ms key00 2000\r\n\r\n') + 2000), sum(len(s) for s in self.write_list[0]))
+
+    def test_copied_data_bounded(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 4096, writev=True)
+        b.set_write_limit(65536)
+
+        for i in range(1000):
+            b.add_mget(b'key%04d' % i)
+        b.finish()
+        self.assertEqual(b''.join(b'mg key%04d v\r\n' % i for i in range(1000)), b''.join(
+            s for segments in self.write_list for s in segments
+        ))
+        self.assertGreater(len(self.write_list), 1)
+
+    def test_lower_limit_below_buffered(self) -> None:
+        written: List[bytes] = []
+
+        def write_func(data: bytes) -> int:
+            written.append(data)
+            return len(data)
+
+        b = cbuilder.BuilderTest(write_func, 4096)
+        gets = b''.join(b'mg key%03d v\r\n' % i for i in range(200))
+        for i in range(200):
+            self.assertEqual(0, b.add_mget(b'key%03d' % i))
+        self.assertEqual([], written)
+
+        # auto cork lowers the limit while 3000 bytes are buffered
+        b.set_write_limit(100)
+        self.assertEqual(512, b.get_write_limit())
+
+        value = bytes(range(256)) * 8
+        self.assertEqual(1, b.add_mset(b'key200', value))
+        self.assertEqual(0, b.add_mget(b'key201'))
+        b.finish()
+
+        self.assertEqual(gets + b'ms key200 2048\r\n' + value + b'\r\nmg key201 v\r\n', b''.join(written))
+        self.assertLessEqual(max(len(w) for w in written), 512)
+
+    def test_adapt(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 4096, writev=True)
+        b.init_autocork(0.001)
+
+        # a single caller per batch is never delayed
+        b.autocork_record(10000, 1, 0.002)
+        self.assertEqual(0, b.autocork_delay())
+        self.assertEqual(20000, b.get_write_limit())
+
+        for _ in range(20):
+            b.autocork_record(10000, 4, 0.002)
+        self.assertAlmostEqual(0.0005, b.autocork_delay())
+
+        # the delay is capped at max_delay
+        for _ in range(50):
+            b.autocork_record(10000, 4, 0.1)
+        self.assertAlmostEqual(0.001, b.autocork_delay())
+
+        stats = b.autocork_stats()
+        self.assertEqual(71, stats['batches'])
+        self.assertEqual(2, stats['corked'])
+        self.assertEqual(20000, stats['write_limit'])
+        self.assertGreater(stats['avg_callers'], 3.9)
+
+        b.autocork_record(0, 100, 1)
+        self.assertEqual(71, b.autocork_stats()['batches'])
+
+    def test_disabled(self) -> None:
+        b = cbuilder.BuilderTest(self.writev_func, 4096, writev=True)
+        b.init_autocork(0)
+        for _ in range(20):
+            b.autocork_record(10000, 4, 0.002)
+        self.assertEqual(0, b.autocork_delay())
@@ -0,0 +1,203 @@
+import socket
+import unittest
+
+import ccache  # type: ignore
+import cmem  # type: ignore
+import csketch  # type: ignore
+import cutil  # type: ignore
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestSketch(unittest.TestCase):
+    def test_estimate(self) -> None:
+        s = csketch.SketchTest(1000)
+        self.assertEqual(1024, s.width())
+        self.assertEqual(4096, cutil.py_get_mem())
+
+        for i in range(5):
+            s.add(b'key01')
+        s.add(b'key02')
+
+        self.assertEqual(5, s.estimate(b'key01'))
+        self.assertEqual(1, s.estimate(b'key02'))
+        self.assertEqual(0, s.estimate(b'key03'))
+
+        del s
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_saturate_and_halve(self) -> None:
+        s = csketch.SketchTest(16)
+        for i in range(20):
+            s.add(b'key01')
+        self.assertEqual(15, s.estimate(b'key01'))
+
+        # the 160th addition of a width of 16 halves all the counters
+        for i in range(140):
+            s.add(f'other:{i}'.encode())
+        self.assertEqual(7, s.estimate(b'key01'))
+
+
+class TestNearCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def test_get_put_delete(self) -> None:
+        c = ccache.NearCache(1000, clock=self.clock)
+        self.assertIsNone(c.get(b'key01'))
+
+        c.put(b'key01', b'value01')
+        self.assertEqual(b'value01', c.get(b'key01'))
+        self.assertEqual(65536 + 7, cutil.py_get_mem())
+
+        c.delete(b'key01')
+        self.assertIsNone(c.get(b'key01'))
+        self.assertEqual({
+            'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 2, 'evictions': 0, 'rejections': 0,
+        }, c.stats())
+
+        del c
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_ttl(self) -> None:
+        c = ccache.NearCache(1000, max_ttl=10, clock=self.clock)
+        c.put(b'key01', b'A', 3)
+        c.put(b'key02', b'B')
+        c.put(b'key03', b'C', 0)
+        self.assertEqual(2, len(c))
+
+        self.clock.now += 3
+        self.assertIsNone(c.get(b'key01'))
+        self.assertEqual(b'B', c.get(b'key02'))
+
+        self.clock.now += 7
+        self.assertIsNone(c.get(b'key02'))
+        self.assertEqual(0, len(c))
+
+    def test_lru_eviction(self) -> None:
+        c = ccache.NearCache(30, clock=self.clock)
+        for i in range(3):
+            c.put(f'key0{i}'.encode(), b'X' * 10)
+        self.assertEqual(b'X' * 10, c.get(b'key00'))
+
+        c.get(b'key03')
+        c.get(b'key03')
+        c.put(b'key03', b'Y' * 10)
+
+        self.assertEqual(b'X' * 10, c.get(b'key00'))
+        self.assertIsNone(c.get(b'key01'))
+        self.assertEqual(30, c.stats()['bytes'])
+        self.assertEqual(1, c.stats()['evictions'])
+
+    def test_scan_does_not_evict_hot_keys(self) -> None:
+        c = ccache.NearCache(100, clock=self.clock)
+        for i in range(10):
+            key = f'hot:{i}'.encode()
+            for _ in range(3):
+                c.get(key)
+            c.put(key, b'H' * 10)
+
+        for i in range(1000):
+            key = f'scan:{i}'.encode()
+            c.get(key)
+            c.put(key, b'S' * 10)
+
+        for i in range(10):
+            self.assertEqual(b'H' * 10, c.get(f'hot:{i}'.encode()))
+        self.assertEqual(1000, c.stats()['rejections'])
+
+    def test_admission_before_eviction(self) -> None:
+        c = ccache.NearCache(30, clock=self.clock)
+        for i in range(3):
+            c.put(f'key0{i}'.encode(), b'X' * 10)
+        for _ in range(3):
+            c.get(b'key01')
+            c.get(b'key02')
+        c.get(b'key01')
+        c.get(b'big')
+
+        # the admission is decided once against the first victim, a hot victim
+        # does not reject the key after a colder one was evicted for it
+        c.put(b'big', b'B' * 20)
+        self.assertEqual(b'B' * 20, c.get(b'big'))
+        self.assertEqual(b'X' * 10, c.get(b'key01'))
+        self.assertEqual({'entries': 2, 'evictions': 2, 'rejections': 0},
+                         {k: v for k, v in c.stats().items() if k in ('entries', 'evictions', 'rejections')})
+
+        # a rejected key evicts nothing
+        c.put(b'cold', b'C' * 20)
+        self.assertIsNone(c.get(b'cold'))
+        self.assertEqual({'entries': 2, 'evictions': 2, 'rejections': 1},
+                         {k: v for k, v in c.stats().items() if k in ('entries', 'evictions', 'rejections')})
+
+    def test_too_big(self) -> None:
+        c = ccache.NearCache(10, clock=self.clock)
+        c.put(b'key01', b'X' * 11)
+        self.assertEqual(0, len(c))
+
+    def tearDown(self) -> None:
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestClientNearCache(unittest.TestCase):
+    def test_hits_skip_the_connection(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        cache = ccache.NearCache(1000)
+        c = cmem.Client(a, near_cache=cache)
+        p = c.pipeline()
+
+        r = p.get(b'cache:key01')
+        b.sendall(b'VA 3 t20\r\nABC\r\n')
+        self.assertEqual(b'ABC', r.result())
+        self.assertEqual(b'mg cache:key01 t v\r\n', b.recv(1024))
+
+        self.assertEqual(b'ABC', p.get(b'cache:key01').result())
+        self.assertEqual(b'ABC', p.get(bytearray(b'cache:key01')).result())
+        self.assertEqual(2, cache.stats()['hits'])
+        self.assertEqual(2, c.stats()['near_cache']['hits'])
+        self.assertEqual(1, c.stats()['responses']['mg'])
+        self.assertEqual(3, cutil.py_get_mem_stats()['cache'])
+
+        r = p.get(b'cache:key01', cas=True)
+        b.sendall(b'VA 3 c11\r\nABC\r\n')
+        self.assertEqual(11, r.cas)
+        self.assertEqual(b'mg cache:key01 c v\r\n', b.recv(1024))
+
+        p.delete(b'cache:key01')
+        r = p.get(b'cache:key01')
+        b.sendall(b'HD\r\nEN\r\n')
+        self.assertIsNone(r.result())
+        self.assertEqual(b'md cache:key01\r\nmg cache:key01 t v\r\n', b.recv(1024))
+        self.assertEqual(0, len(cache))
+
+        del c, p, r, cache
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_write_while_get_in_flight(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        cache = ccache.NearCache(1000)
+        c = cmem.Client(a, near_cache=cache)
+        p = c.pipeline()
+
+        r1 = p.get(b'cache:key02')
+        r2 = p.set(b'cache:key02', b'new')
+        b.sendall(b'VA 3 t-1\r\nold\r\nHD\r\n')
+
+        self.assertEqual(b'old', r1.result())
+        self.assertEqual(True, r2.result())
+        self.assertEqual(0, len(cache))
+
+        del c, p, r1, r2, cache
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
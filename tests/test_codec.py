@@ -0,0 +1,243 @@
+import json
+import random
+import socket
+import unittest
+import zlib
+
+import ccache  # type: ignore
+import ccodec  # type: ignore
+import cmem  # type: ignore
+import cutil  # type: ignore
+from mcproxy import fakeserver
+from mcproxy.memcache import AsyncClient
+
+JSON_VALUE = json.dumps([{'id': i, 'name': 'user %d' % i, 'active': True} for i in range(50)]).encode()
+
+
+class ReversedCodec:
+    def compress(self, data: bytes) -> bytes:
+        return data[:len(data) // 2][::-1]
+
+    def decompress(self, data: bytes) -> bytes:
+        return data[::-1] * 2
+
+
+class TestCompressor(unittest.TestCase):
+    def tearDown(self) -> None:
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_round_trip(self) -> None:
+        c = ccodec.Compressor(threshold=100)
+        data, flags = c.compress(JSON_VALUE)
+        self.assertEqual(1 << 16, flags)
+        self.assertLess(len(data) * 5, len(JSON_VALUE))
+        self.assertEqual(len(JSON_VALUE), int.from_bytes(data[:4], 'little'))
+        self.assertEqual(JSON_VALUE, zlib.decompress(data[4:]))
+
+        self.assertEqual(JSON_VALUE, c.decompress(data, flags))
+        self.assertEqual(data, c.decompress(data, 0))
+        self.assertEqual({
+            'compressed': 1, 'skipped': 0, 'decompressed': 1,
+            'bytes_before': len(JSON_VALUE), 'bytes_after': len(data),
+        }, c.stats())
+
+    def test_threshold_and_incompressible(self) -> None:
+        c = ccodec.Compressor(threshold=100)
+        self.assertEqual((b'x' * 99, 0), c.compress(b'x' * 99))
+
+        value = random.Random(1).randbytes(500)
+        self.assertEqual((value, 0), c.compress(value))
+        self.assertEqual(1, c.stats()['skipped'])
+
+    def test_buffer_inputs(self) -> None:
+        c = ccodec.Compressor(threshold=10, level=1)
+        data, flags = c.compress(memoryview(bytearray(b'a' * 1000)))
+        self.assertEqual(b'a' * 1000, c.decompress(data, flags))
+
+    def test_custom_codec(self) -> None:
+        c = ccodec.Compressor(threshold=4, flag=1 << 10, codec=ReversedCodec())
+        self.assertEqual((b'ba', 1 << 10), c.compress(b'abab'))
+        self.assertEqual(b'abab', c.decompress(b'ba', 1 << 10))
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            ccodec.Compressor(level=10)
+        with self.assertRaises(ValueError):
+            ccodec.Compressor(flag=3)
+
+        c = ccodec.Compressor()
+        with self.assertRaises(ValueError):
+            c.decompress(b'\x01', ccodec.COMPRESSED_FLAG)
+        with self.assertRaises(ValueError):
+            c.decompress(b'\x10\x00\x00\x00garbage', ccodec.COMPRESSED_FLAG)
+        with self.assertRaises(ValueError):
+            c.decompress(b'\xff\xff\xff\xff' + zlib.compress(b'abc'), ccodec.COMPRESSED_FLAG)
+
+
+class TestClientCompression(unittest.TestCase):
+    def test_set_get(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        compressor = ccodec.Compressor(threshold=100)
+        c = cmem.Client(a, compressor=compressor)
+        p = c.pipeline()
+
+        data, _ = compressor.compress(JSON_VALUE)
+        r = p.set(b'codec:key01', JSON_VALUE, client_flags=3)
+        b.sendall(b'HD\r\n')
+        self.assertTrue(r.result())
+        self.assertEqual(b'ms codec:key01 %d F65539\r\n%s\r\n' % (len(data), data), b.recv(4096))
+
+        r1 = p.get(b'codec:key01', client_flags=True)
+        r2 = p.get(b'codec:key02')
+        b.sendall(b'VA %d f65539\r\n%s\r\nVA 5 f0\r\nsmall\r\n' % (len(data), data))
+        self.assertEqual(JSON_VALUE, r1.result())
+        self.assertEqual(3, r1.client_flags)
+        self.assertEqual(b'small', r2.result())
+        self.assertEqual(b'mg codec:key01 f v\r\nmg codec:key02 f v\r\n', b.recv(4096))
+        self.assertEqual(1, c.stats()['compression']['decompressed'])
+
+        with self.assertRaises(ValueError):
+            p.set(b'codec:key01', JSON_VALUE, client_flags=ccodec.COMPRESSED_FLAG)
+
+        del c, p, r, r1, r2, compressor
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_invalid_value_fails_only_its_result(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        c = cmem.Client(a, compressor=ccodec.Compressor())
+        p = c.pipeline()
+        r1 = p.get(b'codec:key01')
+        r2 = p.get(b'codec:key02')
+        b.sendall(b'VA 3 f65536\r\nabc\r\nVA 3 f0\r\nabc\r\n')
+
+        with self.assertRaises(ValueError):
+            r1.result()
+        self.assertEqual(b'abc', r2.result())
+        self.assertIsNone(c.error)
+
+        del c, p, r1, r2
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestAsyncClientCompression(unittest.IsolatedAsyncioTestCase):
+    async def test_set_get(self) -> None:
+        with fakeserver.ServerThread() as server:
+            compressor = ccodec.Compressor(threshold=100)
+            c = await AsyncClient.connect(server.host, server.port, compressor=compressor)
+
+            self.assertTrue(await c.set(b'codec:key01', JSON_VALUE))
+            self.assertEqual(JSON_VALUE, await c.get(b'codec:key01'))
+            self.assertEqual(1, c.stats()['compression']['compressed'])
+            self.assertEqual(1, c.stats()['compression']['decompressed'])
+            c.close()
+
+
+class TestSerializer(unittest.TestCase):
+    def test_native_types(self) -> None:
+        s = ccodec.Serializer()
+        cases = [
+            (b'abc', b'abc', ccodec.TYPE_BYTES),
+            ('h\xe9llo', 'h\xe9llo'.encode(), ccodec.TYPE_STR),
+            (0, b'0', ccodec.TYPE_INT),
+            (-42, b'-42', ccodec.TYPE_INT),
+            (2 ** 63 - 1, b'9223372036854775807', ccodec.TYPE_INT),
+            (-2 ** 63, b'-9223372036854775808', ccodec.TYPE_INT),
+            (10 ** 30, b'1' + b'0' * 30, ccodec.TYPE_INT),
+            (1.5, b'1.5', ccodec.TYPE_FLOAT),
+            (3.0, b'3.0', ccodec.TYPE_FLOAT),
+            (float('inf'), b'inf', ccodec.TYPE_FLOAT),
+        ]
+        for value, data, flags in cases:
+            self.assertEqual((data, flags), s.dumps(value))
+            self.assertEqual(value, s.loads(data, flags))
+            self.assertIs(type(value), type(s.loads(data, flags)))
+
+        self.assertEqual((bytearray(b'abc'), 0), s.dumps(bytearray(b'abc')))
+        self.assertEqual({'native': 11, 'serialized': 0}, s.stats())
+
+    def test_fallback(self) -> None:
+        s = ccodec.Serializer()
+        for value in [None, True, [1, 'a'], {'a': (1, 2.5)}]:
+            data, flags = s.dumps(value)
+            self.assertEqual(ccodec.TYPE_SERIALIZED, flags)
+            self.assertEqual(value, s.loads(data, flags))
+
+        s = ccodec.Serializer(json)
+        self.assertEqual((b'{"a": [1, 2]}', ccodec.TYPE_SERIALIZED), s.dumps({'a': [1, 2]}))
+        self.assertEqual({'a': [1, 2]}, s.loads(b'{"a": [1, 2]}', ccodec.TYPE_SERIALIZED))
+        self.assertEqual(1, s.stats()['serialized'])
+
+    def test_invalid(self) -> None:
+        s = ccodec.Serializer()
+        with self.assertRaises(ValueError):
+            s.loads(b'12a', ccodec.TYPE_INT)
+        with self.assertRaises(ValueError):
+            s.loads(b'', ccodec.TYPE_INT)
+        with self.assertRaises(ValueError):
+            s.loads(b'1.5x', ccodec.TYPE_FLOAT)
+        with self.assertRaises(ValueError):
+            s.loads(b'1', ccodec.TYPE_INT | ccodec.TYPE_STR)
+
+
+class TestClientSerializer(unittest.TestCase):
+    def test_set_get(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        c = cmem.Client(a, serializer=ccodec.Serializer(), compressor=ccodec.Compressor(threshold=100))
+        p = c.pipeline()
+
+        results = [
+            p.set(b'ser:key01', 42),
+            p.set(b'ser:key02', 'abc', client_flags=1 << 8),
+            p.set(b'ser:key03', 2.5),
+        ]
+        b.sendall(b'HD\r\n' * 3)
+        self.assertEqual([True] * 3, [r.result() for r in results])
+        self.assertEqual(
+            b'ms ser:key01 2 F2\r\n42\r\nms ser:key02 3 F272\r\nabc\r\nms ser:key03 3 F32\r\n2.5\r\n',
+            b.recv(4096),
+        )
+
+        value = ['x' * 10] * 100
+        data, _ = ccodec.Compressor(threshold=100).compress(ccodec.Serializer().dumps(value)[0])
+        r1 = p.get(b'ser:key01')
+        r2 = p.get(b'ser:key02', client_flags=True)
+        r3 = p.get(b'ser:key04')
+        b.sendall(b'VA 2 f2\r\n42\r\nVA 3 f272\r\nabc\r\nVA %d f65537\r\n%s\r\n' % (len(data), data))
+        self.assertEqual(42, r1.result())
+        self.assertEqual('abc', r2.result())
+        self.assertEqual(1 << 8, r2.client_flags)
+        self.assertEqual(value, r3.result())
+        b.recv(4096)
+
+        with self.assertRaises(ValueError):
+            p.set(b'ser:key01', 1, client_flags=ccodec.TYPE_INT)
+
+        del c, p, results, r1, r2, r3
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_near_cache_keeps_type(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        c = cmem.Client(a, near_cache=ccache.NearCache(1000), serializer=ccodec.Serializer())
+        p = c.pipeline()
+        r = p.get(b'ser:key01')
+        b.sendall(b'VA 2 t20 f2\r\n42\r\n')
+        self.assertEqual(42, r.result())
+        self.assertEqual(b'mg ser:key01 t f v\r\n', b.recv(1024))
+
+        self.assertEqual(42, p.get(b'ser:key01').result())
+        self.assertEqual(1, c.stats()['near_cache']['hits'])
+
+        del c, p, r
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
@@ -7,6 +7,54 @@ class TestCUtil(unittest.TestCase):
     def test_alloc(self) -> None:
         self.assertEqual(0, cutil.py_get_mem())
 
+    def test_mem_stats(self) -> None:
+        self.assertEqual({
+            'total': 0, 'other': 0, 'parser': 0, 'builder': 0,
+            'client': 0, 'cache': 0, 'sketch': 0, 'ring': 0,
+        }, cutil.py_get_mem_stats())
+
+        c = cutil.TestContainer(21)
+        self.assertEqual(40, cutil.py_get_mem_stats()['other'])
+        self.assertEqual(40, cutil.py_get_mem_stats()['total'])
+
+        c.destroy()
+        self.assertEqual(0, cutil.py_get_mem_stats()['other'])
+
+
+class TestSlab(unittest.TestCase):
+    def tearDown(self) -> None:
+        cutil.py_set_zero_on_free(False)
+
+    def test_reuse(self) -> None:
+        import cparser  # type: ignore
+
+        cutil.py_slab_trim()
+        self.assertEqual(0, cutil.py_get_slab_stats()['cached_bytes'])
+
+        p = cparser.ParserTest()
+        del p
+        self.assertGreater(cutil.py_get_slab_stats()['cached_bytes'], 0)
+        self.assertEqual(0, cutil.py_get_mem())
+
+        hits = cutil.py_get_slab_stats()['hits']
+        p = cparser.ParserTest()
+        self.assertGreater(cutil.py_get_slab_stats()['hits'], hits)
+        self.assertEqual(0, cutil.py_get_slab_stats()['cached_bytes'])
+        self.assertGreater(cutil.py_get_mem_stats()['parser'], 0)
+        del p
+
+        cutil.py_slab_trim()
+        self.assertEqual(0, cutil.py_get_slab_stats()['cached_bytes'])
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_zero_on_free(self) -> None:
+        cutil.py_set_zero_on_free(True)
+        for _ in range(3):
+            c = cutil.TestContainer(21)
+            self.assertEqual(21, c.get_age())
+            c.destroy()
+        self.assertEqual(0, cutil.py_get_mem())
+
 
 class TestSharedPointer(unittest.TestCase):
     def test_normal(self) -> None:
@@ -16,6 +64,19 @@ class TestSharedPointer(unittest.TestCase):
         c.destroy()
         self.assertEqual(0, cutil.py_get_mem())
 
+    def test_misuse_is_counted(self) -> None:
+        errors = cutil.py_get_ptr_errors()
+        c = cutil.TestContainer(21)
+        self.assertTrue(c.get_copied())
+        self.assertEqual(errors + 1, cutil.py_get_ptr_errors())
+
+        # a second free of the same pointer does nothing, a free of an unset one is counted
+        c.destroy()
+        c.destroy()
+        c.release_weak()
+        self.assertEqual(errors + 2, cutil.py_get_ptr_errors())
+        self.assertEqual(0, cutil.py_get_mem())
+
     def test_weak_ptr_clone(self) -> None:
         c = cutil.TestContainer(21)
 
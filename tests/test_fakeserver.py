@@ -0,0 +1,194 @@
+import socket
+import time
+import unittest
+from typing import Optional
+
+import cmem  # type: ignore
+from mcproxy import fakeserver, loadgen
+from mcproxy.memcache import Client
+
+
+class _ServerTestCase(unittest.TestCase):
+    shaping: Optional[fakeserver.Shaping] = None
+
+    def setUp(self) -> None:
+        self.server = fakeserver.ServerThread(shaping=self.shaping)
+
+    def tearDown(self) -> None:
+        self.server.close()
+
+    def new_socket(self) -> socket.socket:
+        return socket.create_connection((self.server.host, self.server.port))
+
+    def assert_response(self, data: bytes, expected: bytes) -> None:
+        with self.new_socket() as s:
+            s.sendall(data)
+            out = b''
+            while len(out) < len(expected):
+                chunk = s.recv(4096)
+                if not chunk:
+                    break
+                out += chunk
+        self.assertEqual(expected, out)
+
+
+class TestFakeServer(_ServerTestCase):
+    def test_client(self) -> None:
+        c = cmem.Client(self.new_socket())
+        p = c.pipeline()
+        r1 = p.set(b'key01', b'value01', ttl=100, client_flags=5)
+        r2 = p.get(b'key01', ttl=True, client_flags=True, cas=True)
+        r3 = p.get(b'key02')
+        r4 = p.delete(b'key01')
+        r5 = p.delete(b'key01')
+        r6 = p.get(b'key01')
+        p.execute()
+
+        self.assertTrue(r1.result())
+        self.assertEqual(b'value01', r2.result())
+        self.assertEqual(100, r2.ttl)
+        self.assertEqual(5, r2.client_flags)
+        self.assertGreater(r2.cas, 0)
+        self.assertIsNone(r3.result())
+        self.assertTrue(r4.result())
+        self.assertFalse(r5.result())
+        self.assertIsNone(r6.result())
+        self.assertEqual(0, len(self.server.store))
+
+    def test_get_or_fill(self) -> None:
+        c = Client(self.new_socket)
+        calls = []
+
+        def loader(key: bytes) -> bytes:
+            calls.append(key)
+            return b'filled'
+
+        self.assertEqual(b'filled', c.get_or_fill(b'key01', loader))
+        self.assertEqual(b'filled', c.get_or_fill(b'key01', loader))
+        self.assertEqual([b'key01'], calls)
+
+    def test_lease_and_stale(self) -> None:
+        self.assert_response(
+            b'mg key01 N30 c v\r\nmg key01 N30 v\r\n',
+            b'VA 0 c1 W\r\n\r\nVA 0 Z\r\n\r\n',
+        )
+        self.assert_response(
+            b'ms key01 2 C1\r\nab\r\nmd key01 I\r\nmg key01 v c\r\nmg key01 v\r\n',
+            b'HD\r\nHD\r\nVA 2 c3 X W\r\nab\r\nVA 2 X Z\r\nab\r\n',
+        )
+        self.assert_response(
+            b'ms key01 2 C2\r\ncd\r\nms key01 2 C3\r\nef\r\nmg key01 v\r\n',
+            b'EX\r\nHD\r\nVA 2\r\nef\r\n',
+        )
+
+    def test_quiet_and_other_commands(self) -> None:
+        self.assert_response(
+            b'mg key01 v q\r\nms key01 2 q\r\nab\r\nmd key02 q\r\nmg key01 v q k\r\n'
+            b'mn\r\nversion\r\nstats\r\nflush_all\r\nmg key01 v\r\n',
+            b'VA 2 kkey01\r\nab\r\nMN\r\nVERSION 1.6.21-fake\r\nERROR\r\nOK\r\nEN\r\n',
+        )
+
+    def test_invalid_request_closes(self) -> None:
+        self.assert_response(b'mn\r\nmg\r\nmn\r\n', b'MN\r\nCLIENT_ERROR bad command line format\r\n')
+
+    def test_expire(self) -> None:
+        now = [100.0]
+        store = fakeserver.FakeStore(clock=lambda: now[0])
+        store.meta_set(b'key01', [b'T10'], b'value')
+        self.assertEqual(b'HD t10\r\n', store.meta_get(b'key01', [b't']))
+
+        now[0] = 109.5
+        self.assertEqual(b'HD t1\r\n', store.meta_get(b'key01', [b't']))
+
+        now[0] = 110
+        self.assertEqual(b'EN\r\n', store.meta_get(b'key01', [b't']))
+        self.assertEqual(0, len(store))
+
+
+class TestFakeServerShaping(_ServerTestCase):
+    shaping = fakeserver.Shaping(latency=0.05, jitter=0.02, seed=1)
+
+    def test_latency_keeps_order(self) -> None:
+        c = cmem.Client(self.new_socket())
+        start = time.monotonic()
+        results = []
+        for i in range(5):
+            p = c.pipeline()
+            results.append(p.set(b'key%02d' % i, b'value%d' % i))
+            p.execute()
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.25)
+        self.assertLess(elapsed, 0.25 + 5 * 0.02 + 0.3)
+
+        s = self.new_socket()
+        s.sendall(b''.join(b'mg key%02d v\r\n' % i for i in range(5)))
+        time.sleep(0.01)
+        s.sendall(b'mn\r\n')
+        out = b''
+        while not out.endswith(b'MN\r\n'):
+            out += s.recv(4096)
+        s.close()
+        self.assertEqual(b''.join(b'VA 6\r\nvalue%d\r\n' % i for i in range(5)) + b'MN\r\n', out)
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            fakeserver.Shaping(latency=-1)
+
+
+class TestFakeServerBandwidth(_ServerTestCase):
+    shaping = fakeserver.Shaping(bandwidth=1000000)
+
+    def test_bandwidth(self) -> None:
+        c = cmem.Client(self.new_socket())
+        p = c.pipeline()
+        for i in range(3):
+            p.set(b'key%02d' % i, b'x' * 100000)
+        p.execute()
+
+        start = time.monotonic()
+        p = c.pipeline()
+        results = [p.get(b'key%02d' % i) for i in range(3)]
+        p.execute()
+        elapsed = time.monotonic() - start
+
+        self.assertEqual([b'x' * 100000] * 3, [r.result() for r in results])
+        self.assertGreaterEqual(elapsed, 0.3)
+
+
+class TestLoadGen(_ServerTestCase):
+    def test_percentile(self) -> None:
+        values = [float(i) for i in range(1, 1001)]
+        self.assertEqual(500, loadgen.percentile(values, 0.5))
+        self.assertEqual(990, loadgen.percentile(values, 0.99))
+        self.assertEqual(999, loadgen.percentile(values, 0.999))
+        self.assertEqual(1, loadgen.percentile(values, 0))
+        self.assertEqual(0, loadgen.percentile([], 0.5))
+
+    def test_closed_loop(self) -> None:
+        res = loadgen.run_load(
+            self.new_socket, duration=0.3, concurrency=4, conns=1, depth=4, keys=50, set_ratio=0.2,
+        )
+        self.assertEqual('closed', res['mode'])
+        self.assertEqual(1, res['conns'])
+        self.assertEqual(50, len(self.server.store))
+        self.assertGreater(res['pipelines'], 0)
+        self.assertEqual(res['pipelines'] * 4, res['ops'])
+        self.assertEqual(0, res['errors'])
+        self.assertEqual(0, res['misses'])
+
+        lat = res['latency_ms']
+        self.assertLessEqual(lat['p50'], lat['p99'])
+        self.assertLessEqual(lat['p99'], lat['p999'])
+        self.assertLessEqual(lat['p999'], lat['max'])
+
+    def test_open_loop(self) -> None:
+        res = loadgen.run_load(
+            self.new_socket, duration=0.5, concurrency=2, conns=1, qps=100, keys=10, warm=False,
+        )
+        self.assertEqual('open', res['mode'])
+        self.assertIn(res['pipelines'], (49, 50, 51))
+        self.assertEqual(0, res['errors'])
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            loadgen.run_load(self.new_socket, concurrency=0)
@@ -0,0 +1,78 @@
+import unittest
+
+import chealth  # type: ignore
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_consecutive_errors(self) -> None:
+        clock = FakeClock()
+        b = chealth.CircuitBreaker(max_errors=3, eject_time=1, max_eject_time=3, clock=clock)
+
+        b.py_record_error()
+        b.py_record_error()
+        b.py_record_success(0.001)
+        b.py_record_error()
+        b.py_record_error()
+        self.assertTrue(b.py_allow())
+
+        b.py_record_error()
+        self.assertFalse(b.py_allow())
+        self.assertEqual('open', b.stats()['state'])
+        self.assertEqual('errors', b.stats()['reason'])
+
+        # probes are due after the ejection time, which doubles after every failed probe
+        self.assertFalse(b.py_start_probe())
+        for eject_time in [1, 2, 3, 3]:
+            clock.now += eject_time - 0.01
+            self.assertFalse(b.py_start_probe())
+            clock.now += 0.01
+            self.assertTrue(b.py_start_probe())
+            self.assertEqual('half_open', b.stats()['state'])
+            self.assertFalse(b.py_allow())
+            b.py_end_probe(False)
+
+        clock.now += 3
+        self.assertTrue(b.py_start_probe())
+        b.py_end_probe(True)
+        self.assertTrue(b.py_allow())
+
+        stats = b.stats()
+        self.assertEqual('closed', stats['state'])
+        self.assertEqual(1, stats['ejections'])
+        self.assertEqual(5, stats['probes'])
+        self.assertEqual(1, stats['recoveries'])
+
+    def test_latency(self) -> None:
+        b = chealth.CircuitBreaker(max_latency=0.01, clock=FakeClock())
+
+        # a few slow responses do not eject a node before the average is known
+        for _ in range(7):
+            b.py_record_success(0.05)
+        self.assertTrue(b.py_allow())
+
+        c = b.clone()
+        for _ in range(20):
+            c.py_record_success(0.001)
+        for _ in range(3):
+            c.py_record_success(0.02)
+        self.assertTrue(c.py_allow())
+
+        for _ in range(20):
+            c.py_record_success(0.02)
+        self.assertFalse(c.py_allow())
+        self.assertEqual('latency', c.stats()['reason'])
+        self.assertTrue(b.py_allow())
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            chealth.CircuitBreaker(max_errors=0)
+        with self.assertRaises(ValueError):
+            chealth.CircuitBreaker(eject_time=2, max_eject_time=1)
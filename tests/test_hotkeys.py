@@ -0,0 +1,95 @@
+import socket
+import unittest
+
+import chotkeys  # type: ignore
+import cmem  # type: ignore
+import cutil  # type: ignore
+from mcproxy import fakeserver
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestHotKeys(unittest.TestCase):
+    def test_top_k(self) -> None:
+        clock = FakeClock()
+        h = chotkeys.HotKeys(k=4, sample_rate=1, clock=clock)
+
+        for i in range(2000):
+            h.sample(b'hot:%d' % (i % 3), 10)
+            h.sample(b'cold:%d' % i, 1000)
+        clock.now += 10
+
+        top = h.top()
+        self.assertEqual(4, len(top))
+        self.assertEqual({b'hot:0', b'hot:1', b'hot:2'}, {t['key'] for t in top[:3]})
+        for t in top[:3]:
+            self.assertAlmostEqual(2000 / 3 / 10, t['qps'], delta=1)
+            self.assertAlmostEqual(2000 / 3, t['bytes_per_sec'], delta=10)
+
+        self.assertEqual([top[0]], h.top(1))
+        stats = h.stats()
+        self.assertEqual(4000, stats['sampled'])
+        self.assertEqual(4, stats['keys'])
+        self.assertGreater(stats['rejected'], 1900)
+
+        h.clear()
+        self.assertEqual([], h.top())
+
+    def test_sample_rate(self) -> None:
+        h = chotkeys.HotKeys(sample_rate=100)
+        sampled = sum(h.sample(b'key01') for _ in range(100000))
+        self.assertAlmostEqual(1000, sampled, delta=100)
+        self.assertEqual(sampled, h.stats()['sampled'])
+
+    def test_decay_replaces_cooled_keys(self) -> None:
+        clock = FakeClock()
+        h = chotkeys.HotKeys(k=2, sample_rate=1, decay_interval=10, clock=clock)
+
+        for _ in range(12):
+            h.sample(b'old:1')
+            h.sample(b'old:2')
+        self.assertEqual({b'old:1', b'old:2'}, {t['key'] for t in h.top()})
+
+        for _ in range(12):
+            clock.now += 10
+            for _ in range(4):
+                h.sample(b'new:1')
+                h.sample(b'new:2')
+        self.assertEqual({b'new:1', b'new:2'}, {t['key'] for t in h.top()})
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            chotkeys.HotKeys(k=0)
+        with self.assertRaises(ValueError):
+            chotkeys.HotKeys(sample_rate=0)
+
+
+class TestClientHotKeys(unittest.TestCase):
+    def test_client(self) -> None:
+        h = chotkeys.HotKeys(k=8, sample_rate=1)
+        with fakeserver.ServerThread() as server:
+            c = cmem.Client(socket.create_connection((server.host, server.port)), hot_keys=h)
+            p = c.pipeline()
+            p.set(b'key01', b'x' * 100)
+            p.execute()
+            for _ in range(5):
+                r = p.get(b'key01')
+                p.get(b'key02')
+                p.execute()
+                self.assertEqual(b'x' * 100, r.result())
+
+            top = h.top()
+            self.assertEqual([b'key01', b'key02'], [t['key'] for t in top])
+            self.assertAlmostEqual(6, top[0]['qps'], delta=0.1)
+            self.assertAlmostEqual(600, top[0]['bytes_per_sec'], delta=10)
+            self.assertEqual(0, top[1]['bytes_per_sec'])
+            self.assertEqual(11, c.stats()['hot_keys']['sampled'])
+
+            del c, p, r, h
+        self.assertEqual(0, cutil.py_get_mem())
@@ -0,0 +1,176 @@
+import socket
+import time
+import unittest
+from typing import Any, Dict, List
+
+from mcproxy import fakeserver
+from mcproxy.invalidation import InvalidationQueue
+from mcproxy.memcache import Client
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class _Result:
+    def __init__(self, error: Any):
+        self.error = error
+
+    def result(self) -> bool:
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class FailingClient:
+    """Fails the deletes of a key the number of times given in failures."""
+
+    def __init__(self, failures: Dict[bytes, int]):
+        self.failures = failures
+        self.deletes: List[bytes] = []
+
+    def pipeline(self) -> 'FailingClient':
+        return self
+
+    def delete(self, key: bytes, invalidate: bool = False) -> _Result:
+        self.deletes.append(key)
+        if self.failures.get(key, 0) > 0:
+            self.failures[key] -= 1
+            return _Result(ConnectionError('failed'))
+        return _Result(None)
+
+    def execute(self) -> None:
+        pass
+
+
+class TestInvalidationQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = fakeserver.ServerThread()
+        self.client = Client(lambda: socket.create_connection((self.server.host, self.server.port)))
+
+    def tearDown(self) -> None:
+        del self.client
+        self.server.close()
+
+    def set_keys(self, keys: List[bytes]) -> None:
+        p = self.client.pipeline()
+        for k in keys:
+            p.set(k, b'value')
+        p.execute()
+
+    def test_dedupe_and_commit(self) -> None:
+        keys = [b'key%02d' % i for i in range(5)]
+        self.set_keys(keys)
+
+        q = InvalidationQueue(self.client, background=False)
+        for _ in range(3):
+            q.add_many(keys)
+        q.add(b'missing')
+        self.assertEqual(6, len(q))
+        self.assertEqual(5, len(self.server.store))
+
+        q.commit()
+        self.assertEqual(0, len(q))
+        self.assertEqual(0, len(self.server.store))
+        self.assertEqual({
+            'queued': 0, 'retrying': 0, 'added': 16, 'deduped': 10,
+            'sent': 6, 'retried': 0, 'failed': 0, 'flushes': 1,
+        }, q.stats())
+        self.assertEqual(0, q.flush())
+
+    def test_invalidate_marks_stale(self) -> None:
+        self.set_keys([b'key01'])
+
+        q = InvalidationQueue(self.client, invalidate=True, background=False)
+        q.add(b'key01')
+        q.commit()
+
+        p = self.client.pipeline()
+        r = p.get(b'key01')
+        p.execute()
+        self.assertEqual(b'value', r.result())
+        self.assertTrue(r.stale)
+
+    def test_size_and_time_thresholds(self) -> None:
+        clock = FakeClock()
+        q = InvalidationQueue(self.client, max_keys=3, max_delay=1, background=False, clock=clock)
+
+        q.add_many([b'key01', b'key02'])
+        self.assertEqual(0, q.poll())
+        q.add(b'key03')
+        self.assertEqual(0, len(q))
+
+        q.add(b'key04')
+        clock.now += 0.5
+        self.assertEqual(0, q.poll())
+        clock.now += 0.5
+        self.assertEqual(1, q.poll())
+        self.assertEqual(2, q.stats()['flushes'])
+
+    def test_background(self) -> None:
+        self.set_keys([b'key01', b'key02'])
+
+        with InvalidationQueue(self.client, max_delay=0.01) as q:
+            q.add(b'key01')
+            deadline = time.monotonic() + 2
+            while len(self.server.store) > 1 and time.monotonic() < deadline:
+                time.sleep(0.005)
+            self.assertEqual(1, len(self.server.store))
+
+            q.add(b'key02')
+            q.commit()
+        self.assertEqual(0, len(self.server.store))
+
+        with self.assertRaises(RuntimeError):
+            q.add(b'key01')
+
+    def test_retry_with_backoff(self) -> None:
+        clock = FakeClock()
+        failed = []
+        c = FailingClient({b'key01': 2, b'key02': 10})
+        q = InvalidationQueue(
+            c, max_attempts=3, backoff=1, background=False, clock=clock,
+            on_failure=lambda key, ex: failed.append(key),
+        )
+
+        q.add_many([b'key01', b'key02', b'key03'])
+        q.commit()
+        self.assertEqual(2, q.stats()['retrying'])
+
+        self.assertEqual(0, q.poll())
+        clock.now += 1
+        self.assertEqual(2, q.poll())
+
+        # the second retry waits twice as long
+        clock.now += 1
+        self.assertEqual(0, q.poll())
+        clock.now += 1
+        self.assertEqual(2, q.poll())
+
+        self.assertEqual([b'key02'], failed)
+        self.assertEqual(0, len(q))
+        self.assertEqual([b'key01', b'key02', b'key03'] + [b'key01', b'key02'] * 2, c.deletes)
+
+        stats = q.stats()
+        self.assertEqual(4, stats['retried'])
+        self.assertEqual(1, stats['failed'])
+
+    def test_add_during_retry_sends_now(self) -> None:
+        clock = FakeClock()
+        c = FailingClient({b'key01': 1})
+        q = InvalidationQueue(c, backoff=10, background=False, clock=clock)
+
+        q.add(b'key01')
+        q.commit()
+        q.add(b'key01')
+        q.commit()
+        self.assertEqual([b'key01', b'key01'], c.deletes)
+        self.assertEqual(0, len(q))
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            InvalidationQueue(self.client, max_keys=0, background=False)
@@ -0,0 +1,101 @@
+import unittest
+from typing import Any, Dict, List
+
+import clatency  # type: ignore
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self) -> None:
+        h = clatency.Histogram()
+        self.assertEqual(0, h.snapshot()['p99'])
+
+        for i in range(1, 10001):
+            h.py_record(i * 1e-6)
+        s = h.snapshot()
+
+        self.assertEqual(10000, s['count'])
+        self.assertEqual(10000, len(h))
+        self.assertAlmostEqual(1e-6, s['min'])
+        self.assertAlmostEqual(0.01, s['max'])
+        self.assertAlmostEqual(0.0050005, s['mean'])
+        for key, expected in [('p50', 0.005), ('p90', 0.009), ('p99', 0.0099), ('p999', 0.00999)]:
+            self.assertGreaterEqual(s[key], expected)
+            self.assertLessEqual(s[key], expected * 1.035)
+
+    def test_small_and_large_values(self) -> None:
+        h = clatency.Histogram()
+        h.py_record(-1)
+        h.py_record(0)
+        h.py_record(17e-9)
+        self.assertEqual(0, h.snapshot()['p50'])
+        self.assertAlmostEqual(17e-9, h.snapshot()['max'])
+
+        # values beyond the range of the buckets are clamped
+        h.py_record(1000)
+        self.assertAlmostEqual(68.72, h.snapshot()['max'], places=2)
+        self.assertAlmostEqual(68.72, h.snapshot()['p999'], places=2)
+
+    def test_merge_and_clear(self) -> None:
+        a = clatency.Histogram()
+        b = clatency.Histogram()
+        for i in range(100):
+            a.py_record(0.001)
+            b.py_record(0.1)
+
+        a.merge(b)
+        s = a.snapshot()
+        self.assertEqual(200, s['count'])
+        self.assertAlmostEqual(0.001, s['min'])
+        self.assertAlmostEqual(0.1, s['max'])
+        self.assertLessEqual(s['p50'], 0.001 * 1.035)
+        self.assertGreaterEqual(s['p90'], 0.1 * 0.97)
+
+        a.clear()
+        self.assertEqual({'count': 0, 'min': 0, 'max': 0, 'mean': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'p999': 0},
+                         a.snapshot())
+
+
+class TestLatencyRecorder(unittest.TestCase):
+    def test_slow_callback(self) -> None:
+        slow: List[Dict[str, Any]] = []
+        r = clatency.LatencyRecorder(slow_threshold=0.01, on_slow=slow.append)
+        r.py_record_pipeline(0.0001, 0.0005, 0.0002, 0.001, 3)
+        r.py_record_pipeline(0.0001, -1, 0.0002, 0.02, 5)
+
+        self.assertEqual([{
+            'node': None, 'seconds': 0.02, 'flush': 0.0001, 'first_byte': None, 'parse': 0.0002, 'requests': 5,
+        }], slow)
+
+        s = r.snapshot()
+        self.assertEqual(1, s['slow'])
+        self.assertEqual(2, s['pipeline']['count'])
+        self.assertEqual(2, s['flush']['count'])
+        self.assertEqual(1, s['first_byte']['count'])
+        self.assertEqual({'mg', 'ms', 'md'}, set(s['commands']))
+
+        r.clear()
+        self.assertEqual(0, r.snapshot()['slow'])
+        self.assertEqual(0, r.snapshot()['pipeline']['count'])
+
+    def test_callback_errors_are_ignored(self) -> None:
+        def on_slow(info: dict) -> None:
+            raise RuntimeError('failed')
+
+        r = clatency.LatencyRecorder(slow_threshold=0.01, on_slow=on_slow)
+        r.py_record_pipeline(0, 0, 0, 0.02, 1)
+        self.assertEqual(1, r.snapshot()['slow'])
+
+    def test_clone(self) -> None:
+        slow: List[Dict[str, Any]] = []
+        r = clatency.LatencyRecorder(slow_threshold=0.01, on_slow=slow.append)
+        r.py_record_pipeline(0, 0, 0, 0.001, 1)
+
+        c = r.clone('node1')
+        self.assertEqual('node1', c.name)
+        self.assertEqual(0, c.snapshot()['pipeline']['count'])
+        c.py_record_pipeline(0, 0, 0, 0.02, 1)
+        self.assertEqual('node1', slow[0]['node'])
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            clatency.LatencyRecorder(slow_threshold=-1)
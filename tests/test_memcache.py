@@ -1,9 +1,21 @@
+import asyncio
+import functools
+import gc
 import socket
+import threading
+import time
 import unittest
+from typing import Any, Callable, Dict, List, Set
 
+import ccodec  # type: ignore
+import chealth  # type: ignore
+import clatency  # type: ignore
 import cmem  # type: ignore
 import cutil  # type: ignore
 
+from mcproxy import fakeserver
+from mcproxy.memcache import AsyncClient, Client, ShardedClient
+
 
 class TestMemcache(unittest.TestCase):
     def new_socket(self):
@@ -14,51 +26,1245 @@ class TestMemcache(unittest.TestCase):
         self.conn.connect((host_ip, 11211))
         return self.conn
 
+    @staticmethod
+    def live_indices(pool: Any) -> List[int]:
+        # the pool keeps the slots of the clients of the tests run before, only the live ones are counted
+        return [i for i, obj in enumerate(pool.get_objects()) if obj is not None]
+
     def test_new_client(self) -> None:
-        c = cmem.Client(self.new_socket())
+        pool = cmem.get_client_pool()
+        self.assertEqual([], self.live_indices(pool))
 
-        self.assertEqual(9320, cutil.py_get_mem())
+        c = cmem.Client(self.new_socket())
 
-        pool = cmem.get_client_pool()
-        conns = pool.get_objects()
+        self.assertEqual(27208, cutil.py_get_mem())
 
-        self.assertEqual(1, len(conns))
-        self.assertIsNotNone(conns[0])
+        live = self.live_indices(pool)
+        self.assertEqual(1, len(live))
+        index = live[0]
 
         del c
 
-        self.assertEqual([None], conns)
-        self.assertEqual([0], pool.get_free_indices())
+        self.assertEqual([], self.live_indices(pool))
+        self.assertIn(index, pool.get_free_indices())
+        free = len(pool.get_free_indices())
 
         c2 = cmem.Client(self.new_socket())
 
-        self.assertEqual(1, len(conns))
-        self.assertIsNotNone(conns[0])
-        self.assertEqual([], pool.get_free_indices())
+        # the slot freed last is reused
+        self.assertEqual([index], self.live_indices(pool))
+        self.assertNotIn(index, pool.get_free_indices())
+        self.assertEqual(free - 1, len(pool.get_free_indices()))
 
-        self.assertEqual(9320, cutil.py_get_mem())
+        self.assertEqual(27208, cutil.py_get_mem())
 
         del c2
-        self.assertEqual([None], conns)
-        self.assertEqual([0], pool.get_free_indices())
+        self.assertEqual([], self.live_indices(pool))
+        self.assertIn(index, pool.get_free_indices())
 
         self.assertEqual(0, cutil.py_get_mem())
 
     def test_new_pipeline(self) -> None:
+        pool = cmem.get_client_pool()
+
         c = cmem.Client(self.new_socket())
         p = c.pipeline()
         self.assertIsNotNone(p)
 
-        pool = cmem.get_client_pool()
-        conns = pool.get_objects()
+        self.assertEqual(1, len(self.live_indices(pool)))
+
+        del c
+        self.assertEqual(1, len(self.live_indices(pool)))
 
-        self.assertEqual(1, len(conns))
-        self.assertIsNotNone(conns[0])
+        del p
+        self.assertEqual([], self.live_indices(pool))
+
+        self.assertEqual(0, cutil.py_get_mem())
 
+
+class TestPipeline(unittest.TestCase):
+    def new_socket(self):
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        host_ip = socket.gethostbyname('localhost')
+        self.conn.settimeout(0.1)
+        self.conn.connect((host_ip, 11211))
+        return self.conn
+
+    def new_client(self):
+        return cmem.Client(self.new_socket())
+
+    def test_set_get_delete(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        set_result = p.set(b'pipe:key01', b'value 01')
+        get_result = p.get(b'pipe:key01')
+        del_result = p.delete(b'pipe:key01')
+        get_again = p.get(b'pipe:key01')
+
+        self.assertEqual(b'value 01', get_result.result())
+        self.assertEqual(True, set_result.result())
+        self.assertEqual(True, del_result.result())
+        self.assertEqual(None, get_again.result())
+
+        del set_result, get_result, del_result, get_again
+        del p
         del c
-        self.assertIsNotNone(conns[0])
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_get_miss_and_delete_not_found(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        p.delete(b'pipe:key02').result()
+
+        get_result = p.get(b'pipe:key02')
+        del_result = p.delete(b'pipe:key02')
+
+        self.assertEqual(None, get_result.result())
+        self.assertEqual(False, del_result.result())
+
+    def test_multi_pipelines_share_connection(self) -> None:
+        c = self.new_client()
+        p1 = c.pipeline()
+        p2 = c.pipeline()
+
+        p1.set(b'pipe:key03', b'AAA')
+        p2.set(b'pipe:key04', b'BBBB')
+
+        r1 = p1.get(b'pipe:key04')
+        r2 = p2.get(b'pipe:key03')
+
+        self.assertEqual(b'AAA', r2.result())
+        self.assertEqual(b'BBBB', r1.result())
+
+    def test_execute(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        results = [p.set(f'pipe:multi:{i}'.encode(), f'value:{i}'.encode()) for i in range(100)]
+        p.execute()
+        self.assertEqual([True] * 100, [r.result() for r in results])
+
+        results = [p.get(f'pipe:multi:{i}'.encode()) for i in range(100)]
+        self.assertEqual([f'value:{i}'.encode() for i in range(100)], [r.result() for r in results])
+
+    def test_big_values(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        values = [bytes([65 + i]) * (100_000 + i) for i in range(5)]
+        for i, v in enumerate(values):
+            p.set(f'pipe:big:{i}'.encode(), v)
+
+        results = [p.get(f'pipe:big:{i}'.encode()) for i in range(5)]
+        self.assertEqual(values, [r.result() for r in results])
+
+    def test_get_meta_flags(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        p.set(b'pipe:meta01', b'value', ttl=100, client_flags=3)
+        r = p.get(b'pipe:meta01', cas=True, ttl=True, client_flags=True)
+        plain = p.get(b'pipe:meta01')
+
+        self.assertEqual(b'value', r.result())
+        self.assertIsNotNone(r.cas)
+        self.assertLessEqual(r.ttl, 100)
+        self.assertGreater(r.ttl, 90)
+        self.assertEqual(3, r.client_flags)
+
+        self.assertIsNone(plain.cas)
+        self.assertIsNone(plain.ttl)
+        self.assertIsNone(plain.client_flags)
+
+        stale = p.set(b'pipe:meta01', b'new value', cas=r.cas + 1000)
+        updated = p.set(b'pipe:meta01', b'new value', cas=r.cas)
+        self.assertEqual(False, stale.result())
+        self.assertEqual(True, updated.result())
+
+    def test_get_miss_vivify(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        p.delete(b'pipe:meta02')
+        first = p.get(b'pipe:meta02', N=30)
+        second = p.get(b'pipe:meta02', N=30)
+
+        self.assertEqual(b'', first.result())
+        self.assertEqual(True, first.win)
+        self.assertEqual(False, first.won)
+
+        self.assertEqual(False, second.win)
+        self.assertEqual(True, second.won)
+        self.assertEqual(False, second.stale)
+
+    def test_concurrent_pipelines(self) -> None:
+        c = self.new_client()
+        errors = []
+
+        def run(n: int) -> None:
+            try:
+                p = c.pipeline()
+                for k in range(20):
+                    results = [p.set(f'pipe:thread:{n}:{i}'.encode(), f'{n}:{k}:{i}'.encode()) for i in range(10)]
+                    gets = [p.get(f'pipe:thread:{n}:{i}'.encode()) for i in range(10)]
+                    p.execute()
+                    assert [r.result() for r in results] == [True] * 10
+                    assert [r.result() for r in gets] == [f'{n}:{k}:{i}'.encode() for i in range(10)]
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], errors)
+
+    def test_duplicate_gets_share_request(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(1)
+
+        c = cmem.Client(a)
+        p1 = c.pipeline()
+        p2 = c.pipeline()
+
+        r1 = p1.get(b'pipe:dup01')
+        r2 = p2.get(bytearray(b'pipe:dup01'))
+        r3 = p1.get(b'pipe:dup01', cas=True)
+        r4 = p1.get(b'pipe:dup01', N=10)
+        r5 = p1.get(b'pipe:dup01', N=10)
+        self.assertIs(r1, r2)
+        self.assertIsNot(r1, r3)
+        self.assertIsNot(r4, r5)
+
+        b.sendall(b'VA 3\r\nABC\r\nVA 3 c12\r\nABC\r\nVA 0 W\r\n\r\nVA 0 Z\r\n\r\n')
+        self.assertEqual(b'ABC', r2.result())
+        self.assertEqual(
+            b'mg pipe:dup01 v\r\nmg pipe:dup01 c v\r\nmg pipe:dup01 N10 v\r\nmg pipe:dup01 N10 v\r\n',
+            b.recv(1024),
+        )
+        self.assertEqual(12, r3.cas)
+        self.assertEqual(True, r4.win)
+        self.assertEqual(True, r5.won)
+
+        r6 = p1.get(b'pipe:dup01')
+        self.assertIsNot(r1, r6)
+
+        del c, p1, p2, r1, r2, r3, r4, r5, r6
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_write_between_gets_not_shared(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        p.set(b'pipe:dup02', b'A')
+        r1 = p.get(b'pipe:dup02')
+        p.set(b'pipe:dup02', b'B')
+        r2 = p.get(b'pipe:dup02')
+        p.delete(b'pipe:dup02')
+        r3 = p.get(b'pipe:dup02')
+
+        self.assertEqual([b'A', b'B', None], [r1.result(), r2.result(), r3.result()])
+
+    def test_buffer_protocol_inputs(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        big = bytearray(b'M' * 300_000)
+
+        p.set(bytearray(b'pipe:buf01'), memoryview(b'small value'))
+        p.set(memoryview(b'pipe:buf02'), big)
+        p.delete(bytearray(b'pipe:buf03'))
+
+        r1 = p.get(memoryview(b'pipe:buf01'))
+        r2 = p.get(b'pipe:buf02')
+
+        self.assertEqual(b'small value', r1.result())
+        self.assertEqual(bytes(big), r2.result())
+
+        big.extend(b'X')
+
+    def test_invalid_value(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        with self.assertRaises(TypeError):
+            p.set(b'pipe:buf04', 'str value')
+
+        with self.assertRaises(TypeError):
+            p.get(12)
+
+    def test_invalid_key(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        with self.assertRaises(ValueError) as ex:
+            p.get(b'')
+        self.assertEqual(('key must not be empty',), ex.exception.args)
+
+        with self.assertRaises(ValueError) as ex:
+            p.set(b'A' * 251, b'value')
+        self.assertEqual(('key is too long',), ex.exception.args)
+
+    def test_result_after_client_closed(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        r = p.get(b'pipe:key05')
 
         del p
-        self.assertEqual([None], conns)
+        del c
+
+        with self.assertRaises(ConnectionError) as ex:
+            r.result()
+        self.assertEqual(('client is closed',), ex.exception.args)
+
+        del r
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_stats(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+        p.set(b'pipe:stats01', b'value01')
+        p.get(b'pipe:stats01')
+        p.delete(b'pipe:stats01')
+        p.get(b'pipe:stats01')
+        p.execute()
+
+        stats = c.stats()
+        self.assertEqual({'mg': 1, 'hd': 2, 'en': 1, 'ns': 0, 'ex': 0, 'nf': 0, 'version': 0}, stats['responses'])
+        self.assertEqual(0, stats['parse_errors'])
+        self.assertEqual(27208, stats['mem'])
+        self.assertEqual(0, stats['pending'])
+        self.assertFalse(stats['closed'])
+
+        self.assertEqual(1, stats['flushes'])
+        self.assertEqual(0, stats['partial_writes'])
+        self.assertEqual(0, stats['full_stalls'])
+        self.assertGreater(stats['bytes_written'], 60)
+        self.assertGreater(stats['bytes_read'], 20)
+        self.assertGreaterEqual(stats['reads'], 1)
+
+        p.get(b'pipe:stats01')
+        self.assertEqual(1, c.stats()['pending'])
+        p.execute()
+        self.assertEqual(0, c.stats()['pending'])
+        self.assertEqual(2, c.stats()['responses']['en'])
+
+        del p, c
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestPipelineFd(TestPipeline):
+    def new_client(self):
+        return cmem.Client(self.new_socket(), use_fd=True)
+
+    def test_timeout(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(0.05)
+
+        c = cmem.Client(a, use_fd=True)
+        p = c.pipeline()
+
+        r = p.get(b'pipe:key06')
+        with self.assertRaises(socket.timeout):
+            r.result()
+        self.assertTrue(b.recv(1024).startswith(b'mg pipe:key06 '))
+
+        with self.assertRaises(socket.timeout):
+            p.get(b'pipe:key07')
+
+        stats = c.stats()
+        self.assertEqual(1, stats['read_waits'])
+        self.assertEqual(0, stats['write_waits'])
+        self.assertTrue(stats['closed'])
+
+        del r, p, c
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_closed_by_server(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(0.1)
+
+        c = cmem.Client(a, use_fd=True)
+        p = c.pipeline()
+
+        r = p.get(b'pipe:key08')
+        b.shutdown(socket.SHUT_WR)
+
+        with self.assertRaises(ConnectionError) as ex:
+            r.result()
+        self.assertEqual(('connection is closed by server',), ex.exception.args)
+
+        del r, p, c
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestShardedClient(unittest.TestCase):
+    def new_socket(self):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(0.1)
+        conn.connect(('localhost', 11211))
+        return conn
+
+    def new_client(self, use_fd: bool = False):
+        names = [f'node{i}' for i in range(4)]
+        return cmem.ShardedClient({name: cmem.Client(self.new_socket(), use_fd) for name in names})
+
+    def test_set_get_many(self) -> None:
+        for use_fd in (False, True):
+            c = self.new_client(use_fd)
+            p = c.pipeline()
+
+            keys = [f'shard:key:{i}'.encode() for i in range(100)]
+            self.assertEqual(4, len({c.get_node(k) for k in keys}))
+
+            sets = [p.set(k, b'value:' + k) for k in keys[:90]]
+            p.execute()
+            self.assertEqual([True] * 90, [r.result() for r in sets])
+
+            p.delete(keys[95])
+            values = p.get_many(keys)
+            self.assertEqual([b'value:' + k for k in keys[:90]] + [None] * 10, values)
+
+            stats = c.stats()
+            self.assertEqual(['node0', 'node1', 'node2', 'node3'], sorted(stats))
+            self.assertEqual(100, sum(s['responses']['mg'] + s['responses']['en'] for s in stats.values()))
+
+            del c, p, sets
+            self.assertEqual(0, cutil.py_get_mem())
+
+    def test_result_executes_all_nodes(self) -> None:
+        c = self.new_client()
+        p = c.pipeline()
+
+        keys = [f'shard:key:{i}'.encode() for i in range(20)]
+        for k in keys:
+            p.set(k, k)
+        results = [p.get(k) for k in keys]
+
+        self.assertEqual(keys[0], results[0].result())
+        self.assertEqual(keys, [r.result() for r in results])
+
+    def test_flush_all_nodes_before_reading(self) -> None:
+        pairs = [socket.socketpair() for _ in range(2)]
+        for a, _ in pairs:
+            a.settimeout(1)
+
+        c = cmem.ShardedClient({'a': cmem.Client(pairs[0][0]), 'b': cmem.Client(pairs[1][0], use_fd=True)})
+        p = c.pipeline()
+
+        keys = [b'key01', b'key02', b'key03', b'key04']
+        nodes = [c.get_node(k) for k in keys]
+        self.assertEqual({'a', 'b'}, set(nodes))
+
+        def serve() -> None:
+            # answers only after the requests to both nodes are received
+            servers = {'a': pairs[0][1], 'b': pairs[1][1]}
+            requests = {name: conn.recv(1024) for name, conn in servers.items()}
+            for name in ('b', 'a'):
+                lines = requests[name].split(b'\r\n')[:-1]
+                resp = b''.join(b'VA 3\r\n' + line[3:8][-3:] + b'\r\n' for line in lines)
+                servers[name].sendall(resp)
+
+        t = threading.Thread(target=serve)
+        t.start()
+        values = p.get_many(keys)
+        t.join()
+
+        self.assertEqual([b'y01', b'y02', b'y03', b'y04'], values)
+
+        for a, b in pairs:
+            b.close()
+
+    def test_node_error_fails_only_its_results(self) -> None:
+        a, b = socket.socketpair()
+        a.settimeout(0.05)
+
+        c = cmem.ShardedClient({'bad': cmem.Client(a), 'good': cmem.Client(self.new_socket())})
+        p = c.pipeline()
+
+        keys = [f'shard:err:{i}'.encode() for i in range(20)]
+        for k in keys:
+            p.set(k, k)
+        results = [p.get(k) for k in keys]
+        p.execute()
+
+        for k, r in zip(keys, results):
+            if c.get_node(k) == 'good':
+                self.assertEqual(k, r.result())
+            else:
+                with self.assertRaises(socket.timeout):
+                    r.result()
+
+        del c, p, results
+        b.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_timeout_per_node(self) -> None:
+        # the slow node times out after the timeout of its own socket, not the longest one
+        with fakeserver.ServerThread(shaping=fakeserver.Shaping(latency=0.2)) as slow_server, \
+                fakeserver.ServerThread() as fast_server:
+            slow = socket.create_connection((slow_server.host, slow_server.port))
+            slow.settimeout(0.05)
+            fast = socket.create_connection((fast_server.host, fast_server.port))
+            fast.settimeout(1)
+
+            c = cmem.ShardedClient({'slow': cmem.Client(slow), 'fast': cmem.Client(fast)})
+            p = c.pipeline()
+            keys = [f'shard:timeout:{i}'.encode() for i in range(20)]
+            results = [p.get(k) for k in keys]
+            p.execute()
+
+            for k, r in zip(keys, results):
+                if c.get_node(k) == 'fast':
+                    self.assertIsNone(r.result())
+                else:
+                    with self.assertRaises(socket.timeout):
+                        r.result()
+
+            del c, p, results
+            slow.close()
+            fast.close()
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestHedgedReads(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fast = fakeserver.ServerThread()
+        self.slow = fakeserver.ServerThread(shaping=fakeserver.Shaping(latency=0.3))
+
+    def tearDown(self) -> None:
+        self.fast.close()
+        self.slow.close()
+
+    def new_client(self, **kwargs):
+        return ShardedClient(
+            {
+                name: lambda s=s: socket.create_connection((s.host, s.port))
+                for name, s in (('fast', self.fast), ('slow', self.slow))
+            },
+            **kwargs,
+        )
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError):
+            self.new_client(replicas=3)
+        with self.assertRaises(ValueError):
+            self.new_client(replicas=2, hedge_percentile=0)
+        self.assertIsNone(self.new_client().hedge_stats())
+
+    def test_replica_answers_first(self) -> None:
+        c = self.new_client(replicas=2, hedge_percentile=0.5)
+        keys = [f'hedge:key:{i}'.encode() for i in range(20)]
+        nodes = {k: c._client.get_nodes(k) for k in keys}
+        self.assertTrue(all(sorted(n) == ['fast', 'slow'] for n in nodes.values()))
+        fast_key = next(k for k in keys if nodes[k][0] == 'fast')
+        slow_keys = [k for k in keys if nodes[k][0] == 'slow']
+
+        p = c.pipeline()
+        sets = [p.set(k, b'value:' + k) for k in keys]
+        p.execute()
+        self.assertEqual([True] * 20, [r.result() for r in sets])
+        self.assertEqual(20, len(self.fast.store))
+        self.assertEqual(20, len(self.slow.store))
+
+        # the response times of the fast node make the hedge delay
+        for _ in range(20):
+            self.assertEqual(b'value:' + fast_key, p.get_many([fast_key])[0])
+        self.assertGreaterEqual(c.hedge_stats()['delay'], 0.0005)
+        self.assertLess(c.hedge_stats()['delay'], 0.1)
+
+        start = time.monotonic()
+        self.assertEqual([b'value:' + k for k in slow_keys], p.get_many(slow_keys))
+        self.assertLess(time.monotonic() - start, 0.2)
+
+        stats = c.hedge_stats()
+        self.assertGreaterEqual(stats['hedged'], 1)
+        self.assertGreaterEqual(stats['wins'], 1)
+
+        # the late responses of the slow node are read and discarded before the next ones
+        p.delete(slow_keys[0])
+        self.assertEqual([None] + [b'value:' + k for k in slow_keys[1:]], p.get_many(slow_keys))
+        self.assertEqual(0, c.stats()['slow']['pending'])
+
+        del c, p, sets
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_shared_get_hedged_once(self) -> None:
+        c = self.new_client(replicas=2, hedge_percentile=0.5)
+        keys = [f'hedge:key:{i}'.encode() for i in range(20)]
+        fast_key = next(k for k in keys if c._client.get_nodes(k)[0] == 'fast')
+        slow_key = next(k for k in keys if c._client.get_nodes(k)[0] == 'slow')
+
+        p1 = c.pipeline()
+        p2 = c.pipeline()
+        p1.set(fast_key, b'fast value')
+        p1.set(slow_key, b'slow value')
+        p1.execute()
+        for _ in range(20):
+            self.assertEqual([b'fast value'], p1.get_many([fast_key]))
+        hedged = c.hedge_stats()['hedged']
+
+        # the get of p2 shares the result of p1, only the batch of p1 hedges it
+        r1 = p1.get(slow_key)
+        r2 = p2.get(slow_key)
+        self.assertIs(r1, r2)
+        start = time.monotonic()
+        p1.execute()
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(b'slow value', r2.result())
+        p2.execute()
+        self.assertEqual(hedged + 1, c.hedge_stats()['hedged'])
+
+        del c, p1, p2, r1, r2
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_cas_set_drops_replicas(self) -> None:
+        c = self.new_client(replicas=2)
+        p = c.pipeline()
+        p.set(b'key01', b'value01')
+        p.execute()
+
+        r = p.get(b'key01', cas=True)
+        p.execute()
+        p.set(b'key01', b'value02', cas=r.cas)
+        p.execute()
+
+        first, replica = c._client.get_nodes(b'key01')
+        servers = {'fast': self.fast, 'slow': self.slow}
+        self.assertEqual(1, len(servers[first].store))
+        self.assertEqual(0, len(servers[replica].store))
+
+
+class TestShardedHealth(unittest.TestCase):
+    def setUp(self) -> None:
+        self.servers = {'a': fakeserver.ServerThread(), 'b': fakeserver.ServerThread()}
+        self.down: Set[str] = set()
+        self.socks: Dict[str, socket.socket] = {}
+        self.connects = 0
+
+    def tearDown(self) -> None:
+        for s in self.servers.values():
+            s.close()
+        for sock in self.socks.values():
+            sock.close()
+
+    def new_conn(self, name: str) -> socket.socket:
+        self.connects += 1
+        if name in self.down:
+            raise ConnectionRefusedError('node is down')
+        s = self.servers[name]
+        self.socks[name] = socket.create_connection((s.host, s.port))
+        return self.socks[name]
+
+    def new_conns(self) -> Dict[str, Callable[[], socket.socket]]:
+        return {name: functools.partial(self.new_conn, name) for name in self.servers}
+
+    def new_client(self, **kwargs: Any) -> ShardedClient:
+        return ShardedClient(
+            self.new_conns(),
+            health=chealth.CircuitBreaker(max_errors=2, eject_time=0.05), health_check_interval=0, **kwargs,
+        )
+
+    @staticmethod
+    def health(c: ShardedClient, name: str) -> Dict[str, Any]:
+        stats = c.health_stats()
+        assert stats is not None
+        return stats[name]
+
+    def kill(self, name: str) -> None:
+        self.down.add(name)
+        self.socks[name].shutdown(socket.SHUT_RDWR)
+
+    def test_eject_and_recover(self) -> None:
+        c = self.new_client()
+        keys = [b'health:%d' % i for i in range(20)]
+        key = next(k for k in keys if c._client.get_node(k) == 'a')
+        p = c.pipeline()
+        for k in keys:
+            p.set(k, b'value')
+        p.execute()
+
+        self.kill('a')
+        with self.assertRaises(ConnectionError):
+            p.get(key).result()
+        self.assertEqual('closed', self.health(c, 'a')['state'])
+
+        # the requests do not wait for a new connection, they fail fast
+        connects = self.connects
+        start = time.monotonic()
+        for _ in range(100):
+            with self.assertRaisesRegex(ConnectionError, 'node a is not available'):
+                p.get(key).result()
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(connects, self.connects)
+
+        other = next(k for k in keys if c._client.get_node(k) == 'b')
+        self.assertEqual(b'value', p.get(other).result())
+
+        # the failed connection is replaced by the health check, the second failure ejects the node
+        self.assertEqual([], c.check_health())
+        self.assertEqual(connects + 1, self.connects)
+        self.assertEqual('open', self.health(c, 'a')['state'])
+        self.assertEqual('closed', self.health(c, 'b')['state'])
+
+        self.assertEqual([], c.check_health())
+        time.sleep(0.06)
+        self.assertEqual([], c.check_health())
+        self.assertEqual(1, self.health(c, 'a')['probes'])
+
+        self.down.discard('a')
+        time.sleep(0.11)
+        self.assertEqual(['a'], c.check_health())
+        self.assertEqual(b'value', p.get(key).result())
+        self.assertEqual(1, self.health(c, 'a')['recoveries'])
+
+        del c, p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_failover(self) -> None:
+        c = self.new_client(failover=True)
+        key = next(k for k in (b'health:%d' % i for i in range(20)) if c._client.get_node(k) == 'a')
+
+        self.kill('a')
+        p = c.pipeline()
+        with self.assertRaises(ConnectionError):
+            p.get(key).result()
+
+        # the requests of the ejected node go to the next node clockwise
+        self.assertIsNone(p.get(key).result())
+        self.assertTrue(p.set(key, b'value').result())
+        self.assertEqual(b'value', p.get(key).result())
+        self.assertEqual(b'value', self.servers['b'].store.meta_get(key, [b'v'])[-7:-2])
+
+        del c, p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_replica_without_failover(self) -> None:
+        c = self.new_client(replicas=2)
+        key = next(k for k in (b'health:%d' % i for i in range(20)) if c._client.get_nodes(k)[0] == 'a')
+        p = c.pipeline()
+        p.set(key, b'value')
+        p.execute()
+
+        self.kill('a')
+        with self.assertRaises(ConnectionError):
+            p.get(key).result()
+        self.assertEqual(b'value', p.get(key).result())
+        c.check_health()
+        self.assertEqual('open', self.health(c, 'a')['state'])
+        self.assertEqual(b'value', p.get(key).result())
+
+        del c, p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_background_check(self) -> None:
+        c = ShardedClient(
+            self.new_conns(),
+            health=chealth.CircuitBreaker(max_errors=1, eject_time=0.02), health_check_interval=0.01,
+        )
+        key = next(k for k in (b'health:%d' % i for i in range(20)) if c._client.get_node(k) == 'a')
+        self.kill('a')
+        p = c.pipeline()
+        with self.assertRaises(ConnectionError):
+            p.get(key).result()
+        self.down.discard('a')
+
+        deadline = time.monotonic() + 2
+        while self.health(c, 'a')['recoveries'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(p.get(key).result())
+
+        del c, p
+        time.sleep(0.03)
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestLatency(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = fakeserver.ServerThread(shaping=fakeserver.Shaping(latency=0.02))
+        self.other = fakeserver.ServerThread()
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.other.close()
+
+    def new_conn(self, s: fakeserver.ServerThread) -> socket.socket:
+        return socket.create_connection((s.host, s.port))
+
+    def test_client(self) -> None:
+        slow: List[Dict[str, Any]] = []
+        c = Client(lambda: self.new_conn(self.server), latency=clatency.LatencyRecorder(0.01, slow.append))
+        p = c.pipeline()
+        p.set(b'key01', b'value01')
+        p.set(b'key02', b'value02')
+        p.get(b'key01')
+        p.delete(b'key02')
+        p.execute()
+        self.assertEqual(b'value01', p.get(b'key01').result())
+
+        stats = c.stats()['latency']
+        self.assertEqual(2, stats['pipeline']['count'])
+        self.assertGreaterEqual(stats['pipeline']['min'], 0.02)
+        self.assertGreaterEqual(stats['first_byte']['min'], 0.015)
+        self.assertLess(stats['flush']['max'], 0.015)
+        self.assertEqual(2, stats['parse']['count'])
+        self.assertEqual({'mg': 2, 'ms': 2, 'md': 1}, {k: v['count'] for k, v in stats['commands'].items()})
+        self.assertGreaterEqual(stats['commands']['mg']['min'], 0.02)
+
+        self.assertEqual(2, stats['slow'])
+        self.assertEqual([None, None], [s['node'] for s in slow])
+        self.assertEqual([4, 1], [s['requests'] for s in slow])
+
+        del c, p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_slow_callback_without_lock(self) -> None:
+        # on_slow is called once the connection is released, it can use the client
+        clients: List[Any] = []
+        values: List[Any] = []
+
+        def on_slow(info: Dict[str, Any]) -> None:
+            if len(values) == 0:
+                p = clients[0].pipeline()
+                values.append(p.get(b'key01'))
+                p.execute()
+                values[0] = values[0].result()
+
+        c = Client(lambda: self.new_conn(self.server), latency=clatency.LatencyRecorder(0.01, on_slow))
+        clients.append(c)
+        p = c.pipeline()
+        p.set(b'key01', b'value01')
+        p.execute()
+        self.assertEqual([b'value01'], values)
+
+        sc = ShardedClient({'slow': lambda: self.new_conn(self.server)}, latency=clatency.LatencyRecorder(0.01, on_slow))
+        clients[0] = sc
+        values.clear()
+        p = sc.pipeline()
+        p.get(b'key01')
+        p.execute()
+        self.assertEqual([b'value01'], values)
+
+        clients.clear()
+        del c, sc, p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_sharded_client(self) -> None:
+        c = ShardedClient(
+            {'slow': lambda: self.new_conn(self.server), 'fast': lambda: self.new_conn(self.other)},
+            latency=clatency.LatencyRecorder(),
+        )
+        self.assertIsNone(ShardedClient({'fast': lambda: self.new_conn(self.other)}).latency_stats())
+
+        keys = [b'latency:%d' % i for i in range(20)]
+        p = c.pipeline()
+        for k in keys:
+            p.set(k, b'value')
+        p.execute()
+
+        stats = c.latency_stats()
+        assert stats is not None
+        self.assertEqual({'slow', 'fast'}, set(stats))
+        for name in ['slow', 'fast']:
+            count = sum(1 for k in keys if c._client.get_node(k) == name)
+            self.assertEqual(1, stats[name]['pipeline']['count'])
+            self.assertEqual(count, stats[name]['commands']['ms']['count'])
+            self.assertEqual(stats[name], c.stats()[name]['latency'])
+        self.assertGreaterEqual(stats['slow']['pipeline']['min'], 0.02)
+        self.assertLess(stats['fast']['first_byte']['max'], 0.02)
+
+        del c, p
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestAutoCork(unittest.TestCase):
+    def new_socket(self):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(1)
+        conn.connect(('localhost', 11211))
+        return conn
+
+    def tearDown(self) -> None:
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_write_limit_follows_batch_size(self) -> None:
+        c = cmem.Client(self.new_socket(), autocork_us=1000)
+
+        flushes = []
+        for _ in range(3):
+            before = c.stats()['flushes']
+            p = c.pipeline()
+            results = [p.set(b'cork:key%02d' % i, b'x' * 2000) for i in range(20)]
+            p.execute()
+            self.assertEqual([True] * 20, [r.result() for r in results])
+            flushes.append(c.stats()['flushes'] - before)
+
+        self.assertGreater(flushes[0], 1)
+        self.assertEqual([1, 1], flushes[1:])
+
+        stats = c.stats()['autocork']
+        self.assertEqual(3, stats['batches'])
+        self.assertEqual(65536, stats['write_limit'])
+        self.assertEqual(1, stats['avg_callers'])
+        self.assertEqual(0, stats['corked'])
+        self.assertGreater(stats['avg_rtt_us'], 0)
+
+        del c, p, results
+
+    def test_concurrent_callers(self) -> None:
+        c = cmem.Client(self.new_socket(), autocork_us=1000)
+        mismatches: List[bytes] = []
+        errors: List[BaseException] = []
+
+        def run(index: int) -> None:
+            try:
+                for i in range(20):
+                    p = c.pipeline()
+                    key = b'cork:thread%d:%02d' % (index, i)
+                    p.set(key, b'value %d' % i)
+                    r = p.get(key)
+                    if r.result() != b'value %d' % i:
+                        mismatches.append(key)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], mismatches)
+        self.assertEqual([], errors)
+        stats = c.stats()
+        self.assertGreater(stats['autocork']['batches'], 0)
+        self.assertLessEqual(stats['flushes'], 80)
+
+        del c
+
+    def test_disabled_by_default(self) -> None:
+        c = cmem.Client(self.new_socket())
+        self.assertNotIn('autocork', c.stats())
+        del c
+
+
+class TestGetOrFill(unittest.TestCase):
+    def new_socket(self):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(0.5)
+        conn.connect(('localhost', 11211))
+        return conn
+
+    def setUp(self) -> None:
+        self.calls: List[bytes] = []
+
+    def loader(self, key: bytes) -> bytes:
+        self.calls.append(key)
+        return b'loaded:' + key
+
+    def test_fill_once(self) -> None:
+        c = Client(self.new_socket)
+        c.pipeline().delete(b'lease:key01').result()
+
+        self.assertEqual(b'loaded:lease:key01', c.get_or_fill(b'lease:key01', self.loader, ttl=100))
+        self.assertEqual(b'loaded:lease:key01', c.get_or_fill(b'lease:key01', self.loader, ttl=100))
+        self.assertEqual([b'lease:key01'], self.calls)
+
+        r = c.pipeline().get(b'lease:key01', ttl=True)
+        self.assertEqual(b'loaded:lease:key01', r.result())
+        self.assertGreater(r.ttl, 90)
+
+    def test_wait_for_lease_winner(self) -> None:
+        c = Client(self.new_socket)
+        other = Client(self.new_socket).pipeline()
+
+        other.delete(b'lease:key02')
+        lease = other.get(b'lease:key02', N=10, cas=True)
+        self.assertEqual(True, lease.win)
+
+        def fill() -> None:
+            time.sleep(0.05)
+            other.set(b'lease:key02', b'filled', cas=lease.cas).result()
+
+        t = threading.Thread(target=fill)
+        t.start()
+        value = c.get_or_fill(b'lease:key02', self.loader)
+        t.join()
+
+        self.assertEqual(b'filled', value)
+        self.assertEqual([], self.calls)
+
+    def test_wait_timeout(self) -> None:
+        c = Client(self.new_socket)
+        other = Client(self.new_socket).pipeline()
+
+        other.delete(b'lease:key03')
+        self.assertEqual(True, other.get(b'lease:key03', N=10).win)
+
+        value = c.get_or_fill(b'lease:key03', self.loader, max_wait=0.05)
+        self.assertEqual(b'loaded:lease:key03', value)
+        self.assertEqual([b'lease:key03'], self.calls)
+        self.assertEqual(b'', other.get(b'lease:key03').result())
+
+    def test_stale_value(self) -> None:
+        c = Client(self.new_socket)
+        p = c.pipeline()
+        p.set(b'lease:key04', b'old value').result()
+
+        conn = self.new_socket()
+        conn.sendall(b'md lease:key04 I\r\n')
+        self.assertEqual(b'HD\r\n', conn.recv(1024))
+        conn.close()
+
+        # the first caller refills the stale value, the next one gets the stale value
+        other = Client(self.new_socket).pipeline()
+        lease = other.get(b'lease:key04', N=10, cas=True)
+        self.assertEqual((True, True), (lease.win, lease.stale))
+
+        self.assertEqual(b'old value', c.get_or_fill(b'lease:key04', self.loader))
+        self.assertEqual([], self.calls)
+
+    def test_late_fill_does_not_overwrite(self) -> None:
+        c = Client(self.new_socket)
+        other = Client(self.new_socket).pipeline()
+        other.delete(b'lease:key05').result()
+
+        def loader(key: bytes) -> bytes:
+            other.set(key, b'newer value').result()
+            return b'late value'
+
+        self.assertEqual(b'late value', c.get_or_fill(b'lease:key05', loader))
+        self.assertEqual(b'newer value', other.get(b'lease:key05').result())
+
+    def test_many(self) -> None:
+        c = Client(self.new_socket)
+        p = c.pipeline()
+        keys = [f'lease:many:{i}'.encode() for i in range(5)]
+        for k in keys:
+            p.delete(k)
+        p.set(keys[2], b'cached')
+        p.execute()
+
+        batches = []
+
+        def loader(ks):
+            batches.append(ks)
+            return {k: b'loaded:' + k for k in ks}
+
+        values = c.get_or_fill_many(keys + [keys[0]], loader)
+        self.assertEqual([b'loaded:' + k for k in keys[:2]] + [b'cached'] + [b'loaded:' + k for k in keys[3:]]
+                         + [b'loaded:' + keys[0]], values)
+        self.assertEqual([keys[:2] + keys[3:]], batches)
+
+
+class Abort(BaseException):
+    pass
+
+
+class FakeTransport:
+    def __init__(self) -> None:
+        self.written: List[bytes] = []
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        self.written.append(data)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FailingSerializer:
+    def dumps(self, value: Any) -> bytes:
+        return repr(value).encode()
+
+    def loads(self, data: bytes) -> Any:
+        raise Abort(data)
+
+
+class TestAsyncConn(unittest.IsolatedAsyncioTestCase):
+    async def test_resolve_raises_midway(self) -> None:
+        transport = FakeTransport()
+        conn = cmem.AsyncConn(transport, asyncio.get_running_loop(), None, ccodec.Serializer(FailingSerializer()))
+        results = [conn.get(b'key%02d' % i) for i in range(4)]
+        await asyncio.sleep(0)
+        self.assertEqual(b''.join(b'mg key%02d f v\r\n' % i for i in range(4)), b''.join(transport.written))
+
+        # the second value is serialized, its conversion raises
+        with self.assertRaises(Abort):
+            conn.data_received(b'VA 1 f0\r\nA\r\nVA 1 f1\r\nB\r\nVA 1 f0\r\nC\r\nEN\r\n')
+
+        self.assertEqual(b'A', await results[0])
+        with self.assertRaises(Abort):
+            await results[1]
+        for r in results[2:]:
+            with self.assertRaises(ConnectionError):
+                await r
+        self.assertTrue(transport.closed)
+        self.assertEqual(0, conn.stats()['pending'])
+
+        del conn, results, r
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+class TestAsyncClient(unittest.IsolatedAsyncioTestCase):
+    async def test_set_get_delete(self) -> None:
+        c = await AsyncClient.connect()
+
+        set_result = c.set(b'async:key01', b'value 01')
+        get_result = c.get(b'async:key01')
+        del_result = c.delete(b'async:key01')
+        get_again = c.get(b'async:key01')
+
+        self.assertEqual(True, await set_result)
+        self.assertEqual(b'value 01', await get_result)
+        self.assertEqual(True, await del_result)
+        self.assertEqual(None, await get_again)
+
+        stats = c.stats()
+        self.assertEqual(1, stats['responses']['mg'])
+        self.assertEqual(2, stats['responses']['hd'])
+        self.assertEqual(1, stats['responses']['en'])
+        self.assertEqual(1, stats['flushes'])
+        self.assertEqual(0, stats['pending'])
+
+        c.close()
+
+    async def test_concurrent_coroutines(self) -> None:
+        c = await AsyncClient.connect()
+
+        async def run(i: int) -> bytes:
+            await c.set(f'async:multi:{i}'.encode(), f'value:{i}'.encode() * i)
+            return await c.get(f'async:multi:{i}'.encode())
+
+        values = await asyncio.gather(*[run(i) for i in range(200)])
+        self.assertEqual([f'value:{i}'.encode() * i for i in range(200)], values)
+
+        c.close()
+
+    async def test_duplicate_gets_share_request(self) -> None:
+        received = []
+
+        async def on_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                received.append(line)
+                writer.write(b'VA 3\r\nABC\r\n')
+
+        server = await asyncio.start_server(on_conn, 'localhost', 0)
+        c = await AsyncClient.connect('localhost', server.sockets[0].getsockname()[1])
+
+        values = await asyncio.gather(*[c.get(b'async:dup01') for _ in range(10)])
+        self.assertEqual([b'ABC'] * 10, values)
+        self.assertEqual([b'mg async:dup01 v\r\n'], received)
+
+        self.assertEqual(b'ABC', await c.get(b'async:dup01'))
+        self.assertEqual(2, len(received))
+
+        c.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_big_values(self) -> None:
+        c = await AsyncClient.connect()
+
+        values = [bytes([65 + i]) * (100_000 + i) for i in range(5)]
+        for i, v in enumerate(values):
+            c.set(f'async:big:{i}'.encode(), v)
+
+        results = await asyncio.gather(*[c.get(f'async:big:{i}'.encode()) for i in range(5)])
+        self.assertEqual(values, results)
+
+        c.close()
+
+    async def test_get_meta_flags(self) -> None:
+        c = await AsyncClient.connect()
+
+        c.set(b'async:meta01', b'value', client_flags=5)
+        r = c.get(b'async:meta01', cas=True, client_flags=True)
+
+        with self.assertRaises(RuntimeError) as ex:
+            r.result()
+        self.assertEqual(('result is not ready, it must be awaited',), ex.exception.args)
+
+        self.assertEqual(b'value', await r)
+        self.assertEqual(b'value', r.result())
+        self.assertEqual(5, r.client_flags)
+
+        self.assertEqual(False, await c.set(b'async:meta01', b'new', cas=r.cas + 1000))
+        self.assertEqual(True, await c.set(b'async:meta01', b'new', cas=r.cas))
+
+        c.close()
+
+    async def test_close(self) -> None:
+        c = await AsyncClient.connect()
+
+        r = c.get(b'async:key02')
+        c.close()
+
+        with self.assertRaises(ConnectionError) as ex:
+            await r
+        self.assertEqual(('client is closed',), ex.exception.args)
+
+        with self.assertRaises(ConnectionError):
+            c.get(b'async:key02')
+
+    async def test_connection_lost(self) -> None:
+        server_conns = []
+
+        def on_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            server_conns.append(writer)
+
+        server = await asyncio.start_server(on_conn, 'localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        c = await AsyncClient.connect('localhost', port)
+        r = c.get(b'async:key03')
+
+        await asyncio.sleep(0.01)
+        server_conns[0].close()
+
+        with self.assertRaises(ConnectionError) as ex:
+            await asyncio.wait_for(r, 1)
+        self.assertEqual(('connection is closed',), ex.exception.args)
+
+        server.close()
+        await server.wait_closed()
+
+    async def test_autocork(self) -> None:
+        c = await AsyncClient.connect(autocork_us=1000)
+
+        for _ in range(3):
+            values = await asyncio.gather(*[c.get(b'async:cork%02d' % i) for i in range(50)])
+            self.assertEqual([None] * 50, values)
+
+        stats = c.stats()['autocork']
+        self.assertEqual(3, stats['batches'])
+        self.assertEqual(50, stats['avg_callers'])
+        self.assertEqual(2, stats['corked'])
+        self.assertEqual(3, c.stats()['flushes'])
+
+        c.close()
+
+    async def test_invalid_key(self) -> None:
+        c = await AsyncClient.connect()
+
+        with self.assertRaises(ValueError) as ex:
+            c.get(b'')
+        self.assertEqual(('key must not be empty',), ex.exception.args)
+
+        c.close()
 
+    def tearDown(self) -> None:
+        gc.collect()
         self.assertEqual(0, cutil.py_get_mem())
@@ -94,6 +94,7 @@ class TestCMemParser(unittest.TestCase):
             p.handle(b'   123\ra')
 
         self.assertEqual(('invalid LF state',), ex.exception.args)
+        self.assertEqual(1, p.stats()['parse_errors'])
 
     def test_va(self):
         p = cparser.ParserTest()
@@ -105,6 +106,9 @@ class TestCMemParser(unittest.TestCase):
         self.assertEqual(2, p.get())
         self.assertEqual(0, p.get_len())
         self.assertEqual(b'ABC', p.get_data())
+        self.assertEqual(0, p.get())
+        self.assertEqual(1, p.stats()['responses']['mg'])
+        self.assertEqual(0, p.stats()['responses']['hd'])
 
         del p
         self.assertEqual(0, cutil.py_get_mem())
@@ -141,6 +145,40 @@ class TestCMemParser(unittest.TestCase):
         del p
         self.assertEqual(0, cutil.py_get_mem())
 
+    def test_va_split_inside_data(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'VA 10\r\nABC')
+        self.assertEqual(0, p.get())
+
+        p.handle(b'DEFG')
+        self.assertEqual(0, p.get())
+
+        p.handle(b'HIJ\r\nVA 2\r\nXY\r\n')
+
+        self.assertEqual(2, p.get())
+        self.assertEqual(b'ABCDEFGHIJ', p.get_data())
+
+        self.assertEqual(2, p.get())
+        self.assertEqual(b'XY', p.get_data())
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_va_get_data_not_copied(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'VA 3\r\nABC\r\n')
+
+        self.assertEqual(2, p.get())
+        data = p.get_data()
+        self.assertEqual(b'ABC', data)
+        self.assertIs(data, p.get_data())
+
+        del p
+        self.assertEqual(b'ABC', data)
+        self.assertEqual(0, cutil.py_get_mem())
+
     def test_va_missing_cr(self):
         p = cparser.ParserTest()
 
@@ -340,3 +378,233 @@ class TestCMemParserHandleMSet(unittest.TestCase):
 
         del p
         self.assertEqual(0, cutil.py_get_mem())
+
+    def test_handle_en(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'EN\r\n')
+
+        self.assertEqual(7, p.get())
+        self.assertEqual(0, p.get_len())
+        self.assertEqual(b'', p.get_data())
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+
+
+class TestCMemParserMetaFlags(unittest.TestCase):
+    def test_va_flags(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'VA 3 c123 t-1 f7 kkey01 Oab12 W X Z\r\nABC\r\n')
+
+        self.assertEqual(2, p.get())
+        self.assertEqual(b'ABC', p.get_data())
+        self.assertEqual({
+            'cas': 123, 'ttl': -1, 'client_flags': 7,
+            'key': b'key01', 'opaque': b'ab12',
+            'win': True, 'stale': True, 'won': True,
+        }, p.get_meta())
+        self.assertEqual(b'', p.get_string())
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_va_flags_split(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'VA 3 c18446744073')
+        p.handle(b'709551615 t30\r\nAB')
+        p.handle(b'C\r\n')
+
+        self.assertEqual(2, p.get())
+        self.assertEqual(b'ABC', p.get_data())
+        self.assertEqual({'cas': 18446744073709551615, 'ttl': 30}, p.get_meta())
+
+    def test_flags_reset_on_next_response(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'VA 1 c12 W\r\nA\r\nHD t20\r\n')
+
+        self.assertEqual(2, p.get())
+        self.assertEqual({'cas': 12, 'win': True}, p.get_meta())
+
+        self.assertEqual(3, p.get())
+        self.assertEqual({'ttl': 20}, p.get_meta())
+
+    def test_en_with_flags(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'EN kkey01 O123\r\n')
+
+        self.assertEqual(7, p.get())
+        self.assertEqual({'key': b'key01', 'opaque': b'123'}, p.get_meta())
+
+    def test_unknown_flags_ignored(self):
+        p = cparser.ParserTest()
+
+        p.handle(b'HD abcd s12 c3\r\n')
+
+        self.assertEqual(3, p.get())
+        self.assertEqual({'cas': 3}, p.get_meta())
+        self.assertEqual(b'', p.get_string())
+
+    def test_invalid_cas(self):
+        p = cparser.ParserTest()
+
+        with self.assertRaises(ValueError) as ex:
+            p.handle(b'VA 1 c12a\r\nA\r\n')
+
+        self.assertEqual(('invalid cas flag',), ex.exception.args)
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_opaque_too_long(self):
+        p = cparser.ParserTest()
+
+        with self.assertRaises(ValueError) as ex:
+            p.handle(b'HD O' + b'1' * 33 + b'\r\n')
+
+        self.assertEqual(('opaque flag is too long',), ex.exception.args)
+
+    def test_batch_flags(self):
+        p = cparser.ParserTest()
+
+        data = b'VA 3 c12 t-1 f3\r\nABC\r\nEN\r\nHD c13\r\nVA 2 W\r\nX'
+        records, consumed = p.handle_batch(data, with_meta=True)
+
+        self.assertEqual([
+            (2, 17, b'ABC', {'cas': 12, 'ttl': -1, 'client_flags': 3}),
+            (7, -1, b'', {}),
+            (3, -1, b'', {'cas': 13}),
+        ], records)
+        self.assertEqual(len(data), consumed)
+
+        records, consumed = p.handle_batch(b'Y\r\n', with_meta=True)
+        self.assertEqual([(2, -1, b'XY', {'win': True})], records)
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_batch_invalid_flags(self):
+        p = cparser.ParserTest()
+
+        with self.assertRaises(ValueError) as ex:
+            p.handle_batch(b'HD t1x\r\n')
+
+        self.assertEqual(('invalid ttl flag',), ex.exception.args)
+
+
+class TestCMemParserBatch(unittest.TestCase):
+    def test_many_responses(self):
+        p = cparser.ParserTest()
+
+        data = b'VA 3 c12\r\nABC\r\nHD\r\nNS abcd\r\nEN\r\nNF\r\nEX\r\nVERSION 1.6.21\r\n'
+        records, consumed = p.handle_batch(data)
+
+        self.assertEqual([
+            (2, 10, b'ABC'),
+            (3, -1, b''),
+            (4, -1, b''),
+            (7, -1, b''),
+            (6, -1, b''),
+            (5, -1, b''),
+            (1, -1, b''),
+        ], records)
+        self.assertEqual(len(data), consumed)
+        self.assertEqual(b'1.6.21', p.get_string())
+
+        self.assertEqual({
+            'responses': {'version': 1, 'mg': 1, 'hd': 1, 'ns': 1, 'ex': 1, 'nf': 1, 'en': 1},
+            'parse_errors': 0,
+        }, p.stats())
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_max_records(self):
+        p = cparser.ParserTest()
+
+        data = b'VA 1\r\nA\r\nVA 2\r\nBB\r\nHD\r\n'
+
+        records, consumed = p.handle_batch(data, 2)
+        self.assertEqual([(2, 6, b'A'), (2, 15, b'BB')], records)
+        self.assertEqual(len(data) - 4, consumed)
+
+        records, consumed = p.handle_batch(data[consumed:])
+        self.assertEqual([(3, -1, b'')], records)
+        self.assertEqual(4, consumed)
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_split_value(self):
+        p = cparser.ParserTest()
+
+        records, consumed = p.handle_batch(b'HD\r\nVA 10\r\nABCD')
+        self.assertEqual([(3, -1, b'')], records)
+        self.assertEqual(15, consumed)
+
+        records, consumed = p.handle_batch(b'EFG')
+        self.assertEqual([], records)
+        self.assertEqual(3, consumed)
+
+        records, consumed = p.handle_batch(b'HIJ\r\nVA 2\r\nXY\r\nVA')
+        self.assertEqual([(2, -1, b'ABCDEFGHIJ'), (2, 11, b'XY')], records)
+        self.assertEqual(17, consumed)
+
+        records, consumed = p.handle_batch(b' 1\r\nZ\r\n')
+        self.assertEqual([(2, -1, b'Z')], records)
+        self.assertEqual(7, consumed)
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_split_line(self):
+        p = cparser.ParserTest()
+
+        records, consumed = p.handle_batch(b'H')
+        self.assertEqual([], records)
+
+        records, consumed = p.handle_batch(b'D\r\nNS\r')
+        self.assertEqual([(3, -1, b'')], records)
+
+        records, consumed = p.handle_batch(b'\nVERSION 12\r\n')
+        self.assertEqual([(4, -1, b''), (1, -1, b'')], records)
+        self.assertEqual(b'12', p.get_string())
+
+    def test_invalid_response(self):
+        p = cparser.ParserTest()
+
+        with self.assertRaises(ValueError) as ex:
+            p.handle_batch(b'VA 1\r\nA\r\nHX\r\n')
+
+        self.assertEqual(('invalid character after H',), ex.exception.args)
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_va_number_too_large(self):
+        p = cparser.ParserTest()
+
+        # the length would overflow an int before reaching the allocation
+        with self.assertRaises(ValueError) as ex:
+            p.handle_batch(b'VA 4294967297\r\nA\r\n')
+        self.assertEqual(('VA number is too large',), ex.exception.args)
+
+        p = cparser.ParserTest()
+        records, consumed = p.handle_batch(b'VA 000000002\r\nAB\r\n')
+        self.assertEqual([(2, 14, b'AB')], records)
+
+        del p
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_va_missing_cr(self):
+        p = cparser.ParserTest()
+
+        with self.assertRaises(ValueError) as ex:
+            p.handle_batch(b'VA 2\r\nAAB\n')
+
+        self.assertEqual(('invalid CR state',), ex.exception.args)
@@ -0,0 +1,187 @@
+import gc
+import socket
+import threading
+import unittest
+from typing import Any, List
+
+import cmem  # type: ignore
+import cpool  # type: ignore
+import cutil  # type: ignore
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.sockets: List[Any] = []
+
+    def new_client(self) -> Any:
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(0.1)
+        conn.connect(('localhost', 11211))
+        self.sockets.append(conn)
+        return cmem.Client(conn)
+
+    def new_pool(self, **kwargs: Any) -> Any:
+        return cpool.ConnectionPool(self.new_client, clock=self.clock, **kwargs)
+
+    def test_min_size(self) -> None:
+        pool = self.new_pool(min_size=2, max_size=4)
+        self.assertEqual({'size': 2, 'idle': 2}, pool.stats())
+        self.assertEqual(2, len(self.sockets))
+
+    def test_invalid_size(self) -> None:
+        with self.assertRaises(ValueError) as ex:
+            self.new_pool(min_size=3, max_size=2)
+        self.assertEqual(('invalid pool size',), ex.exception.args)
+
+    def test_checkout_reuse(self) -> None:
+        pool = self.new_pool(min_size=0, max_size=4)
+
+        c1 = pool.checkout()
+        c2 = pool.checkout()
+        self.assertIsNot(c1.client, c2.client)
+        self.assertEqual({'size': 2, 'idle': 0}, pool.stats())
+
+        c1.release()
+        self.assertEqual({'size': 2, 'idle': 1}, pool.stats())
+
+        c3 = pool.checkout()
+        self.assertIs(c1, c3)
+        self.assertEqual(2, len(self.sockets))
+
+        c2.release()
+        c3.release()
+        self.assertEqual({'size': 2, 'idle': 2}, pool.stats())
+
+        with self.assertRaises(ValueError) as ex:
+            c3.release()
+        self.assertEqual(('connection is not checked out',), ex.exception.args)
+
+    def test_context_manager(self) -> None:
+        pool = self.new_pool(min_size=1, max_size=1)
+
+        with pool.checkout() as client:
+            p = client.pipeline()
+            p.set(b'pool:key01', b'value')
+            self.assertEqual(b'value', p.get(b'pool:key01').result())
+            self.assertEqual(True, p.version().result())
+            self.assertEqual({'size': 1, 'idle': 0}, pool.stats())
+
+        self.assertEqual({'size': 1, 'idle': 1}, pool.stats())
+
+    def test_share_when_full(self) -> None:
+        pool = self.new_pool(min_size=0, max_size=2)
+
+        conns = [pool.checkout() for _ in range(5)]
+        self.assertEqual(2, len(self.sockets))
+        self.assertEqual(
+            [conns[0], conns[1], conns[0], conns[1], conns[0]],
+            conns,
+        )
+
+        for c in conns[:4]:
+            c.release()
+        self.assertEqual({'size': 2, 'idle': 1}, pool.stats())
+
+        conns[4].release()
+        self.assertEqual({'size': 2, 'idle': 2}, pool.stats())
+
+    def test_reap_idle(self) -> None:
+        pool = self.new_pool(min_size=1, max_size=4, idle_timeout=30)
+
+        conns = [pool.checkout() for _ in range(3)]
+        for c in conns:
+            c.release()
+            self.clock.now += 10
+        self.assertEqual({'size': 3, 'idle': 3}, pool.stats())
+
+        self.clock.now += 5
+        pool.reap()
+        self.assertEqual({'size': 2, 'idle': 2}, pool.stats())
+
+        self.clock.now += 100
+        pool.reap()
+        self.assertEqual({'size': 1, 'idle': 1}, pool.stats())
+
+        self.assertIs(conns[2], pool.checkout())
+
+    def test_probe_dead_connection(self) -> None:
+        pool = self.new_pool(min_size=0, max_size=4, probe_interval=5)
+
+        c = pool.checkout()
+        c.release()
+
+        self.sockets[0].shutdown(socket.SHUT_RDWR)
+        self.clock.now += 10
+
+        c2 = pool.checkout()
+        self.assertIsNot(c, c2)
+        self.assertEqual(2, len(self.sockets))
+        self.assertEqual({'size': 1, 'idle': 0}, pool.stats())
+
+        c2.release()
+
+    def test_release_failed_connection(self) -> None:
+        pool = self.new_pool(min_size=0, max_size=4)
+
+        c = pool.checkout()
+        p = c.client.pipeline()
+        r = p.get(b'pool:key02')
+        self.sockets[0].shutdown(socket.SHUT_RDWR)
+        with self.assertRaises(Exception):
+            r.result()
+
+        c.release()
+        self.assertEqual({'size': 0, 'idle': 0}, pool.stats())
+
+        with pool.checkout() as client:
+            self.assertIsNone(client.error)
+        self.assertEqual({'size': 1, 'idle': 1}, pool.stats())
+
+    def test_concurrent_checkouts(self) -> None:
+        pool = self.new_pool(min_size=0, max_size=3)
+        errors: List[BaseException] = []
+
+        def run() -> None:
+            try:
+                for i in range(50):
+                    with pool.checkout() as client:
+                        p = client.pipeline()
+                        assert p.version().result() is True
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=run) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], errors)
+        self.assertLessEqual(len(self.sockets), 3)
+        self.assertEqual({'size': len(self.sockets), 'idle': len(self.sockets)}, pool.stats())
+
+    def test_reap_on_release(self) -> None:
+        pool = self.new_pool(min_size=0, max_size=4, idle_timeout=30)
+
+        c1 = pool.checkout()
+        c2 = pool.checkout()
+        c1.release()
+        self.clock.now += 40
+        c2.release()
+        self.assertEqual({'size': 1, 'idle': 1}, pool.stats())
+
+    def tearDown(self) -> None:
+        for conn in self.sockets:
+            conn.close()
+        self.sockets = []
+        gc.collect()
+        self.assertEqual(0, cutil.py_get_mem())
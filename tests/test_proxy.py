@@ -0,0 +1,243 @@
+import asyncio
+import socket
+import subprocess
+import sys
+import time
+import unittest
+from typing import List
+
+import cproxy  # type: ignore
+
+from mcproxy import proxy
+from mcproxy.memcache import AsyncClient
+from mcproxy.proxy import start_server
+
+
+class TestRequestReader(unittest.TestCase):
+    def test_requests(self) -> None:
+        r = cproxy.RequestReader()
+        result = r.feed(b'mg key01 v\r\nms key02 3 T10\r\nABC\r\nmd key03\r\nmn\r\nversion\r\nget key04\r\n')
+        self.assertEqual([
+            (cproxy.CMD_MG, b'key01', b'mg key01 v\r\n', False),
+            (cproxy.CMD_MS, b'key02', b'ms key02 3 T10\r\nABC\r\n', False),
+            (cproxy.CMD_MD, b'key03', b'md key03\r\n', False),
+            (cproxy.CMD_MN, None, b'mn\r\n', False),
+            (cproxy.CMD_VERSION, None, b'version\r\n', False),
+            (cproxy.CMD_OTHER, None, b'get key04\r\n', False),
+        ], result)
+
+    def test_quiet(self) -> None:
+        r = cproxy.RequestReader()
+        result = r.feed(b'mg key01 v q k\r\nms key02 2 q\r\nAB\r\nmd key03 q\r\n')
+        self.assertEqual([
+            (cproxy.CMD_MG, b'key01', b'mg key01 v k\r\n', True),
+            (cproxy.CMD_MS, b'key02', b'ms key02 2\r\nAB\r\n', True),
+            (cproxy.CMD_MD, b'key03', b'md key03\r\n', True),
+        ], result)
+
+    def test_split(self) -> None:
+        r = cproxy.RequestReader()
+        self.assertEqual([], r.feed(b'mg ke'))
+        self.assertEqual([(cproxy.CMD_MG, b'key01', b'mg key01 v\r\n', False)], r.feed(b'y01 v\r\nms key02 5\r\nAB'))
+        self.assertEqual([], r.feed(b'C'))
+        self.assertEqual([(cproxy.CMD_MS, b'key02', b'ms key02 5\r\nABCDE\r\n', False)], r.feed(b'DE\r\n'))
+
+    def test_big_value(self) -> None:
+        r = cproxy.RequestReader()
+        value = b'X' * 100_000
+        data = b'ms key01 100000\r\n' + value + b'\r\n'
+
+        for i in range(0, len(data) - 1000, 1000):
+            self.assertEqual([], r.feed(data[i:i + 1000]))
+
+        result = r.feed(data[len(data) // 1000 * 1000 - 1000 + 1000:] if len(data) % 1000 else b'')
+        self.assertEqual([(cproxy.CMD_MS, b'key01', data, False)], result)
+
+    def test_invalid(self) -> None:
+        for data in (b'mg\r\n', b'mg ' + b'A' * 251 + b'\r\n', b'ms key01 abc\r\n', b'ms key01 2\r\nABC\r\n'):
+            result = cproxy.RequestReader().feed(b'mn\r\n' + data + b'mn\r\n')
+            self.assertEqual([
+                (cproxy.CMD_MN, None, b'mn\r\n', False),
+                (cproxy.CMD_INVALID, None, None, False),
+            ], result)
+
+
+class TestResponseReader(unittest.TestCase):
+    def test_responses(self) -> None:
+        r = cproxy.ResponseReader()
+        self.assertEqual(
+            [b'VA 3 c12\r\nABC\r\n', b'HD\r\n', b'EN\r\n', b'VERSION 1.6.21\r\n'],
+            r.feed(b'VA 3 c12\r\nABC\r\nHD\r\nEN\r\nVERSION 1.6.21\r\n'),
+        )
+
+    def test_split(self) -> None:
+        r = cproxy.ResponseReader()
+        self.assertEqual([b'HD\r\n'], r.feed(b'HD\r\nVA 5\r\nAB'))
+        self.assertEqual([], r.feed(b'CD'))
+        self.assertEqual([b'VA 5\r\nABCDE\r\n', b'NF\r\n'], r.feed(b'E\r\nNF\r\n'))
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError) as ex:
+            cproxy.ResponseReader().feed(b'VA 2\r\nABC\r\n')
+        self.assertEqual(('invalid response from server',), ex.exception.args)
+
+
+class TestProxyServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.server = await start_server('127.0.0.1', 0, [('localhost', 11211)])
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def request(self, data: bytes, n: int) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(data)
+        result = await reader.readexactly(n)
+        writer.close()
+        return result
+
+    async def test_set_get_delete(self) -> None:
+        c = await AsyncClient.connect('127.0.0.1', self.port)
+
+        self.assertEqual(True, await c.set(b'proxy:key01', b'value 01'))
+        self.assertEqual(b'value 01', await c.get(b'proxy:key01'))
+        self.assertEqual(True, await c.delete(b'proxy:key01'))
+        self.assertEqual(None, await c.get(b'proxy:key01'))
+
+        c.close()
+
+    async def test_many_clients(self) -> None:
+        clients = [await AsyncClient.connect('127.0.0.1', self.port) for _ in range(10)]
+
+        async def run(i: int) -> bytes:
+            c = clients[i % len(clients)]
+            await c.set(f'proxy:multi:{i}'.encode(), f'value:{i}'.encode())
+            return await c.get(f'proxy:multi:{i}'.encode())
+
+        values = await asyncio.gather(*[run(i) for i in range(200)])
+        self.assertEqual([f'value:{i}'.encode() for i in range(200)], values)
+
+        for c in clients:
+            c.close()
+
+    async def test_local_commands(self) -> None:
+        resp = await self.request(b'mn\r\nversion\r\nget key01\r\nmn\r\n', 32)
+        self.assertEqual(b'MN\r\nVERSION mcproxy\r\nERROR\r\nMN\r\n', resp)
+
+    async def test_quiet(self) -> None:
+        resp = await self.request(
+            b'md proxy:key02 q\r\nmg proxy:key02 v q\r\nms proxy:key02 2 q\r\nAB\r\nmg proxy:key02 v q\r\nmn\r\n',
+            14,
+        )
+        self.assertEqual(b'VA 2\r\nAB\r\nMN\r\n', resp)
+
+    async def test_bad_request(self) -> None:
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(b'mn\r\nms key01 abc\r\nmn\r\n')
+        self.assertEqual(b'MN\r\nCLIENT_ERROR bad command line format\r\n', await reader.read())
+        writer.close()
+
+    async def test_upstream_down(self) -> None:
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        server = await start_server('127.0.0.1', 0, [('127.0.0.1', port)])
+        proxy_port = server.sockets[0].getsockname()[1]
+
+        c = await AsyncClient.connect('127.0.0.1', proxy_port)
+        with self.assertRaises(ValueError):
+            await c.get(b'proxy:key03')
+        c.close()
+
+        server.close()
+        await server.wait_closed()
+
+
+class FakeTransport:
+    def __init__(self) -> None:
+        self.reading = True
+        self.written: List[bytes] = []
+
+    def pause_reading(self) -> None:
+        self.reading = False
+
+    def resume_reading(self) -> None:
+        self.reading = True
+
+    def is_closing(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> None:
+        self.written.append(data)
+
+
+class TestFlowControl(unittest.IsolatedAsyncioTestCase):
+    async def test_pause_reading(self) -> None:
+        loop = asyncio.get_running_loop()
+        client = proxy._ClientProtocol(proxy._Upstreams(loop, [('localhost', 11211)], 1))
+        client_transport = FakeTransport()
+        client.connection_made(client_transport)
+        upstream = proxy._UpstreamProtocol(loop)
+        upstream.connection_made(FakeTransport())
+
+        # the client does not read its responses
+        client.pause_writing()
+        self.assertFalse(client_transport.reading)
+        client.resume_writing()
+        self.assertTrue(client_transport.reading)
+
+        # the upstream node does not keep up, the clients sending to it are paused until it drains
+        upstream.pause_writing()
+        upstream.send(b'mn\r\n', proxy._Reply(client, cproxy.CMD_MN, False))
+        upstream.send(b'mn\r\n', proxy._Reply(client, cproxy.CMD_MN, False))
+        self.assertFalse(client_transport.reading)
+
+        client.pause_writing()
+        upstream.resume_writing()
+        self.assertFalse(client_transport.reading)
+        client.resume_writing()
+        self.assertTrue(client_transport.reading)
+
+        # a failed upstream connection does not keep its clients paused
+        upstream.pause_writing()
+        upstream.send(b'mn\r\n', proxy._Reply(client, cproxy.CMD_MN, False))
+        self.assertFalse(client_transport.reading)
+        upstream.connection_lost(None)
+        self.assertTrue(client_transport.reading)
+
+
+class TestProxyMain(unittest.TestCase):
+    def test_workers(self) -> None:
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        proc = subprocess.Popen([
+            sys.executable, '-m', 'mcproxy', '--listen', f'127.0.0.1:{port}',
+            '--upstream', 'localhost:11211', '--workers', '2',
+        ])
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    conn = socket.create_connection(('127.0.0.1', port), timeout=1)
+                    break
+                except ConnectionRefusedError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+
+            conn.sendall(b'ms proxy:key04 3\r\nABC\r\nmg proxy:key04 v\r\n')
+            data = b''
+            while len(data) < 15:
+                data += conn.recv(1024)
+            self.assertEqual(b'HD\r\nVA 3\r\nABC\r\n', data)
+            conn.close()
+        finally:
+            proc.terminate()
+            proc.wait(10)
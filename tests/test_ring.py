@@ -0,0 +1,72 @@
+import unittest
+
+import cring  # type: ignore
+import cutil  # type: ignore
+
+
+class TestHashRing(unittest.TestCase):
+    def test_single_node(self) -> None:
+        r = cring.HashRing(['node01'])
+        self.assertEqual(160, len(r))
+        self.assertEqual(0, r.get_node(b'key01'))
+        self.assertEqual('node01', r.get_node_name(b'key02'))
+
+        del r
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_invalid(self) -> None:
+        with self.assertRaises(ValueError) as ex:
+            cring.HashRing([])
+        self.assertEqual(('ring must have at least one node',), ex.exception.args)
+
+        with self.assertRaises(ValueError) as ex:
+            cring.HashRing(['node01'], 10)
+        self.assertEqual(('points_per_node must be a positive multiple of 4',), ex.exception.args)
+
+        self.assertEqual(0, cutil.py_get_mem())
+
+    def test_distribution(self) -> None:
+        nodes = [f'10.0.0.{i}:11211' for i in range(12)]
+        r = cring.HashRing(nodes)
+
+        counts = [0] * len(nodes)
+        for i in range(12000):
+            counts[r.get_node(f'key:{i}'.encode())] += 1
+
+        for c in counts:
+            self.assertGreater(c, 500)
+            self.assertLess(c, 1500)
+
+    def test_remove_node_moves_only_its_keys(self) -> None:
+        nodes = [f'10.0.0.{i}:11211' for i in range(12)]
+        r1 = cring.HashRing(nodes)
+        r2 = cring.HashRing(nodes[:5] + nodes[6:])
+
+        for i in range(5000):
+            key = f'key:{i}'.encode()
+            before = r1.get_node_name(key)
+            if before != nodes[5]:
+                self.assertEqual(before, r2.get_node_name(key))
+
+    def test_same_for_any_node_order(self) -> None:
+        nodes = [f'node{i}' for i in range(5)]
+        r1 = cring.HashRing(nodes)
+        r2 = cring.HashRing(list(reversed(nodes)))
+
+        for i in range(1000):
+            key = f'key:{i}'.encode()
+            self.assertEqual(r1.get_node_name(key), r2.get_node_name(key))
+
+    def test_get_nodes(self) -> None:
+        nodes = [f'10.0.0.{i}:11211' for i in range(5)]
+        r = cring.HashRing(nodes)
+
+        for i in range(1000):
+            key = f'key:{i}'.encode()
+            replicas = r.get_nodes(key, 3)
+            self.assertEqual(3, len(set(replicas)))
+            self.assertEqual(r.get_node(key), replicas[0])
+            self.assertEqual(replicas[:2], r.get_nodes(key, 2))
+
+        self.assertEqual(5, len(r.get_nodes(b'key01', 10)))
+        self.assertEqual([0], cring.HashRing(['node01']).get_nodes(b'key01', 3))